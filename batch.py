@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+from lib.batch import expand_inputs, run_batch
+from lib.pipeline import Pipeline
+
+#=============================================================================================================================================
+
+# Non-interactive cleaning of many extracts (see lib/batch.py), e.g.:
+#
+#   python batch.py 'extracts/**/*.csv' --output-dir cleaned --format parquet --dropna both --jobs 4
+
+def main():
+    parser = argparse.ArgumentParser(description='Cleans many home visits extracts in parallel, without prompts.')
+    parser.add_argument('inputs', nargs='+', help='CSV or Parquet files, glob patterns (quoted) or URLs')
+    parser.add_argument('--output-dir', default='cleaned', help='directory of the cleaned tables and of the manifest')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'sqlite'], default='csv', help='format of the cleaned tables')
+    parser.add_argument('--dropna', choices=['keep', 'drop', 'both'], default='both',
+                        help='write the full table (keep), the table without rows with null values (drop) or both')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (number of CPUs by default)')
+    parser.add_argument('--chunksize', type=int, default=None, help='process each file in chunks of this many rows')
+    parser.add_argument('--retries', type=int, default=1, help='number of times a failed file is tried again')
+    parser.add_argument('--retry-delay', type=float, default=1.0, help='seconds before trying a failed file again')
+    parser.add_argument('--skip-existing', action='store_true', help='skip the files whose outputs exist already')
+    parser.add_argument('--manifest', default=None, help='manifest file (manifest.json in the output directory by default)')
+    parser.add_argument('--pipeline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.json'),
+                        help='cleaning steps')
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--row-group-size', type=int, default=None, help='maximum number of rows per Parquet row group')
+    parser.add_argument('--compact', action='store_true', help='store the vitals as float32 and the counts as small integers')
+    parser.add_argument('--no-cache', action='store_true', help='download the URLs without the local cache')
+    parser.add_argument('--cache-dir', default=None, help='directory of the local cache')
+    args = parser.parse_args()
+
+    try:
+        paths = expand_inputs(args.inputs)
+    except FileNotFoundError as error:
+        parser.error(str(error))
+
+    pipeline = Pipeline.from_file(args.pipeline, args.compact) # fails here on an invalid pipeline, before starting the workers
+
+    manifest = run_batch(pipeline.spec, paths, args.output_dir, args.format, args.dropna, args.jobs, args.retries,
+                         args.retry_delay, args.skip_existing, args.manifest, chunksize=args.chunksize,
+                         compression=args.compression, row_group_size=args.row_group_size, cache_dir=args.cache_dir,
+                         use_cache=not args.no_cache)
+
+    totals = manifest['totals']
+    print('-'*40, f"{totals['ok']} cleaned, {totals['failed']} failed, {totals['skipped']} skipped "
+                  f"({manifest['rows_in']} -> {manifest['rows_out']} rows, {manifest['seconds']:.1f} s)", '-'*40)
+    sys.exit(1 if totals['failed'] else 0)
+
+if __name__ == '__main__':
+    main()
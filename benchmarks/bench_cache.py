@@ -0,0 +1,103 @@
+import argparse
+import hashlib
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.cache import RawCache, RawExtractUnavailable
+
+# Benchmark of the raw extract cache against a local HTTP stand-in of the source (with ETag support): first download,
+# reload from the cache, revalidation (304), new content, eviction and the error when the source is down and nothing
+# is cached.
+
+class Source(BaseHTTPRequestHandler):
+    """
+    Serves Source.content with an ETag, answering 304 to a matching If-None-Match.
+    """
+
+    content = b''
+    requests = 0
+
+    def do_GET(self):
+        Source.requests += 1
+        etag = '"' + hashlib.md5(Source.content).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(Source.content)))
+        self.end_headers()
+        self.wfile.write(Source.content)
+
+    def log_message(self, *args):
+        pass
+
+def extract(rows, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'id_paciente': [f'{i:032x}' for i in rng.integers(0, 2 ** 62, rows)],
+                       'sexo': rng.choice(['female', 'male'], rows),
+                       'altura': rng.normal(165, 10, rows).round(1),
+                       'updated_at': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 10 ** 7, rows), unit='s')})
+    return df.to_csv(index=False).encode()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the raw extract cache.')
+    parser.add_argument('--rows', type=int, default=500_000)
+    args = parser.parse_args()
+
+    Source.content = extract(args.rows, 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Source)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/extract.csv'
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = RawCache(directory)
+
+        start = time.perf_counter()
+        first = cache.load(url)
+        t_cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        second = cache.load(url)
+        t_warm = time.perf_counter() - start
+        assert first.equals(second) and Source.requests == 1
+
+        start = time.perf_counter()
+        cache.load(url, refresh=True)
+        t_refresh = time.perf_counter() - start
+        assert Source.requests == 2 # answered with 304
+
+        Source.content = extract(args.rows, 1)
+        assert not cache.load(url, refresh=True).equals(first)
+
+        Source.content = extract(args.rows, 2)
+        small = RawCache(directory, max_bytes=1)
+        small.fetch(url + '?copy', refresh=True)
+        assert url not in small._index() and len(small._index()) == 1 # older entry evicted
+
+        server.shutdown()
+        server.server_close()
+        assert cache.load(url + '?copy').shape == first.shape # source down, cached copy used
+
+        try:
+            cache.load(url + '?missing')
+            raise AssertionError('expected RawExtractUnavailable')
+        except RawExtractUnavailable as error:
+            print(f'Source down and nothing cached: {error}')
+
+    print(f'{args.rows} rows ({len(Source.content) / 1e6:.1f} MB)')
+    print(f'download and parse:     {t_cold:8.3f} s')
+    print(f'reload from the cache:  {t_warm:8.3f} s ({t_cold / t_warm:.0f}x)')
+    print(f'revalidation (304):     {t_refresh:8.3f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.engines import engines, run_engine
+from lib.loader import load_raw
+from lib.pipeline import Pipeline
+from lib.streaming import write_csv
+from synthetic import write
+
+# Same cleaning with the pandas backend and with the embedded engines (see lib/engines.py), on a synthetic extract (the
+# shared corpus): time, peak memory and whether the CSV output of each engine is identical to the one of pandas. The
+# new IDs of the duplicates are generated with a fixed seed, so the outputs are compared whole. Exits with status 1 when
+# an output differs, e.g.:
+#
+#   python benchmarks/bench_engines.py --rows 1000000 --engines pandas polars duckdb
+
+pipeline_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipeline.json')
+
+def seeded_spec():
+    with open(pipeline_path, encoding='utf-8') as file:
+        spec = json.load(file)
+    for entry in spec['steps']:
+        if entry['step'] == 'duplicates':
+            entry['seed'] = 0
+    return spec
+
+def run_case(engine, path, output):
+    start = time.perf_counter()
+    pipeline = Pipeline(seeded_spec())
+    if engine == 'pandas':
+        df, _ = load_raw(path)
+        write_csv(pipeline.run(df), output, sep=';', decimal=',')
+    else:
+        run_engine(pipeline, path, {output: False}, engine)
+    return time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+
+def differences(output, reference):
+    a, b = (pd.read_csv(path, sep=';', dtype=str, keep_default_na=False) for path in (output, reference))
+    if list(a.columns) != list(b.columns) or len(a) != len(b):
+        return [f'shape {a.shape} != {b.shape} or different columns']
+    return [f'{col}: {int((a[col] != b[col]).sum())} rows' for col in a.columns if not a[col].equals(b[col])]
+
+def main():
+    parser = argparse.ArgumentParser(description='Pandas backend against the Polars and DuckDB engines.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--input', default=None, help='raw CSV file (a synthetic one is generated by default)')
+    parser.add_argument('--engines', nargs='+', choices=engines, default=engines)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.input
+        if path is None:
+            path = os.path.join(directory, 'raw.csv')
+            write(args.rows, path, seed=args.seed)
+
+        reference = None
+        print(f'{"":<8} {"seconds":>8} {"peak MB":>8}  output')
+        for engine in ['pandas'] + [engine for engine in args.engines if engine != 'pandas']:
+            output = os.path.join(directory, f'{engine}.csv')
+            try:
+                with ProcessPoolExecutor(1) as executor:
+                    seconds, peak = executor.submit(run_case, engine, path, output).result()
+            except ImportError as error:
+                print(f'{engine:<8} skipped ({error})')
+                continue
+
+            if engine == 'pandas':
+                reference, result = output, 'reference'
+            else:
+                diff = differences(output, reference)
+                failed |= bool(diff)
+                result = 'identical to pandas' if not diff else 'differs: ' + ', '.join(diff)
+            if engine in args.engines:
+                print(f'{engine:<8} {seconds:>8.2f} {peak:>8.0f}  {result}')
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
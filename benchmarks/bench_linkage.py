@@ -0,0 +1,100 @@
+import argparse
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.linkage import blocking, comparisons, link_records
+from synthetic import generate
+
+# Record linkage (see lib/linkage.py) on synthetic extracts where a share of the patients is registered a second time
+# under a new ID: the copy keeps the birth date and sex, its height moves by up to 2 cm, one other compared field
+# changes now and then and a few copies move to another neighbourhood (those can only be found by a second blocking).
+# Each size runs in a new process; the output has the time, the candidate pairs, the recall and precision of the links,
+# the memory of the columns read and the peak memory allocated by the linkage (traced), and the last line extrapolates
+# them per row to --target-rows, e.g.:
+#
+#   python benchmarks/bench_linkage.py --rows 1000000 2000000 --target-rows 30000000
+
+def planted(rows, share, seed, keys=blocking):
+    """
+    Synthetic extract (the compared columns as categorical, like a cleaned table read by linkage.read_columns) with
+    copies of some of its rows under new IDs.
+
+    Returns:
+    --------
+    df : pandas.DataFrame
+    truth : pandas.DataFrame
+        Original and copy ID of each planted duplicate
+    """
+    rng = np.random.default_rng(seed)
+    df = generate(rows, seed=seed)
+    sources = rng.choice(rows, int(rows * share), replace=False)
+    copies = df.iloc[sources].copy()
+    copies['id_paciente'] = [f'copy-{i}' for i in range(len(copies))]
+    copies['altura'] = copies['altura'] + rng.integers(-2, 3, len(copies))
+
+    fields = [col for col in comparisons if col in df.columns and 'tolerance' not in comparisons[col]]
+    changed = rng.random(len(copies)) < 0.3
+    for col, rows_changed in zip(rng.choice(fields, changed.sum()), np.flatnonzero(changed)):
+        copies.iloc[rows_changed, copies.columns.get_loc(col)] = df[col].iloc[rng.integers(0, rows)]
+    moved = rng.random(len(copies)) < 0.05
+    copies.loc[moved, 'bairro'] = df['bairro'].sample(moved.sum(), random_state=seed).to_numpy()
+
+    truth = pd.DataFrame({'original': df['id_paciente'].iloc[sources].to_numpy(), 'copy': copies['id_paciente'].to_numpy()})
+    df = pd.concat([df, copies], ignore_index=True)
+    used = ['id_paciente', 'data_atualizacao_cadastro'] + [col for key in keys for col in key] + list(comparisons)
+    df = df[[col for col in df.columns if col in used]]
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    return df, truth
+
+def run_case(rows, share, seed, keys, threshold):
+    df, truth = planted(rows, share, seed, keys)
+    table_mb = df.memory_usage(deep=True).sum() / 2 ** 20
+    tracemalloc.start()
+    start = time.perf_counter()
+    _, links, summary = link_records(df, blocking=keys, threshold=threshold)
+    seconds = time.perf_counter() - start
+    linkage_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+
+    found = pd.concat([links[['left_id', 'right_id']].set_axis(['original', 'copy'], axis=1),
+                       links[['right_id', 'left_id']].set_axis(['original', 'copy'], axis=1)])
+    true_links = truth.merge(found.drop_duplicates(), on=['original', 'copy']).shape[0]
+    return (len(df), seconds, summary['candidate_pairs'], true_links / max(len(truth), 1), true_links / max(len(links), 1),
+            table_mb, linkage_mb)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time, quality and memory of the record linkage.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[500_000, 1_000_000])
+    parser.add_argument('--target-rows', type=int, default=30_000_000, help='number of rows of the estimate')
+    parser.add_argument('--share', type=float, default=0.02, help='fraction of the patients registered twice')
+    parser.add_argument('--block', nargs='+', action='append', default=None, metavar='COLUMN',
+                        help='columns of a blocking key (can be repeated)')
+    parser.add_argument('--threshold', type=float, default=8.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{"rows":>10} {"seconds":>8} {"pairs":>11} {"recall":>7} {"precision":>9} {"table MB":>9} {"linkage MB":>10}')
+    results = []
+    for rows in args.rows:
+        with ProcessPoolExecutor(1) as executor:
+            result = executor.submit(run_case, rows, args.share, args.seed, args.block or blocking, args.threshold).result()
+        results.append(result)
+        n, seconds, pairs, recall, precision, table_mb, linkage_mb = result
+        print(f'{n:>10} {seconds:>8.2f} {pairs:>11} {recall:>7.3f} {precision:>9.3f} {table_mb:>9.0f} {linkage_mb:>10.0f}')
+
+    n, seconds, _, _, _, table_mb, linkage_mb = results[-1]
+    scale = args.target_rows / n
+    print(f'Estimate for {args.target_rows} rows: {seconds * scale:.0f} s, {table_mb * scale / 1024:.1f} GB of columns and '
+          f'{linkage_mb * scale / 1024:.1f} GB allocated by the linkage (linear in the rows)')
+
+if __name__ == '__main__':
+    main()
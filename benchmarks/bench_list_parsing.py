@@ -0,0 +1,71 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.functions import clean_column, split_string, parse_list_column, encode_list_column
+
+# Benchmark of the list columns parsing: clean_column + split_string (ast based) against parse_list_column
+# (tokenizer, one parse per distinct value) and encode_list_column (categorical output).
+
+# Values in the same formats found in the raw extract
+samples = ['[]', 'Diabetes', 'Hipertensão', 'Diabetes, Hipertensão', '["Hipertens\\u00e3o"]',
+           '["Hipertens\\u00e3o", "Diabetes"]', '["Usu\\u00e1rio de Drogas Il\\u00edcitas", "AIDS"]',
+           "['Internet', 'Televisão']", '["Rede Privada"]', 'Unidade de Saúde, Rede Privada', '[1, 2]']
+
+def timeit(func, repeat):
+    """
+    Runs a function a few times and returns the best time.
+
+    Parameters:
+    -----------
+    func : function
+    repeat : int
+
+    Returns:
+    --------
+    best : float
+        Best time in seconds
+    result
+        Output of the last run
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the list columns parsing.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    raw = pd.DataFrame({'col': rng.choice(np.array(samples, dtype=object), args.rows)})
+
+    def current():
+        df = clean_column(raw.copy(), 'col')
+        return split_string(df, 'col')['col']
+
+    t_current, expected = timeit(current, args.repeat)
+    t_buffers, (offsets, values) = timeit(lambda: parse_list_column(raw['col']), args.repeat)
+    t_encoded, encoded = timeit(lambda: encode_list_column(raw.copy(), 'col')['col'], args.repeat)
+
+    # Same results as the current path
+    rebuilt = [list(values[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+    assert rebuilt == list(expected)
+    assert list(encoded.astype(str)) == [str(items) for items in expected]
+
+    print(f'{args.rows} rows, best of {args.repeat}')
+    print(f'clean_column + split_string: {t_current:8.3f} s')
+    print(f'parse_list_column:           {t_buffers:8.3f} s ({t_current / t_buffers:.0f}x)')
+    print(f'encode_list_column:          {t_encoded:8.3f} s ({t_current / t_encoded:.0f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.functions import boolean_to_int, standardize_dates
+from lib.loader import load_raw, schema
+from synthetic import write
+
+# Benchmark of the raw load: pd.read_csv with type inference followed by the conversions the loader does at read time
+# (dates and booleans, as standardize_dates and boolean_to_int do them in the pipeline), against the typed loader with
+# the pyarrow and pandas C engines. Each case runs in a new process, so that its peak memory (growth of the peak
+# resident size, which also counts the memory allocated by pyarrow) is not hidden by the previous cases.
+
+dates = [col for col, kind in schema.items() if kind == 'datetime']
+booleans = [col for col, kind in schema.items() if kind == 'boolean']
+
+def read_csv(path):
+    df = standardize_dates(pd.read_csv(path), dates, flags=False)
+    for col in booleans:
+        df = boolean_to_int(df, col)
+    return df
+
+cases = {'pd.read_csv + conversions': read_csv,
+         'load_raw (pyarrow)': lambda path: load_raw(path, engine='pyarrow')[0],
+         'load_raw (c)': lambda path: load_raw(path, engine='c')[0]}
+
+def run_case(name, path):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    df = cases[name](path)
+    seconds = time.perf_counter() - start
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024 # kilobytes on Linux
+    return seconds, peak, df.memory_usage(deep=True).sum() / 2 ** 20
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the typed loader of the raw extract.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--input', default=None, help='raw CSV file (a synthetic one is generated by default)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.input
+        if path is None:
+            path = os.path.join(directory, 'raw.csv')
+            write(args.rows, path)
+
+        print(f'{os.path.getsize(path) / 1e6:.0f} MB file')
+        print(f'{"":<26} {"seconds":>8} {"peak MB":>8} {"table MB":>9}')
+        for name in cases:
+            with ProcessPoolExecutor(1) as executor:
+                seconds, peak, size = executor.submit(run_case, name, path).result()
+            print(f'{name:<26} {seconds:>8.2f} {peak:>8.0f} {size:>9.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.functions import null_rows
+from lib.loader import load_raw
+from lib.pipeline import Pipeline
+from lib.streaming import write_csv
+from synthetic import write
+
+# Peak memory of a full run (load, pipeline and both CSV outputs, the one without null values written through a mask):
+#
+# - default: eager run with the default types
+# - compact: eager run with the compact types (Pipeline(..., compact=True), i.e. cleaning.py --compact)
+# - chunked: compact types, file processed in chunks of --chunksize rows (cleaning.py --compact --chunksize)
+#
+# Each run is done in a new process at two sizes, and the peak resident size is fitted as fixed + per-row cost to
+# estimate the memory needed for --target-rows rows. The load column is the peak right after the typed load: in an eager
+# run it is most of the peak, the compact types make the cleaned table smaller, not the raw one. With --max-mb the script
+# exits with status 1 when the estimate of --check goes over the budget, e.g. for a 20M-row extract on a 16 GB worker:
+#
+#   python benchmarks/bench_memory.py --rows 1000000 --target-rows 20000000 --check chunked --max-mb 16000
+
+pipeline_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipeline.json')
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+
+def run_case(mode, path, directory, chunksize):
+    start = time.perf_counter()
+    pipeline = Pipeline.from_file(pipeline_path, compact=mode != 'default')
+    outputs = {os.path.join(directory, 'full.csv'): False, os.path.join(directory, 'dropna.csv'): True}
+
+    if mode == 'chunked':
+        pipeline.run_chunked(path, outputs, chunksize)
+        return time.perf_counter() - start, None, _max_rss_mb(), None
+
+    df, _ = load_raw(path, columns=pipeline.input_columns(None))
+    loaded = _max_rss_mb()
+    df = pipeline.run(df)
+    table_mb = df.memory_usage(deep=True).sum() / 2 ** 20
+    keep = ~null_rows(df)
+    for output, dropna in outputs.items():
+        write_csv(df, output, keep if dropna else None, sep=';', decimal=',')
+    return time.perf_counter() - start, loaded, _max_rss_mb(), table_mb
+
+def measure(*args):
+    with ProcessPoolExecutor(1) as executor:
+        return executor.submit(run_case, *args).result()
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak memory of the cleaning with the default and the compact types.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='largest synthetic extract (half of it is run too)')
+    parser.add_argument('--target-rows', type=int, default=20_000_000, help='number of rows of the memory estimate')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='chunk size of the chunked run')
+    parser.add_argument('--modes', nargs='+', choices=['default', 'compact', 'chunked'], default=['default', 'compact', 'chunked'])
+    parser.add_argument('--check', choices=['default', 'compact', 'chunked'], default='compact',
+                        help='run whose estimate is compared with --max-mb')
+    parser.add_argument('--max-mb', type=float, default=None, help='memory budget of the estimate of --check')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    def mb(value):
+        return f'{value:>9.0f}' if value is not None else f'{"-":>9}'
+
+    estimates = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sizes = [args.rows // 2, args.rows]
+        paths = {}
+        for rows in sizes:
+            paths[rows] = os.path.join(directory, f'raw_{rows}.csv')
+            write(rows, paths[rows], seed=args.seed)
+
+        print(f'{"":<8} {"rows":>10} {"seconds":>8} {"load MB":>9} {"peak MB":>9} {"table MB":>9}')
+        for mode in args.modes:
+            peaks = []
+            for rows in sizes:
+                seconds, loaded, peak, table_mb = measure(mode, paths[rows], directory, args.chunksize)
+                peaks.append(peak)
+                print(f'{mode:<8} {rows:>10} {seconds:>8.2f} {mb(loaded)} {mb(peak)} {mb(table_mb)}')
+
+            per_row = max(peaks[1] - peaks[0], 0) / (sizes[1] - sizes[0])
+            estimates[mode] = peaks[1] + per_row * (args.target_rows - sizes[1])
+            print(f'{mode:<8} {per_row * 2 ** 20:.0f} bytes per row, estimated peak for {args.target_rows} rows: '
+                  f'{estimates[mode] / 1024:.1f} GB')
+
+    if args.max_mb is not None and args.check in estimates and estimates[args.check] > args.max_mb:
+        print(f'Estimated peak of the {args.check} run ({estimates[args.check]:.0f} MB) over the budget of {args.max_mb:.0f} MB.')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lib.functions import (boolean_to_int, clean_column, split_string, encode_list_column, parse_dates, standardize_date,
+                           standardize_dates, diseases_flag, internet_flag, check_id_duplicates, resolve_duplicates,
+                           fix_duplicates, replace_strings, create_category_col, transform_family_income, calculate_IQR_lims,
+                           valid_uuids)
+from lib.pipeline import Pipeline
+from lib.validation import validate
+from synthetic import generate, write
+
+# Benchmark suite of the cleaning code on synthetic extracts (see synthetic.py) of several sizes:
+#
+# - functions: each cleaning function of lib/functions.py on its own, legacy paths included
+# - steps: each group of the execution plan of pipeline.json, in order, on the output of the previous one
+# - main: cleaning.py end to end in a subprocess (reading the CSV file, cleaning and writing the output)
+#
+# Each case gets its best time over --repeat runs and its peak memory: the peak of the allocations traced by tracemalloc
+# during one extra run (numpy and pandas buffers included), or the peak resident size of the process for main.
+#
+# The results are saved as JSON (--save). Given a previous result file (--baseline), the cases slower or bigger than the
+# baseline by more than --threshold are listed and the exit status is 1, so the suite can guard against regressions:
+#
+#   python benchmarks/bench_suite.py --sizes 10000 100000 --save baseline.json
+#   python benchmarks/bench_suite.py --sizes 10000 100000 --baseline baseline.json
+
+root = Path(__file__).resolve().parents[1]
+
+# Differences below these are noise, not regressions
+min_seconds = 0.005
+min_mb = 1.0
+
+def measure(setup, func, repeat):
+    """
+    Best time and peak traced memory of a function.
+
+    Parameters:
+    -----------
+    setup : function
+        Builds the input of func (not measured), e.g. a copy of the table
+    func : function
+        Measured function, called with the output of setup
+    repeat : int
+
+    Returns:
+    --------
+    dict
+        seconds (best time) and peak_mb
+    """
+    best = np.inf
+    for _ in range(repeat):
+        data = setup()
+        start = time.perf_counter()
+        func(data)
+        best = min(best, time.perf_counter() - start)
+
+    data = setup()
+    tracemalloc.start()
+    try:
+        func(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': best, 'peak_mb': peak / 2 ** 20}
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def function_cases(raw):
+    """
+    Cases of the functions section: name -> (setup, func).
+    """
+    dates = ['data_cadastro', 'data_nascimento', 'data_atualizacao_cadastro', 'updated_at']
+    encoded = encode_list_column(raw[['doencas_condicoes', 'meios_comunicacao']].copy(), 'doencas_condicoes')
+    encoded = encode_list_column(encoded, 'meios_comunicacao')
+    lists = clean_column(raw[['doencas_condicoes']].copy(), 'doencas_condicoes')
+    lists = split_string(lists, 'doencas_condicoes')
+    cleaned = standardize_dates(raw[['id_paciente'] + dates].copy(), dates, flags=False)
+    duplicated = check_id_duplicates(cleaned, 'id_paciente')
+    duplicated = duplicated[0] + duplicated[1] if duplicated else []
+
+    def copy(cols, df=raw):
+        return lambda: df[cols].copy()
+
+    return {
+        'boolean_to_int': (copy(['obito']), lambda df: boolean_to_int(df, 'obito')),
+        'clean_column+split_string': (copy(['doencas_condicoes']),
+                                      lambda df: split_string(clean_column(df, 'doencas_condicoes'), 'doencas_condicoes')),
+        'encode_list_column': (copy(['doencas_condicoes']), lambda df: encode_list_column(df, 'doencas_condicoes')),
+        'diseases_flag (lists)': (copy(['doencas_condicoes'], lists), diseases_flag),
+        'diseases_flag (encoded)': (copy(['doencas_condicoes'], encoded), diseases_flag),
+        'internet_flag': (copy(['meios_comunicacao'], encoded), internet_flag),
+        'parse_dates': (lambda: raw['data_cadastro'], parse_dates),
+        'standardize_date': (copy(['data_cadastro']), lambda df: standardize_date(df, 'data_cadastro')),
+        'standardize_dates': (copy(dates), lambda df: standardize_dates(df, dates)),
+        'check_id_duplicates': (lambda: cleaned, lambda df: check_id_duplicates(df, 'id_paciente')),
+        'resolve_duplicates': (lambda: cleaned, resolve_duplicates),
+        'fix_duplicates': (lambda: cleaned, lambda df: fix_duplicates(df, 'id_paciente', duplicated)),
+        'replace_strings': (copy(['situacao_profissional']),
+                            lambda df: replace_strings(df, 'situacao_profissional', ['Não se aplica', 'Não trabalha'], 'Desempregado')),
+        'create_category_col': (copy(['ocupacao']), lambda df: create_category_col(df, 'ocupacao', 'categoria_ocupacao')),
+        'transform_family_income': (copy(['renda_familiar']), transform_family_income),
+        'calculate_IQR_lims': (lambda: raw, lambda df: calculate_IQR_lims(df, 'peso')),
+        'valid_uuids': (lambda: raw['id_paciente'], valid_uuids),
+        'validate (raw)': (lambda: raw, validate),
+        'validate (cleaned)': (lambda: cleaned, validate),
+    }
+
+def label(position, group):
+    """
+    Name of a group of the execution plan in the results (e.g. '13 replace_values(religiao)').
+    """
+    steps = getattr(group, 'steps', [group])
+    names = []
+    for step in steps:
+        col = step.kwargs.get('col')
+        names.append(f'{step.name}({col})' if isinstance(col, str) else step.name)
+    return f'{position:02d} ' + '+'.join(names)
+
+def bench_steps(raw, repeat):
+    """
+    Times each group of the execution plan of pipeline.json on the output of the previous group. A new pipeline is
+    built for each run, so the caches of the steps start empty every time.
+
+    Returns:
+    --------
+    dict
+        Label -> measure
+    """
+    def new_plan():
+        return Pipeline.from_file(root / 'pipeline.json').plan()
+
+    # Input of each group
+    inputs = []
+    df = raw.copy()
+    for group in new_plan():
+        inputs.append(df)
+        df = group.run(df.copy(), group.fit(df)) if group.is_global else group.run(df.copy())
+
+    results = {}
+    for position, group in enumerate(new_plan()):
+        def func(args):
+            group, df = args
+            return group.run(df, group.fit(df)) if group.is_global else group.run(df)
+        results[label(position, group)] = measure(lambda: (new_plan()[position], inputs[position].copy()), func, repeat)
+
+    results['total (Pipeline.run)'] = measure(lambda: (Pipeline.from_file(root / 'pipeline.json'), raw.copy()),
+                                              lambda args: args[0].run(args[1]), repeat)
+    return results
+
+def bench_main(rows, seed, repeat, args=()):
+    """
+    Runs cleaning.py on a synthetic CSV file in a subprocess, answering its questions (keep rows with null values).
+
+    Returns:
+    --------
+    dict
+        seconds (best wall time) and peak_mb (peak resident size of the subprocess)
+    """
+    best, peak = np.inf, 0
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'raw.csv')
+        write(rows, source, seed)
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, str(root / 'cleaning.py'), '--input', source, *args], cwd=directory,
+                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            process.stdin.write(b'y\ny\n')
+            process.stdin.close()
+            _, status, usage = os.wait4(process.pid, 0)
+            best = min(best, time.perf_counter() - start)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                raise RuntimeError(f'cleaning.py failed:\n{process.stderr.read().decode()}')
+            process.stderr.close()
+            peak = max(peak, usage.ru_maxrss / 1024) # kilobytes on Linux
+
+    return {'seconds': best, 'peak_mb': peak}
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def compare(results, baseline, threshold):
+    """
+    Cases slower or bigger than in the baseline by more than the threshold (relative), ignoring differences below
+    min_seconds and min_mb.
+
+    Returns:
+    --------
+    list of str
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        for metric, noise in (('seconds', min_seconds), ('peak_mb', min_mb)):
+            old, new = previous[metric], current[metric]
+            if new > old * (1 + threshold) and new - old > noise:
+                regressions.append(f'{key}: {metric} {old:.3f} -> {new:.3f} (+{(new / old - 1) * 100 if old else np.inf:.0f}%)')
+    return regressions
+
+def print_results(results, baseline):
+    print(f'{"case":<70} {"seconds":>10} {"peak MB":>10} {"vs baseline":>12}')
+    for key, result in results.items():
+        previous = baseline.get(key)
+        change = f'{(result["seconds"] / previous["seconds"] - 1) * 100:+.0f}%' if previous and previous['seconds'] else ''
+        print(f'{key:<70} {result["seconds"]:>10.4f} {result["peak_mb"]:>10.1f} {change:>12}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of the cleaning functions, steps and main().')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sections', nargs='+', choices=['functions', 'steps', 'main'], default=['functions', 'steps', 'main'])
+    parser.add_argument('--save', help='JSON file where the results are saved')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown or memory growth reported as a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+
+    results = {}
+    for rows in args.sizes:
+        print(f'{rows} rows...', file=sys.stderr)
+        raw = generate(rows, args.seed)
+
+        with contextlib.redirect_stdout(io.StringIO()): # messages of the functions
+            if 'functions' in args.sections:
+                for name, (setup, func) in function_cases(raw).items():
+                    results[f'{rows}/functions/{name}'] = measure(setup, func, args.repeat)
+
+            if 'steps' in args.sections:
+                for name, result in bench_steps(raw, args.repeat).items():
+                    results[f'{rows}/steps/{name}'] = result
+
+        if 'main' in args.sections:
+            results[f'{rows}/main/cleaning.py'] = bench_main(rows, args.seed, args.repeat)
+
+    print_results(results, baseline)
+
+    if args.save:
+        meta = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                'machine': platform.machine(), 'cpus': os.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'repeat': args.repeat, 'seed': args.seed}
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump({'meta': meta, 'results': results}, file, indent=1)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        print(f'\n{len(regressions)} regression(s) above {args.threshold:.0%}' + ''.join(f'\n  {line}' for line in regressions))
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
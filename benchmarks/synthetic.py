@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# Synthetic home visits tables with the schema and the errors of the raw extract:
+#
+# - list columns serialized as JSON lists (with \u escapes), Python lists, empty lists or comma separated text
+# - boolean columns mixing '0' / '1' / 'True' / 'False'
+# - dates with and without milliseconds, date only, DD/MM/YYYY and a few invalid values
+# - the dirty categorical values fixed by the replacement rules of pipeline.json
+# - duplicated id_paciente groups of 2 or more rows, both updates of the same patient (same birth date) and different
+#   patients sharing an ID, also across chunks
+# - missing and outlier vital signs
+#
+# The table is generated chunk by chunk with vectorized numpy code, so tables from 10k to 50M rows can be written with
+# bounded memory (python benchmarks/synthetic.py --rows 50000000 --output raw.csv).
+
+columns = ['id_paciente', 'sexo', 'obito', 'bairro', 'raca_cor', 'ocupacao', 'religiao', 'luz_eletrica', 'data_cadastro',
+           'escolaridade', 'nacionalidade', 'renda_familiar', 'data_nascimento', 'em_situacao_de_rua', 'frequenta_escola',
+           'meios_transporte', 'doencas_condicoes', 'identidade_genero', 'meios_comunicacao', 'orientacao_sexual',
+           'possui_plano_saude', 'em_caso_doenca_procura', 'situacao_profissional', 'vulnerabilidade_social',
+           'data_atualizacao_cadastro', 'familia_beneficiaria_auxilio_brasil', 'crianca_matriculada_creche_pre_escola', 'altura',
+           'peso', 'pressao_sistolica', 'pressao_diastolica', 'n_atendimentos_atencao_primaria', 'n_atendimentos_hospital',
+           'updated_at', 'tipo']
+
+boolean_values = ['0', '1', 'True', 'False']
+
+# Column -> (values, weights)
+categorical_values = {
+    'sexo': (['female', 'male'], [0.55, 0.45]),
+    'bairro': (['Tijuca', 'Bangu', 'Campo Grande', 'Copacabana', 'Maré', 'Realengo', 'Santa Cruz', 'Méier'], None),
+    'raca_cor': (['Parda', 'Branca', 'Preta', 'Amarela', 'Indígena', 'Não'], [0.4, 0.3, 0.2, 0.03, 0.02, 0.05]),
+    'ocupacao': (['Não se aplica', 'Estudante', 'Dona de casa', 'Pedreiro', 'Médico (Urologista)', 'Técnico (Eletricista)',
+                  'Auxiliar (Administrativo)'], None),
+    'religiao': (['Católica', 'Evangélica', 'Espírita', 'Sem religião', 'Não', 'Sim', 'Acomp. Cresc. e Desenv. da Criança',
+                  'ORQUIDEA', 'ESB ALMIRANTE', '10 EAP 01'], [0.35, 0.3, 0.05, 0.1, 0.05, 0.05, 0.025, 0.025, 0.025, 0.025]),
+    'escolaridade': (['Fundamental Incompleto', 'Médio Completo', 'Superior Completo', 'Não sabe ler/escrever',
+                      'Especialização/Residência'], [0.3, 0.35, 0.2, 0.1, 0.05]),
+    'nacionalidade': (['Brasileira', 'Estrangeira', 'Naturalizado'], [0.97, 0.02, 0.01]),
+    'renda_familiar': (['1/4 Salário Mínimo', '1/2 Salário Mínimo', '1 Salário Mínimo', '2 Salários Mínimos',
+                        '3 Salários Mínimos', '4 Salários Mínimos', 'Mais de 4 Salários Mínimos', 'Não informado', 'Manhã',
+                        'Internet'], [0.1, 0.15, 0.25, 0.15, 0.08, 0.05, 0.07, 0.1, 0.025, 0.025]),
+    'identidade_genero': (['Cisgênero', 'Transgênero', 'Homossexual (gay / lésbica)', 'Heterossexual', 'Bissexual', 'Não',
+                           'Sim', None], [0.6, 0.02, 0.03, 0.1, 0.02, 0.05, 0.03, 0.15]),
+    'orientacao_sexual': (['Heterossexual', 'Homossexual (gay / lésbica)', 'Bissexual', 'Não informado'], [0.8, 0.08, 0.04, 0.08]),
+    'situacao_profissional': (['Emprego Formal', 'Emprego Informal', 'Autônomo', 'Desempregado', 'Não trabalha', 'Não se aplica',
+                               'Pensionista / Aposentado', 'Médico Urologista', 'SMS CAPS DIRCINHA E LINDA BATISTA AP 33',
+                               'Autônomo com previdência social'], [0.25, 0.15, 0.1, 0.1, 0.1, 0.08, 0.15, 0.03, 0.01, 0.03]),
+    'tipo': (['rotineiro', 'historico'], [0.7, 0.3]),
+}
+
+# List column -> items; each row is serialized in one of the formats found in the extract
+list_items = {
+    'meios_transporte': ['Ônibus', 'Metrô', 'Trem', 'Carro', 'Bicicleta', 'Caminhada', 'BRT'],
+    'doencas_condicoes': ['Hipertensão', 'Diabetes', 'Tabagismo', 'AIDS', 'Gestante', 'Alcoolismo', 'Usuário de Drogas Ilícitas',
+                          'Asma'],
+    'meios_comunicacao': ['Internet', 'Rádio', 'Televisão', 'Jornal', 'Revista', 'Carta', 'Não informado'],
+    'em_caso_doenca_procura': ['Unidade de Saúde', 'Rede Privada', 'Farmácia', 'Hospital', 'Benzedeira', 'Plano de Saúde'],
+}
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def uuids(rng, n):
+    """
+    Random UUID version 4 strings, built with numpy (no Python loop per row).
+    """
+    data = rng.integers(0, 256, (n, 16), dtype=np.uint8)
+    data[:, 6] = (data[:, 6] & 0x0F) | 0x40
+    data[:, 8] = (data[:, 8] & 0x3F) | 0x80
+    digits = np.frombuffer(b'0123456789abcdef', dtype='S1')
+    text = np.empty((n, 32), dtype='S1')
+    text[:, 0::2], text[:, 1::2] = digits[data >> 4], digits[data & 0x0F]
+    dashed = np.full((n, 36), b'-', dtype='S1')
+    for start, end, offset in ((0, 8, 0), (8, 12, 1), (12, 16, 2), (16, 20, 3), (20, 32, 4)):
+        dashed[:, start + offset:end + offset] = text[:, start:end]
+    return dashed.view('S36').ravel().astype(str).astype(object)
+
+def timestamps(rng, n, start, end, layouts):
+    """
+    Random timestamps written in a mix of layouts.
+
+    Parameters:
+    -----------
+    rng : numpy.random.Generator
+    n : int
+    start, end : str
+        Range of the dates
+    layouts : dict
+        Layout ('ms', 'seconds', 'date', 'dmy', 'invalid') -> probability
+    """
+    lower, upper = np.datetime64(start, 's').astype(np.int64), np.datetime64(end, 's').astype(np.int64)
+    seconds = rng.integers(lower, upper, n).astype('datetime64[s]')
+    iso = np.char.replace(np.datetime_as_string(seconds), 'T', ' ') # YYYY-MM-DD HH:MM:SS
+    layout = rng.choice(list(layouts), n, p=list(layouts.values()))
+    out = iso.astype(object)
+
+    ms = layout == 'ms'
+    if ms.any():
+        out[ms] = np.char.add(iso[ms], np.char.add('.', np.char.zfill(rng.integers(0, 1000, ms.sum()).astype(str), 3)))
+    date = iso.astype('U10')
+    out[layout == 'date'] = date[layout == 'date']
+    dmy = layout == 'dmy'
+    if dmy.any(): # YYYY-MM-DD -> DD/MM/YYYY
+        chars = date[dmy].view('U1').reshape(-1, 10)[:, [8, 9, 7, 5, 6, 4, 0, 1, 2, 3]]
+        chars[:, [2, 5]] = '/'
+        out[dmy] = np.ascontiguousarray(chars).view('U10').ravel()
+    invalid = layout == 'invalid'
+    out[invalid] = rng.choice(['0000-00-00', '31/02/2023', 'Não informado'], invalid.sum())
+    return out
+
+def list_strings(rng, n, items, variants=8):
+    """
+    Random list values serialized in the formats found in the extract. There are few distinct values, so a pool of
+    serialized lists is built per (number of items, format) and the rows sample from it.
+    """
+    formats = ['json', 'python', 'text']
+    pool = np.empty((len(items) + 1, len(formats), variants), dtype=object)
+    for size in range(len(items) + 1):
+        for variant in range(variants):
+            values = [items[i] for i in rng.choice(len(items), size, replace=False)]
+            pool[size, 0, variant] = json.dumps(values) # ["Hipertens\u00e3o"]
+            pool[size, 1, variant] = str(values) # ['Hipertensão']
+            pool[size, 2, variant] = ', '.join(values) if values else '[]' # Diabetes, Hipertensão
+
+    size = np.minimum(rng.geometric(0.55, n) - 1, len(items)) # often 0 or 1 item
+    return pool[size, rng.choice(len(formats), n, p=[0.6, 0.1, 0.3]), rng.integers(0, variants, n)]
+
+def pick(rng, n, values, weights=None):
+    values = np.array(values, dtype=object)
+    p = None if weights is None else np.asarray(weights) / np.sum(weights)
+    return values[rng.choice(len(values), n, p=p)]
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+class Generator:
+    """
+    Generates a synthetic extract chunk by chunk.
+
+    Parameters:
+    -----------
+    seed : int
+    duplicate_rate : float
+        Fraction of rows whose ID repeats the ID of another row
+    same_patient : float
+        Fraction of the duplicated rows that are updates of the same patient (same birth date)
+    outlier_rate : float
+        Fraction of vital signs that are outliers
+    """
+
+    def __init__(self, seed=0, duplicate_rate=0.02, same_patient=0.5, outlier_rate=0.01):
+        self.rng = np.random.default_rng(seed)
+        self.duplicate_rate = duplicate_rate
+        self.same_patient = same_patient
+        self.outlier_rate = outlier_rate
+        self.previous = None # (ids, birth dates) of the end of the previous chunk, for duplicates across chunks
+
+    def vitals(self, n, mean, std, outliers, decimals):
+        rng = self.rng
+        values = rng.normal(mean, std, n)
+        wrong = rng.random(n) < self.outlier_rate
+        values[wrong] = rng.choice(outliers, wrong.sum())
+        values[rng.random(n) < 0.02] = np.nan
+        return values.round(decimals)
+
+    def chunk(self, n):
+        """
+        Generates the next n rows.
+
+        Returns:
+        --------
+        pandas.DataFrame
+        """
+        rng = self.rng
+        df = {'id_paciente': uuids(rng, n)}
+
+        for col in columns:
+            if col in categorical_values:
+                df[col] = pick(rng, n, *categorical_values[col])
+            elif col in list_items:
+                df[col] = list_strings(rng, n, list_items[col])
+
+        for col in ['obito', 'luz_eletrica', 'em_situacao_de_rua', 'possui_plano_saude', 'vulnerabilidade_social',
+                    'familia_beneficiaria_auxilio_brasil', 'crianca_matriculada_creche_pre_escola']:
+            df[col] = pick(rng, n, boolean_values, [0.4, 0.4, 0.1, 0.1])
+        df['frequenta_escola'] = rng.integers(0, 2, n)
+
+        mixed = {'ms': 0.45, 'seconds': 0.45, 'date': 0.05, 'dmy': 0.04, 'invalid': 0.01}
+        df['data_cadastro'] = timestamps(rng, n, '2012-01-01', '2025-01-01', mixed)
+        df['data_nascimento'] = timestamps(rng, n, '1920-01-01', '2024-12-31', {'date': 0.97, 'dmy': 0.02, 'invalid': 0.01})
+        df['data_atualizacao_cadastro'] = timestamps(rng, n, '2015-01-01', '2025-01-01', mixed)
+        df['updated_at'] = timestamps(rng, n, '2015-01-01', '2025-01-01', {'ms': 0.5, 'seconds': 0.5})
+
+        df['altura'] = self.vitals(n, 160, 20, [0, 5, 300, 999], 0)
+        df['peso'] = self.vitals(n, 68, 18, [0, 500, 999.9], 1)
+        df['pressao_sistolica'] = self.vitals(n, 125, 18, [0, 20, 400], 0)
+        df['pressao_diastolica'] = self.vitals(n, 80, 12, [0, 5, 300], 0)
+        df['n_atendimentos_atencao_primaria'] = rng.poisson(4, n)
+        df['n_atendimentos_hospital'] = rng.poisson(1, n)
+
+        df = pd.DataFrame(df)[columns]
+        self._duplicate(df)
+        return df
+
+    def _duplicate(self, df):
+        """
+        Gives some rows the ID of another row, in groups of 2 or more (also with rows of the previous chunk).
+        """
+        rng, n = self.rng, len(df)
+        n_copies = int(n * self.duplicate_rate)
+        if n_copies and n > 1:
+            sources = np.repeat(rng.integers(0, n, max(n_copies // 2, 1)), 2)[:n_copies] # groups of 3 and more too
+            targets = rng.choice(n, n_copies, replace=False)
+            keep = sources != targets
+            sources, targets = sources[keep], targets[keep]
+
+            ids, births = df['id_paciente'].to_numpy(), df['data_nascimento'].to_numpy()
+            if self.previous is not None:
+                across = rng.random(len(sources)) < 0.2
+                previous = rng.integers(0, len(self.previous[0]), across.sum())
+                source_ids = np.where(across, 0, ids[sources]).astype(object)
+                source_births = np.where(across, 0, births[sources]).astype(object)
+                source_ids[across], source_births[across] = self.previous[0][previous], self.previous[1][previous]
+            else:
+                source_ids, source_births = ids[sources], births[sources]
+
+            ids[targets] = source_ids
+            same = rng.random(len(targets)) < self.same_patient
+            births[targets[same]] = source_births[same]
+            df['id_paciente'], df['data_nascimento'] = ids, births
+
+        tail = slice(max(n - 1000, 0), n)
+        self.previous = (df['id_paciente'].to_numpy()[tail].copy(), df['data_nascimento'].to_numpy()[tail].copy())
+
+def generate(rows, seed=0, chunksize=1_000_000, **kwargs):
+    """
+    Generates a synthetic extract in memory.
+
+    Parameters:
+    -----------
+    rows : int
+    seed : int
+    chunksize : int
+        Rows generated at a time
+
+    Returns:
+    --------
+    pandas.DataFrame
+    """
+    generator = Generator(seed, **kwargs)
+    chunks = [generator.chunk(min(chunksize, rows - start)) for start in range(0, rows, chunksize)]
+    return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+
+def write(rows, output, seed=0, chunksize=1_000_000, **kwargs):
+    """
+    Writes a synthetic extract to a CSV file (or Parquet, by extension) chunk by chunk.
+    """
+    generator = Generator(seed, **kwargs)
+    writer = None
+    for start in range(0, rows, chunksize):
+        chunk = generator.chunk(min(chunksize, rows - start))
+        if output.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            writer = writer or pq.ParquetWriter(output, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        else:
+            chunk.to_csv(output, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    if writer is not None:
+        writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic home visits extract.')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=1_000_000)
+    parser.add_argument('--output', default='synthetic.csv', help='CSV or Parquet file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    write(args.rows, args.output, args.seed, args.chunksize)
+    print(f'{args.rows} rows written to {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB) in '
+          f'{time.perf_counter() - start:.1f} s')
+
+if __name__ == '__main__':
+    main()
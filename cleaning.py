@@ -1,156 +1,379 @@
-from importlib import reload 
+import argparse
+import contextlib
+import json
+from importlib import reload
 import lib.functions as functions
-reload(functions) 
+reload(functions)
 from lib.functions import *
+import os
+from lib.pipeline import Pipeline
+from lib.cache import RawCache, RawExtractUnavailable, is_url
+from lib.profiling import Profiler, StackSampler
+from lib.loader import load_raw, print_report as print_validation_report
+from lib.streaming import write_csv
+from lib.validation import validate
 
-def main():
+url = "https://drive.google.com/file/d/1dWC1ZUPNlCQBalYPY8uP4Zzs0aue9nkQ/view?usp=sharing"
+path = 'https://drive.google.com/uc?export=download&id='+url.split('/')[-2]
+
+# Downloads go through a local cache (see lib/cache.py)
+use_cache = True
+cache_dir = None # HOME_VISITS_CACHE or ~/.cache/home_visits
+refresh = False # whether to check with the source that the cached copy is up to date
+typed = True # whether the raw CSV is read with the schema of lib/loader.py (pd.read_csv type inference otherwise)
+
+# Instrumentation of the steps (see lib/profiling.py), off when profile_report is None
+profile_report = None # JSON or CSV file with the time, memory and rows changed of each step
+profile_memory = False # whether to trace the allocations for the peak memory of each step (slower)
+profile_stacks = None # file where the sampled stacks of each step are written (collapsed stacks format)
+
+#=============================================================================================================================================
+
+# Cleaning rules (see pipeline.json)
+
+pipeline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.json')
+
+def load_pipeline(compact=False, limits_file=None):
     """
-    Main function that performs data cleaning and transformation.
+    Cleaning pipeline of pipeline.json, optionally with the compact types and with the outlier limits kept in a file
+    (see StratifiedOutlierFlags in lib/pipeline.py).
     """
-    url = "https://drive.google.com/file/d/1dWC1ZUPNlCQBalYPY8uP4Zzs0aue9nkQ/view?usp=sharing"
-    path = 'https://drive.google.com/uc?export=download&id='+url.split('/')[-2]
+    with open(pipeline_path, encoding='utf-8') as file:
+        spec = json.load(file)
+    if limits_file is not None:
+        for entry in spec['steps']:
+            if entry['step'] == 'stratified_outlier_flags':
+                entry['limits_file'] = limits_file
+    return Pipeline(spec, compact)
 
-    try:
-        data = pd.read_csv(path)
-        print('Table loaded with success.')
+pipeline = load_pipeline()
 
-    except:
-        print('Error when loading the table. Please contact the author.')
+#=============================================================================================================================================
 
-    # Checking for null values
-    check_null_values(data)
+def ask_outputs(output_format='csv'):
+    """
+    Asks the user which cleaned tables should be saved.
 
-    print('Cleaning quantitative columns...')
+    Parameters:
+    -----------
+    output_format : str
+        'csv', 'parquet' or 'sqlite'
 
-    lims_altura = calculate_IQR_lims(data, 'altura')
-    lims_altura[0] = 40 # considering newborn babies
-    lims_peso = calculate_IQR_lims(data, 'peso')
-    lims_pressao_diastolica = calculate_IQR_lims(data, 'pressao_diastolica')
-    lims_pressao_sistolica = calculate_IQR_lims(data, 'pressao_sistolica')
+    Returns:
+    --------
+    outputs : dict
+        Output file -> whether rows with null values are dropped
+    """
+    outputs = {}
 
-    data = identify_outliers(data, 'altura', lims_altura[0], lims_altura[1])
-    data = identify_outliers(data, 'peso', lims_peso[0], lims_peso[1])
-    data = identify_outliers(data, 'pressao_diastolica', lims_pressao_diastolica[0], lims_pressao_diastolica[1])
-    data = identify_outliers(data, 'pressao_sistolica', lims_pressao_sistolica[0], lims_pressao_sistolica[1])
+    retrieve_data = input("Do you wish to retrieve the cleaned dataset? (y/n)")
 
-    print('Cleaning columns with True / False errors...')
+    if retrieve_data == 'y':
 
-    boolean_to_int_cols = [
-    'obito',
-    'luz_eletrica',
-    'em_situacao_de_rua',
-    'possui_plano_saude',
-    'vulnerabilidade_social',
-    'familia_beneficiaria_auxilio_brasil',
-    'crianca_matriculada_creche_pre_escola'
-    ]
+        null_values = input("Do you want to include rows with null values? (y/n)")
 
-    # Applying boolean_to_int function to each column
-    for column in boolean_to_int_cols:
-        data = boolean_to_int(data, column)
+        if null_values == 'y':
+            outputs[f'final_dataset.{output_format}'] = False
+        else:
+            outputs[f'final_dataset_dropna.{output_format}'] = True
 
-    print('Cleaning columns with string errors...')
+    return outputs
 
-    standardize_string_cols = ['meios_transporte', 'doencas_condicoes', 'meios_comunicacao', 'em_caso_doenca_procura']
+def source_path(path):
+    """
+    Local path of the raw extract: downloaded files go through the cache.
+    """
+    if is_url(path) and use_cache:
+        return RawCache(cache_dir).fetch(path, refresh)
+    return path
 
-    # Applying clean_column and split_string functions to each column
-    for column in standardize_string_cols:
-        data = clean_column(data, column)
-        data = split_string(data, column)
+def read_raw(path):
+    """
+    Reads a local raw CSV file with the schema of the extract, printing the values that do not match it.
+    """
+    data, report = load_raw(path)
+    print_validation_report(report)
+    return data
 
-    means_of_communication = ['Internet', 'Rádio', 'Televisão', 'Jornal', 'Não informado', 'Revista', 'Outros']
+def read_table(path):
+    """
+    Reads the raw extract, from the CSV file, from a Parquet copy of it (see lib/storage.py) or from the cache.
+    """
+    if is_url(path) and use_cache:
+        return RawCache(cache_dir).load(path, refresh, reader=read_raw if typed else None)
+    if path.lower().endswith(('.parquet', '.pq')):
+        return pd.read_parquet(path)
+    if typed and not is_url(path):
+        return read_raw(path)
+    return pd.read_csv(path)
+
+def write_table(df, output, compression='zstd', row_group_size=None, keep=None, types=None):
+    """
+    Writes a cleaned table, as Parquet (keeping the column types, the declared ones when types is given, see
+    Pipeline.column_types), into a SQLite database (upserted, see lib/database.py) or as CSV depending on the extension
+    of the file. Only the rows of the mask keep are written when it is given (see streaming.write_csv).
+    """
+    if output.endswith(('.sqlite', '.sqlite3', '.db')):
+        from lib.database import write_database
+        write_database(df, output, keep)
+    elif output.endswith('.parquet'):
+        from lib.storage import write_table as write_parquet # requires pyarrow
+        write_parquet(df, output, compression, row_group_size, keep, types)
+    else:
+        write_csv(df, output, keep, sep =';', decimal=',') # you can change decimal delimiter to '.' if you want
 
-    data['meios_comunicacao'] = data['meios_comunicacao'].apply(
-        lambda x: ['Outros' if item not in means_of_communication else item for item in x]
-    ) # Cleaning incorrect entries
+def print_report():
+    """
+    Prints the number of rows changed by each replacement rule of the pipeline.
+    """
+    print('Rows changed by each replacement rule:')
+    for _, row in pipeline.report_table().iterrows():
+        print(f"    {row['item']}: {row['count']}")
 
-    data = internet_flag(data) # Filtering which patients have access to the Internet
-    data = public_transport_flag(data) # Filtering which patients use public transportation (subway, metro or bus)
-    data = diseases_flag(data) # Filtering which patients have common diseases
-    data = private_health_care_flag(data) # Filtering whether the patient has access to private health care facilities
+def make_profiler():
+    """
+    Profiler of the steps as configured above (None when profiling is off).
+    """
+    if profile_report is None and profile_stacks is None:
+        return None
+    return Profiler(memory=profile_memory, sampler=StackSampler() if profile_stacks is not None else None)
 
-    print('Cleaning date columns...')
+def save_profile(profiler):
+    """
+    Writes the profiling report and the sampled stacks, and prints the slowest steps.
+    """
+    if profiler is None:
+        return
+    print(profiler.summary())
+    if profile_report is not None:
+        profiler.write(profile_report)
+        print(f'Profiling report written to {profile_report}.')
+    if profile_stacks is not None:
+        profiler.sampler.write(profile_stacks)
+        print(f'Sampled stacks written to {profile_stacks}.')
+
+def main_chunked(chunksize, output_format='csv', compression='zstd', row_group_size=None):
+    """
+    Performs the same cleaning as main() reading the table in chunks, so that memory usage is proportional to the chunk
+    size instead of the table size. The outputs are written chunk by chunk.
+
+    Parameters:
+    -----------
+    chunksize : int
+        Number of rows per chunk
+    output_format, compression, row_group_size :
+        Output options (see main)
+    """
+    outputs = ask_outputs(output_format)
 
-    date_columns = ['data_cadastro', 'data_nascimento', 'data_atualizacao_cadastro', 'updated_at']
+    try:
+        source = source_path(path)
+    except RawExtractUnavailable as error:
+        print(f'Error when loading the table: {error}')
+        return
 
-    # Applying the standardize_date function to each column and adding flags for incorrect entries
-    for column in date_columns:
-        data = standardize_date(data, column)
-        data = date_flag(data, column)
+    print('Calculating outlier limits and looking for duplicates in id_paciente column...')
 
-    print('Cleaning columns with specific errors...')
+    profiler = make_profiler()
+    with profiler or contextlib.nullcontext():
+        N_rows, N_null = pipeline.run_chunked(source, outputs, chunksize, verbose=True, profiler=profiler,
+                                              compression=compression, row_group_size=row_group_size)
 
-    check_id_format(data, 'id_paciente')
-    duplicates, over_2_repeated_values = check_id_duplicates(data, 'id_paciente')
-    print('Fixing duplicates in id_paciente column...')
-    fix_duplicates(data, 'id_paciente', duplicates)
-    fix_duplicates(data, 'id_paciente', over_2_repeated_values)
+    print_report()
+    save_profile(profiler)
 
-    # Check for duplicates in id_paciente column
-    check_id_duplicates(data, 'id_paciente')
+    if N_null != 0:
+        print(f'There are {N_null} null values in the dataframe.')
+    else:
+        print('No null values in the dataframe.')
 
-    print('Cleaning columns with incorrect and/or random entries...')
+    print('-'*40, f'Finish cleaning table! ({N_rows} rows)', '-'*40)
 
-    random_entries = ['Acomp. Cresc. e Desenv. da Criança', 'ORQUIDEA', 'ESB ALMIRANTE', '10 EAP 01']
+def main_engine(engine, chunksize=None, output_format='csv', compression='zstd', row_group_size=None):
+    """
+    Performs the same cleaning as main() as a query of an embedded engine (Polars or DuckDB, see lib/engines.py), which
+    reads the table from disk and uses all the cores. The outputs are written chunk by chunk.
+
+    Parameters:
+    -----------
+    engine : str
+        'polars' or 'duckdb'
+    chunksize : int, optional
+        Number of rows per chunk when writing the outputs
+    output_format, compression, row_group_size :
+        Output options (see main)
+    """
+    from lib.engines import run_engine
 
-    replace_string_columns = {'identidade_genero': [(['Homossexual (gay / lésbica)', 'Heterossexual', 'Bissexual', np.nan, 'Não', 'Sim'], 'Não informado')],
-                              'raca_cor': [('Não', 'Não deseja informar')],
-                              'orientacao_sexual': [('Homossexual (gay / lésbica)', 'Homossexual')],
-                              'religiao': [(random_entries, 'Sem informação'),
-                                           ('Não', 'Sem religião'), ('Sim', 'Outra')],
-                              'escolaridade': [('Não sabe ler/escrever', 'Iletrado'), 
-                                               ('Especialização/Residência', 'Especialização ou Residência')],
-                              'situacao_profissional': [('SMS CAPS DIRCINHA E LINDA BATISTA AP 33', 'Não informado'),
-                                                        ('Pensionista / Aposentado', 'Pensionista ou Aposentado'),
-                                                        (['Não se aplica', 'Não trabalha'], 'Desempregado'),
-                                                        ('Médico Urologista', 'Emprego Formal')],
-                              'renda_familiar': [(['Manhã', 'Internet'], 'Não informado')]}
+    outputs = ask_outputs(output_format)
 
-    for col in list(replace_string_columns.keys()):
+    try:
+        source = source_path(path)
+    except RawExtractUnavailable as error:
+        print(f'Error when loading the table: {error}')
+        return
 
-        for item in replace_string_columns[col]:
+    N_rows, N_null = run_engine(pipeline, source, outputs, engine, chunksize or 100_000, compression, row_group_size,
+                                verbose=True)
 
-            data = replace_strings(data, col, item[0], item[1])
+    print_report()
 
-    # List of functions to be applied
-    functions = [(create_category_col, 'ocupacao', 'categoria_ocupacao'), 
-                transform_family_income,
-                family_income_flag,
-                create_social_security_col]
+    if N_null != 0:
+        print(f'There are {N_null} null values in the dataframe.')
+    else:
+        print('No null values in the dataframe.')
 
-    # Iterating over the functions and applying them to the dataframe
-    for func in functions:
-        if isinstance(func, tuple):
-            # Function that needs additional parameters
-            data = func[0](data, *func[1:])
-        else:
-            # Function with no additional parameters
-            data = func(data)
+    print('-'*40, f'Finish cleaning table! ({N_rows} rows)', '-'*40)
 
-    # Checking for null values again
-    check_null_values(data)
+def main_incremental(state, chunksize=None, output_format='csv', compression='zstd', row_group_size=None):
+    """
+    Cleans only the rows updated since the last run and upserts them into a local state store (see lib/incremental.py).
+    The cleaned table is then exported from the store.
+
+    Parameters:
+    -----------
+    state : str
+        SQLite database of the state store (created on the first run)
+    chunksize : int, optional
+        Number of rows per chunk when scanning the extract
+    output_format, compression, row_group_size :
+        Output options (see main)
+    """
+    from lib.incremental import run_incremental, StateStore
 
-    data[['renda_familiar', 'altura', 'peso', 'pressao_sistolica', 'pressao_diastolica']] = data[['renda_familiar', 'altura', 'peso', \
-         'pressao_sistolica', 'pressao_diastolica']].apply(pd.to_numeric)
+    outputs = ask_outputs(output_format)
 
-    data_no_null_values = data.dropna() # Table with no null values
+    try:
+        source = source_path(path)
+    except RawExtractUnavailable as error:
+        print(f'Error when loading the table: {error}')
+        return
+
+    profiler = make_profiler()
+    with profiler or contextlib.nullcontext():
+        N_delta, N_upserted, N_undated = run_incremental(pipeline, source, state, chunksize or 100_000, verbose=True,
+                                                         profiler=profiler)
+    save_profile(profiler)
+    print(f'{N_delta} rows updated since the last run, {N_upserted} patients inserted or updated.')
+    if N_undated:
+        print(f'{N_undated} rows without a valid update date, cleaned again on every run.')
+
+    if outputs:
+        store = StateStore(state)
+        data = store.load()
+        store.close()
+        print(validate(data))
+        keep = ~null_rows(data)
+        for output, dropna in outputs.items():
+            write_table(data, output, compression, row_group_size, keep if dropna else None, pipeline.column_types())
 
     print('-'*40, 'Finish cleaning table!', '-'*40)
 
-    retrieve_data = input("Do you wish to retrieve the cleaned dataset? (y/n)")
+def main(chunksize=None, workers=None, parallel='rows', output_format='csv', compression='zstd', row_group_size=None,
+         engine='pandas'):
+    """
+    Main function that performs data cleaning and transformation.
 
-    if retrieve_data == 'y':
+    Parameters:
+    -----------
+    chunksize : int, optional
+        When given, the table is processed in chunks of this size (see main_chunked)
+    workers : int, optional
+        When given, the table is processed by this many worker processes (see Pipeline.run_parallel)
+    parallel : str
+        Whether the workers process row shards ('rows') or independent groups of columns ('columns')
+    output_format : str
+        'csv', 'parquet' or 'sqlite' (list columns, datetimes and categories keep their types)
+    compression : str
+        Parquet compression codec ('zstd', 'snappy', 'gzip', 'brotli', 'lz4' or 'none')
+    row_group_size : int, optional
+        Maximum number of rows per Parquet row group
+    engine : str
+        'pandas', or an embedded engine that runs the same cleaning out of core ('polars' or 'duckdb', see main_engine)
+    """
+    if engine != 'pandas':
+        return main_engine(engine, chunksize, output_format, compression, row_group_size)
+    if chunksize is not None:
+        return main_chunked(chunksize, output_format, compression, row_group_size)
 
-        null_values = input("Do you want to include rows with null values? (y/n)") 
+    try:
+        data = read_table(path)
+        print('Table loaded with success.')
 
-        if null_values == 'y':
+    except RawExtractUnavailable as error:
+        print(f'Error when loading the table: {error}')
+        return
 
-            data.to_csv('final_dataset.csv', index=False, sep =';', decimal=',') # you can change decimal delimiter to '.' if you want
+    # Data quality of the raw table: null values, ID format, allowed values, date ranges and duplicated IDs
+    print(validate(data))
 
+    profiler = make_profiler()
+    with profiler or contextlib.nullcontext():
+        if workers is not None:
+            data = pipeline.run_parallel(data, workers, by=parallel, verbose=True, profiler=profiler)
         else:
-            data_no_null_values.to_csv('final_dataset_dropna.csv', index=False, sep =';', decimal=',')
-    else:
-        pass
+            data = pipeline.run(data, verbose=True, profiler=profiler)
+
+    print_report()
+    save_profile(profiler)
+
+    # Data quality of the cleaned table
+    print(validate(data))
+
+    keep = ~null_rows(data) # Rows with no null values, selected when writing instead of copying the table
+
+    print('-'*40, 'Finish cleaning table!', '-'*40)
+
+    outputs = ask_outputs(output_format)
+
+    for output, dropna in outputs.items():
+        write_table(data, output, compression, row_group_size, keep if dropna else None, pipeline.column_types())
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Cleans the home visits table.')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='process the table in chunks of this many rows to limit memory usage')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='process the table in parallel with this many worker processes')
+    parser.add_argument('--parallel', choices=['rows', 'columns'], default='rows',
+                        help='split the work between the workers by row shards or by independent groups of columns')
+    parser.add_argument('--engine', choices=['pandas', 'polars', 'duckdb'], default='pandas',
+                        help='run the cleaning as a Polars or DuckDB query (out of core, all cores, see lib/engines.py)')
+    parser.add_argument('--input', default=None,
+                        help='read the raw extract from this CSV file or Parquet copy (see lib/storage.py) instead of downloading it')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'sqlite'], default='csv', help='format of the cleaned table')
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--row-group-size', type=int, default=None, help='maximum number of rows per Parquet row group')
+    parser.add_argument('--incremental', metavar='STATE_DB', default=None,
+                        help='clean only the rows updated since the last run, keeping the cleaned table in this SQLite file')
+    parser.add_argument('--refresh', action='store_true',
+                        help='check with the source that the cached copy of the extract is up to date')
+    parser.add_argument('--no-cache', action='store_true', help='download the extract without the local cache')
+    parser.add_argument('--cache-dir', default=None, help='directory of the local cache')
+    parser.add_argument('--clear-cache', action='store_true', help='remove every cached file before running')
+    parser.add_argument('--no-schema', action='store_true',
+                        help='read the raw CSV with type inference instead of the schema of lib/loader.py')
+    parser.add_argument('--compact', action='store_true',
+                        help='store the vitals as float32 and the counts as small integers (less memory, see bench_memory.py)')
+    parser.add_argument('--outlier-limits', metavar='FILE', default=None,
+                        help='keep the outlier limits of each age band and sex in this JSON file and reuse them in later runs')
+    parser.add_argument('--profile', metavar='REPORT', default=None,
+                        help='write the time, memory and rows changed of each step to this JSON or CSV file')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='trace the allocations for the peak memory of each step (slower)')
+    parser.add_argument('--profile-stacks', metavar='FILE', default=None,
+                        help='sample the stacks of each step and write them to this file (collapsed stacks, for flame graphs)')
+    args = parser.parse_args()
+    if args.input is not None:
+        path = args.input
+    use_cache, cache_dir, refresh = not args.no_cache, args.cache_dir, args.refresh
+    typed = not args.no_schema
+    profile_report, profile_memory, profile_stacks = args.profile, args.profile_memory, args.profile_stacks
+    if args.compact or args.outlier_limits is not None:
+        pipeline = load_pipeline(args.compact, args.outlier_limits)
+    if args.clear_cache:
+        RawCache(cache_dir).clear()
+    if args.incremental is not None:
+        main_incremental(args.incremental, args.chunksize, args.format, args.compression, args.row_group_size)
+    else:
+        main(args.chunksize, args.workers, args.parallel, args.format, args.compression, args.row_group_size, args.engine)
@@ -0,0 +1,372 @@
+import glob
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+
+import lib.streaming as streaming
+from lib.cache import RawCache, is_url
+from lib.functions import null_rows
+from lib.loader import load_raw
+from lib.pipeline import _worker_pipeline
+from lib.validation import QualityReport, validate
+
+#=============================================================================================================================================
+
+# Batch cleaning of many extracts (e.g. one per region and month), without prompts
+#
+# Each input file is cleaned on its own, as a task of a process pool:
+#
+# - isolation: a file that fails does not stop the others, and its outputs are written to temporary files renamed only
+#   when the file succeeds, so there are never partial outputs. SQLite outputs are the exception: they are upserted in
+#   place (see database.SQLiteSink), so that the patients of earlier runs are kept; each write is a transaction, and a
+#   retried file upserts the same rows again.
+# - retries: a failed file is tried again up to `retries` times (after `retry_delay` seconds), also when its worker
+#   process dies (in that case the files running in the other workers of the pool are tried again too)
+# - manifest: a JSON file lists every input with its status, attempts, time, row counts, outputs and error
+# - downloads: URL inputs are fetched through the cache by the parent process before being submitted, one at a time, and
+#   the workers read the local copies (a failed download counts as a failed attempt of its input)
+#
+# The outputs of a file are named after it, in the output directory: <name>.<format> for the full table and
+# <name>_dropna.<format> for the table without rows with null values, depending on the dropna policy.
+
+dropna_policies = {'keep': [False], 'drop': [True], 'both': [False, True]}
+
+def _is_parquet(path):
+    return str(path).lower().endswith(('.parquet', '.pq'))
+
+def _is_database(path):
+    return str(path).lower().endswith(('.sqlite', '.sqlite3', '.db'))
+
+def expand_inputs(patterns):
+    """
+    Expands paths and glob patterns (** included) into a sorted list of files, without repetitions. URLs are kept as
+    they are.
+
+    Parameters:
+    -----------
+    patterns : list of str
+
+    Returns:
+    --------
+    list of str
+
+    Raises:
+    -------
+    FileNotFoundError
+        When a pattern matches no file
+    """
+    paths = []
+    for pattern in patterns:
+        if is_url(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+        if not matches:
+            raise FileNotFoundError(f'No file matches {pattern!r}.')
+        paths.extend(match for match in matches if match not in paths)
+    return paths
+
+def output_names(paths):
+    """
+    Names of the outputs of each input: the file name without extension, preceded by its directories (relative to the
+    common directory of the inputs) when two inputs have the same file name, e.g. 'norte__2024-01'.
+
+    Returns:
+    --------
+    dict
+        Input -> name
+    """
+    def stem(path):
+        name = path.rstrip('/').split('/')[-1] if is_url(path) else os.path.basename(path)
+        return name.split('?')[0].rsplit('.', 1)[0] or 'extract'
+
+    stems = [stem(path) for path in paths]
+    local = [path for path in paths if not is_url(path)]
+    common = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in local]) if local else ''
+
+    names = {}
+    for path, name in zip(paths, stems):
+        if stems.count(name) > 1 and not is_url(path):
+            relative = os.path.relpath(os.path.abspath(path), common)
+            name = relative.rsplit('.', 1)[0].replace(os.sep, '__')
+        names[path] = name
+
+    # Remaining collisions (e.g. URLs with the same file name): numbered
+    seen = {}
+    for path, name in names.items():
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            names[path] = f'{name}_{seen[name]}'
+    return names
+
+def plan_outputs(paths, output_dir, output_format='csv', dropna='both'):
+    """
+    Output files of each input.
+
+    Parameters:
+    -----------
+    paths : list of str
+        Inputs (see expand_inputs)
+    output_dir : str
+    output_format : str
+        'csv', 'parquet' or 'sqlite'
+    dropna : str
+        'keep' (full table), 'drop' (without rows with null values) or 'both'
+
+    Returns:
+    --------
+    dict
+        Input -> {output file: whether rows with null values are dropped}
+    """
+    if dropna not in dropna_policies:
+        raise ValueError(f'dropna must be one of {list(dropna_policies)}, not {dropna!r}')
+    names = output_names(paths)
+    return {path: {os.path.join(output_dir, f'{names[path]}{"_dropna" if drop else ""}.{output_format}'): drop
+                   for drop in dropna_policies[dropna]}
+            for path in paths}
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def _partial(output):
+    """
+    Temporary name of an output while it is written (same extension, so the format is kept). Databases are written in
+    place.
+    """
+    if _is_database(output):
+        return output
+    root, extension = os.path.splitext(output)
+    return f'{root}.partial{extension}'
+
+def _write(df, path, compression, row_group_size, keep=None, types=None):
+    if _is_database(path):
+        from lib.database import write_database
+        write_database(df, path, keep)
+    elif _is_parquet(path):
+        from lib.storage import write_table # requires pyarrow
+        write_table(df, path, compression, row_group_size, keep, types)
+    else:
+        streaming.write_csv(df, path, keep, sep=';', decimal=',')
+
+def clean_file(spec, path, outputs, chunksize=None, compression='zstd', row_group_size=None, cache_dir=None,
+               use_cache=True):
+    """
+    Cleans one extract and writes its outputs, in a worker process.
+
+    Parameters:
+    -----------
+    spec : dict
+        Pipeline specification (see Pipeline.from_spec)
+    path : str
+        Path or URL of the CSV or Parquet file
+    outputs : dict
+        Output file -> whether rows with null values are dropped
+    chunksize : int, optional
+        When given, the file is processed in chunks of this size
+    compression, row_group_size :
+        Parquet options
+    cache_dir : str, optional
+        Directory of the download cache
+    use_cache : bool
+        Whether downloads go through the cache
+
+    Returns:
+    --------
+    dict
+        rows_in, rows_out, null_rows, outputs (file -> rows written), report (rows changed by each replacement rule),
+        validation (values of a CSV file that do not match the schema, see loader.load_raw) and quality (data quality
+        report of the raw and of the cleaned table, see validation.validate)
+    """
+    pipeline = _worker_pipeline(spec)
+    pipeline.reset_reports()
+
+    source = RawCache(cache_dir).fetch(path) if is_url(path) and use_cache else path
+    partial = {_partial(output): dropna for output, dropna in outputs.items()}
+    validation = []
+    raw_quality, cleaned_quality = QualityReport(), QualityReport()
+
+    def validate_cleaned(df):
+        validate(df, report=cleaned_quality)
+        return df
+
+    try:
+        if chunksize is not None:
+            states = pipeline.fit_stream(source, chunksize)
+            sizes = []
+
+            def transform(chunk):
+                sizes.append(len(chunk))
+                validate(chunk, report=raw_quality)
+                return validate_cleaned(pipeline.run(chunk, states=states))
+
+            rows_out, N_null = streaming.run_chunked(source, transform, partial, chunksize, compression, row_group_size,
+                                                     pipeline.column_types())
+            rows_in = sum(sizes)
+        else:
+            if _is_parquet(source):
+                df = pd.read_parquet(source)
+            else:
+                df, report = load_raw(source)
+                validation = report.to_dict('records')
+            rows_in = len(df)
+            validate(df, report=raw_quality)
+            df = validate_cleaned(pipeline.run(df))
+            null = null_rows(df)
+            rows_out, N_null = len(df), int(null.sum())
+            for output, dropna in partial.items():
+                _write(df, output, compression, row_group_size, ~null if dropna else None, pipeline.column_types())
+
+        for output in outputs:
+            if not _is_database(output):
+                os.replace(_partial(output), output)
+
+    finally:
+        for output in partial:
+            if not _is_database(output) and os.path.exists(output):
+                os.remove(output)
+
+    return {'rows_in': rows_in, 'rows_out': rows_out, 'null_rows': N_null,
+            'outputs': {output: rows_out - N_null if dropna else rows_out for output, dropna in outputs.items()},
+            'report': {key: count for report in pipeline.reports().values() for key, count in report.items()},
+            'validation': validation, 'quality': {'raw': raw_quality.to_dict(), 'cleaned': cleaned_quality.to_dict()}}
+
+def _fetch(path, options):
+    """
+    Local copy of a URL input, downloaded through the cache (other inputs, and URLs when the cache is off, are returned
+    as they are).
+    """
+    if is_url(path) and options.get('use_cache', True):
+        return RawCache(options.get('cache_dir')).fetch(path)
+    return path
+
+def _attempt(spec, path, outputs, options):
+    """
+    One attempt at cleaning a file: exceptions are returned instead of raised, so that they reach the parent process
+    with their traceback.
+    """
+    start = time.perf_counter()
+    try:
+        result = clean_file(spec, path, outputs, **options)
+        result['status'] = 'ok'
+    except Exception as error:
+        result = {'status': 'failed', 'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def run_batch(spec, paths, output_dir, output_format='csv', dropna='both', jobs=None, retries=1, retry_delay=1.0,
+              skip_existing=False, manifest=None, verbose=True, **options):
+    """
+    Cleans many extracts in a process pool (see the notes above).
+
+    Parameters:
+    -----------
+    spec : dict
+        Pipeline specification
+    paths : list of str
+        Inputs (see expand_inputs)
+    output_dir : str
+        Directory of the outputs (created if needed)
+    output_format : str
+        'csv', 'parquet' or 'sqlite'
+    dropna : str
+        'keep', 'drop' or 'both' (see plan_outputs)
+    jobs : int, optional
+        Number of worker processes (number of CPUs by default)
+    retries : int
+        Number of times a failed file is tried again
+    retry_delay : float
+        Seconds before a new attempt
+    skip_existing : bool
+        Whether to skip the inputs whose outputs all exist already
+    manifest : str, optional
+        JSON file of the manifest (manifest.json in the output directory by default)
+    verbose : bool
+        Whether to print a line per file
+    options :
+        Arguments of clean_file (chunksize, compression, row_group_size, cache_dir, use_cache)
+
+    Returns:
+    --------
+    dict
+        Manifest: settings, totals and one entry per input
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = manifest or os.path.join(output_dir, 'manifest.json')
+    planned = plan_outputs(paths, output_dir, output_format, dropna)
+    started = time.time()
+
+    entries = {path: {'input': path, 'status': 'pending', 'attempts': 0, 'outputs': list(planned[path])} for path in paths}
+    pending = []
+    for path in paths:
+        if skip_existing and all(os.path.exists(output) for output in planned[path]):
+            entries[path]['status'] = 'skipped'
+        else:
+            pending.append(path)
+
+    def finish(path, result):
+        entry = entries[path]
+        entry.update({key: value for key, value in result.items() if key != 'outputs'})
+        if result['status'] == 'ok':
+            entry['outputs'] = result['outputs']
+            entry.pop('error', None)
+            entry.pop('traceback', None)
+        if verbose:
+            detail = f"{result.get('rows_in')} -> {result.get('rows_out')} rows" if result['status'] == 'ok' else result['error']
+            print(f"[{entry['status']}] {path} (attempt {entry['attempts']}, {result['seconds']:.1f} s): {detail}")
+
+    while pending:
+        retry = []
+        try:
+            with ProcessPoolExecutor(jobs or os.cpu_count()) as executor:
+                futures = {}
+                for path in pending:
+                    entries[path]['attempts'] += 1
+                    start = time.perf_counter()
+                    try:
+                        source = _fetch(path, options)
+                    except Exception as error:
+                        finish(path, {'status': 'failed', 'error': f'{type(error).__name__}: {error}',
+                                      'traceback': traceback.format_exc(), 'seconds': time.perf_counter() - start})
+                        if entries[path]['attempts'] <= retries:
+                            retry.append(path)
+                        continue
+                    futures[executor.submit(_attempt, spec, source, planned[path], options)] = path
+
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        result = {'status': 'failed', 'error': 'BrokenProcessPool: the worker process died', 'seconds': 0.0}
+                    finish(path, result)
+                    if result['status'] != 'ok' and entries[path]['attempts'] <= retries:
+                        retry.append(path)
+
+        except BrokenProcessPool: # raised when leaving the pool, the files were already handled above
+            pass
+
+        pending = [path for path in paths if path in retry]
+        if pending:
+            time.sleep(retry_delay)
+
+    entries = [entries[path] for path in paths]
+    summary = {'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)), 'seconds': time.time() - started,
+               'settings': {'output_dir': output_dir, 'format': output_format, 'dropna': dropna, 'jobs': jobs or os.cpu_count(),
+                            'retries': retries, **{key: value for key, value in options.items() if key != 'cache_dir'}},
+               'totals': {status: sum(entry['status'] == status for entry in entries) for status in ('ok', 'failed', 'skipped')},
+               'rows_in': sum(entry.get('rows_in', 0) for entry in entries),
+               'rows_out': sum(entry.get('rows_out', 0) for entry in entries),
+               'files': entries}
+
+    tmp = manifest + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as file:
+        json.dump(summary, file, indent=1, default=str)
+    os.replace(tmp, manifest)
+    return summary
+
+#========================================================================================================================================
@@ -0,0 +1,314 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError: # Windows: the cache directory is then not safe to share between processes
+    fcntl = None
+
+#=============================================================================================================================================
+
+# Local cache of the raw extract
+#
+# Downloaded files are stored by the SHA-256 of their content (objects/<sha256>.csv), next to a columnar Arrow copy of the
+# parsed table (objects/<sha256>.arrow) that is read through a memory map, so reloading the extract needs neither the
+# network nor the CSV parser. index.json maps each URL to its content, with the ETag / Last-Modified headers used to
+# revalidate it.
+#
+# - A cached URL is used without any request, unless refresh is asked. Refreshing sends a conditional request, so an
+#   unchanged extract is not downloaded again.
+# - When the source cannot be reached, the cached copy is used (with a warning). When there is no cached copy either,
+#   RawExtractUnavailable is raised.
+# - The total size is kept under max_bytes by evicting the least recently used entries.
+#
+# Several processes can share a cache directory (e.g. the workers of batch.py): the index is only read and written while
+# holding an exclusive lock on index.lock, and it is read again under the lock before being changed, so no process
+# saves an out-of-date index. Downloads are streamed to a temporary file (outside the lock) and moved into place under
+# it. Unreferenced objects are removed, but never temporary files nor objects written after the index was read.
+
+default_directory = os.environ.get('HOME_VISITS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'home_visits'))
+
+class RawExtractUnavailable(RuntimeError):
+    """
+    Raised when the extract can neither be downloaded nor found in the cache.
+    """
+
+def is_url(path):
+    return str(path).startswith(('http://', 'https://'))
+
+class RawCache:
+    """
+    Content-addressed cache of downloaded extracts.
+
+    Parameters:
+    -----------
+    directory : str, optional
+        Cache directory (HOME_VISITS_CACHE or ~/.cache/home_visits by default)
+    max_bytes : int
+        Maximum total size of the cached files
+    timeout : float
+        Timeout of the requests, in seconds
+    """
+
+    def __init__(self, directory=None, max_bytes=2 * 1024 ** 3, timeout=60):
+        self.directory = directory or default_directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+
+    def _object(self, digest, extension):
+        return os.path.join(self.directory, 'objects', f'{digest}.{extension}')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds the exclusive lock of the index (not reentrant: the methods called under it do not take it again).
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, 'index.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _index(self):
+        self._read_at = time.time()
+        try:
+            with open(os.path.join(self.directory, 'index.json'), encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self, index):
+        tmp = os.path.join(self.directory, 'index.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as file:
+            json.dump(index, file, indent=1)
+        os.replace(tmp, os.path.join(self.directory, 'index.json'))
+
+    def _temporary(self):
+        """
+        New temporary file in the objects directory (unique to the process, so concurrent writes never share one).
+        """
+        descriptor, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.join(self.directory, 'objects'))
+        os.close(descriptor)
+        return tmp
+
+    def _download(self, response, block_size=1024 ** 2):
+        """
+        Streams a response to a temporary file in blocks, hashing it on the way.
+
+        Returns:
+        --------
+        tmp : str
+            Temporary file
+        digest : str
+            SHA-256 of the content
+        size : int
+        """
+        tmp, sha256, size = self._temporary(), hashlib.sha256(), 0
+        try:
+            with open(tmp, 'wb') as file:
+                while True:
+                    block = response.read(block_size)
+                    if not block:
+                        break
+                    sha256.update(block)
+                    file.write(block)
+                    size += len(block)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp, sha256.hexdigest(), size
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def fetch(self, url, refresh=False):
+        """
+        Returns the path of a local copy of the file at url, downloading it when needed.
+
+        Parameters:
+        -----------
+        url : str
+        refresh : bool
+            Whether to check with the source that the cached copy is up to date
+
+        Returns:
+        --------
+        str
+            Path of the raw file in the cache
+        """
+        with self._locked():
+            index = self._index()
+            entry = index.get(url)
+            cached = entry is not None and os.path.exists(self._object(entry['sha256'], 'csv'))
+            if cached and not refresh:
+                return self._touch(index, url)
+
+        headers = {}
+        if cached and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if cached and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+                tmp, digest, size = self._download(response)
+                etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        except urllib.error.HTTPError as error:
+            if error.code == 304 and cached:
+                return self._revalidated(url, entry)
+            return self._fallback(url, cached, error)
+
+        except (urllib.error.URLError, OSError) as error:
+            return self._fallback(url, cached, error)
+
+        with self._locked():
+            index = self._index() # other processes may have changed it during the download
+            path = self._object(digest, 'csv')
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, path)
+            index[url] = {'sha256': digest, 'etag': etag, 'last_modified': last_modified, 'size': size,
+                          'fetched_at': time.time(), 'used_at': time.time()}
+            self._remove_unreferenced(index) # previous content of the URL
+            self._evict(index, keep=digest)
+            self._save_index(index)
+        return path
+
+    def _touch(self, index, url):
+        """
+        Marks an entry as used (called with the lock held and an index read under it).
+        """
+        index[url]['used_at'] = time.time()
+        self._save_index(index)
+        return self._object(index[url]['sha256'], 'csv')
+
+    def _revalidated(self, url, entry):
+        """
+        Uses the cached copy after a 304, unless another process removed or replaced it meanwhile.
+        """
+        with self._locked():
+            index = self._index()
+            if url in index and os.path.exists(self._object(index[url]['sha256'], 'csv')):
+                return self._touch(index, url)
+        return self.fetch(url)
+
+    def _fallback(self, url, cached, error):
+        with self._locked():
+            index = self._index()
+            if cached and url in index and os.path.exists(self._object(index[url]['sha256'], 'csv')):
+                print(f'Could not reach {url} ({error}), using the cached copy from '
+                      f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(index[url]["fetched_at"]))}.')
+                return self._touch(index, url)
+        raise RawExtractUnavailable(f'Could not download {url} ({error}) and there is no copy of it in the cache '
+                                    f'({self.directory}).') from error
+
+    def load(self, url, refresh=False, reader=None):
+        """
+        Reads the extract at url as a DataFrame, from the columnar copy in the cache when available.
+
+        Parameters:
+        -----------
+        url : str
+        refresh : bool
+            Whether to check with the source that the cached copy is up to date
+        reader : function, optional
+            Reads the raw file (pandas.read_csv by default). Each reader has its own columnar copy, named after it.
+
+        Returns:
+        --------
+        pandas.DataFrame
+        """
+        reader = reader or pd.read_csv
+        raw = self.fetch(url, refresh)
+        digest = os.path.basename(raw).split('.')[0]
+        arrow = self._object(digest, 'arrow' if reader is pd.read_csv else f'{reader.__name__}.arrow')
+
+        try:
+            import pyarrow as pa
+        except ImportError: # no columnar copy without pyarrow
+            return reader(raw)
+
+        if not os.path.exists(arrow):
+            table = pa.Table.from_pandas(reader(raw), preserve_index=False)
+            tmp = self._temporary()
+            with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            with self._locked():
+                os.replace(tmp, arrow)
+                index = self._index()
+                self._evict(index, keep=digest)
+                self._save_index(index)
+
+        with pa.memory_map(arrow) as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def size(self):
+        """
+        Total size of the cached files, in bytes (downloads in progress are not counted).
+        """
+        objects = os.path.join(self.directory, 'objects')
+        return sum(os.path.getsize(os.path.join(objects, name)) for name in os.listdir(objects) if not name.endswith('.tmp'))
+
+    def _remove_unreferenced(self, index):
+        """
+        Removes the objects of no entry of the index (called with the lock held and an index read under it). Temporary
+        files and objects written after the index was read (by another process) are kept.
+        """
+        digests = {entry['sha256'] for entry in index.values()}
+        objects = os.path.join(self.directory, 'objects')
+        for name in os.listdir(objects):
+            path = os.path.join(objects, name)
+            if name.endswith('.tmp') or name.split('.')[0] in digests:
+                continue
+            try:
+                if os.path.getmtime(path) < self._read_at:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, index, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes (the entry being added is kept).
+        """
+        for url in sorted(index, key=lambda url: index[url]['used_at']):
+            if self.size() <= self.max_bytes:
+                break
+            if index[url]['sha256'] != keep:
+                del index[url]
+                self._remove_unreferenced(index)
+
+    def invalidate(self, url):
+        """
+        Removes a URL from the cache, so that the next load downloads it again.
+        """
+        with self._locked():
+            index = self._index()
+            index.pop(url, None)
+            self._remove_unreferenced(index)
+            self._save_index(index)
+
+    def clear(self):
+        """
+        Removes every cached file.
+        """
+        with self._locked():
+            self._index()
+            self._save_index({})
+            self._remove_unreferenced({})
+
+#========================================================================================================================================
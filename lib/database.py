@@ -0,0 +1,338 @@
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from lib.functions import parse_list_string
+from lib.storage import is_list_column
+
+#=============================================================================================================================================
+
+# SQLite output
+#
+# The cleaned table is bulk-loaded into a local SQLite database, so the patients can be looked up by ID, flag or date
+# with an index instead of a scan of the CSV file:
+#
+# - patients: one row per patient, keyed by id_paciente (datetimes as ISO text, which keeps their order)
+# - one child table per list column (id_paciente, position, value), e.g. the diseases of each patient
+# - meta: column types of the cleaned table, to read it back with the same types (see read_database)
+#
+# Each write is one transaction: the rows go in batches (executemany) into a temporary staging table and from there
+# into the tables, with the pragmas of a bulk load (WAL journal, no fsync per statement, temporary tables in memory, a
+# larger page cache). The secondary indexes are created once, when the sink is closed, rather than updated row by row:
+# the last update date, the value of the child tables and one partial index per flag column (the rows with the flag set,
+# which is what the flags are filtered by).
+#
+# Writing into an existing database is an upsert: a patient already stored is replaced (with its lists) only when the
+# new record is more recent, like in the state store of the incremental cleaning (see incremental.StateStore.upsert).
+
+sqlite_extensions = ('.sqlite', '.sqlite3', '.db')
+
+load_pragmas = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'temp_store': 'MEMORY', 'cache_size': -256 * 1024}
+
+def is_sqlite(path):
+    """
+    Whether a path points to a SQLite database (by its extension).
+    """
+    return str(path).lower().endswith(sqlite_extensions)
+
+def _date_text(series):
+    """
+    Datetime column as ISO text with milliseconds (None for null values), computed in one vectorized pass.
+    """
+    text = np.datetime_as_string(series.to_numpy(dtype='datetime64[ms]'), unit='ms').astype(object)
+    text[series.isna().to_numpy()] = None
+    return text
+
+def _values(series):
+    """
+    Values of a column as Python objects SQLite can bind (None for null values).
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return _date_text(series)
+    values = series.to_numpy(dtype=object)
+    null = series.isna().to_numpy()
+    if null.any():
+        values[null] = None
+    return values
+
+def _list_rows(ids, series):
+    """
+    Rows of the child table of a list column: (ID, position, value) of each item. Each category is parsed once and the
+    rows take their items by code. Null lists have no rows.
+
+    Returns:
+    --------
+    ids : numpy.ndarray
+    positions : list of int
+    values : numpy.ndarray
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype): # e.g. chunks whose categories were combined
+        series = series.astype('category')
+    lists = [parse_list_string(label) for label in series.cat.categories]
+    counts = np.array([len(items) for items in lists] + [0], dtype=np.int64) # code -1: null
+    starts = np.concatenate([[0], np.cumsum(counts[:-1])])
+    flat = np.array([item for items in lists for item in items], dtype=object)
+
+    codes = series.cat.codes.to_numpy()
+    n = counts[codes]
+    positions = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    return np.repeat(ids, n), positions.tolist(), flat[np.repeat(starts[codes], n) + positions]
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class SQLiteSink:
+    """
+    Writes cleaned tables (or chunks of one) into a SQLite database, see the notes above.
+
+    Parameters:
+    -----------
+    path : str
+        Database file (created if it does not exist, otherwise the patients are upserted)
+    col : str
+        Name of the patient ID column
+    update_col : str
+        Column that decides which record of a patient is kept (the stored one is always replaced when missing)
+    batch_size : int
+        Number of rows per executemany
+    flag_cols : list, optional
+        Columns with a partial index on the rows equal to 1 (the columns ending in '_flag' by default)
+    table : str
+        Name of the main table (the child tables are named <table>_<list column>)
+    """
+
+    def __init__(self, path, col='id_paciente', update_col='data_atualizacao_cadastro', batch_size=50_000, flag_cols=None,
+                 table='patients'):
+        self.path = path
+        self.col = col
+        self.update_col = update_col
+        self.batch_size = batch_size
+        self.flag_cols = flag_cols
+        self.table = table
+        self.connection = sqlite3.connect(path, isolation_level=None) # transactions are opened by write
+        for pragma, value in load_pragmas.items():
+            self.connection.execute(f'PRAGMA {pragma} = {value}')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+        self.schema = json.loads(row[0]) if row is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def _child(self, list_col):
+        return _quote(f'{self.table}_{list_col}')
+
+    def _create(self, df):
+        """
+        Creates the tables from the columns of the first table written.
+        """
+        lists = [c for c in df.columns if is_list_column(df[c])]
+        scalars = [c for c in df.columns if c not in lists]
+        types = {c: 'INTEGER' if pd.api.types.is_bool_dtype(df[c]) or pd.api.types.is_integer_dtype(df[c])
+                 else 'REAL' if pd.api.types.is_float_dtype(df[c]) else 'TEXT' for c in scalars}
+        self.schema = {'col': self.col, 'columns': list(df.columns), 'scalars': scalars, 'lists': lists,
+                       'dtypes': {c: str(df[c].dtype) for c in df.columns}}
+
+        columns = ', '.join(f'{_quote(c)} {types[c]}' for c in scalars)
+        self.connection.execute('BEGIN')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {_quote(self.table)} ({columns}, PRIMARY KEY ({_quote(self.col)}))')
+        for c in lists:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {self._child(c)} ({_quote(self.col)} TEXT NOT NULL, '
+                                    f'position INTEGER NOT NULL, value TEXT, PRIMARY KEY ({_quote(self.col)}, position)) WITHOUT ROWID')
+        self.connection.execute("INSERT INTO meta (key, value) VALUES ('schema', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                                (json.dumps(self.schema),))
+        self.connection.execute('COMMIT')
+
+    def _stage(self, df):
+        """
+        Loads a table into the staging tables, in batches.
+        """
+        scalars, lists = self.schema['scalars'], self.schema['lists']
+        self.connection.execute(f'CREATE TEMP TABLE IF NOT EXISTS staging AS SELECT * FROM {_quote(self.table)} WHERE 0')
+        self.connection.execute('DELETE FROM temp.staging')
+        insert = f'INSERT INTO temp.staging VALUES ({", ".join("?" * len(scalars))})'
+        for c in lists:
+            self.connection.execute(f'CREATE TEMP TABLE IF NOT EXISTS "staging_{c}" ({_quote(self.col)} TEXT, position INTEGER, value TEXT)')
+            self.connection.execute(f'DELETE FROM temp."staging_{c}"')
+
+        for start in range(0, len(df), self.batch_size):
+            block = df.iloc[start:start + self.batch_size]
+            self.connection.executemany(insert, zip(*(_values(block[c]) for c in scalars)))
+            ids = _values(block[self.col])
+            for c in lists:
+                self.connection.executemany(f'INSERT INTO temp."staging_{c}" VALUES (?, ?, ?)',
+                                            zip(*_list_rows(ids, block[c])))
+
+    def write(self, df, keep=None):
+        """
+        Upserts a cleaned table (or a chunk of it) in one transaction.
+
+        Parameters:
+        -----------
+        df : pandas.DataFrame
+            Cleaned table, one row per patient (when an ID is repeated, its most recent row is kept)
+        keep : numpy.ndarray of bool, optional
+            Rows to write (all of them when None), e.g. ~functions.null_rows(df)
+
+        Returns:
+        --------
+        int
+            Number of patients inserted or replaced
+        """
+        if keep is not None:
+            df = df[keep]
+        if self.schema is None:
+            self._create(df)
+        if self.update_col not in df.columns:
+            self.update_col = None
+
+        if df[self.col].duplicated().any():
+            order = [self.update_col] if self.update_col is not None else []
+            df = df.sort_values(order, ascending=False, na_position='last', kind='stable') if order else df
+            df = df.loc[~df[self.col].duplicated(keep='first' if order else 'last')].sort_index()
+
+        table, col = _quote(self.table), _quote(self.col)
+        newer = 'TRUE'
+        if self.update_col is not None:
+            update = _quote(self.update_col)
+            newer = f'{table}.{update} IS NULL OR excluded.{update} > {table}.{update}'
+
+        self.connection.execute('BEGIN')
+        try:
+            self._stage(df)
+
+            # Patients whose lists are replaced: the new ones and the ones whose stored record is older
+            self.connection.execute(f'CREATE TEMP TABLE IF NOT EXISTS accepted ({col} TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM temp.accepted')
+            if self.schema['lists']:
+                self.connection.execute(f'INSERT INTO temp.accepted SELECT s.{col} FROM temp.staging s LEFT JOIN {table} '
+                                        f'ON {table}.{col} = s.{col} WHERE {table}.{col} IS NULL OR '
+                                        + newer.replace('excluded.', 's.'))
+            for c in self.schema['lists']:
+                child = self._child(c)
+                self.connection.execute(f'DELETE FROM {child} WHERE {col} IN (SELECT {col} FROM temp.accepted)')
+                self.connection.execute(f'INSERT INTO {child} SELECT * FROM temp."staging_{c}" WHERE {col} IN '
+                                        f'(SELECT {col} FROM temp.accepted)')
+
+            names = ', '.join(_quote(c) for c in self.schema['scalars'])
+            updates = ', '.join(f'{_quote(c)} = excluded.{_quote(c)}' for c in self.schema['scalars'] if c != self.col)
+            changed = self.connection.execute(f'INSERT INTO {table} ({names}) SELECT {names} FROM temp.staging WHERE TRUE '
+                                              f'ON CONFLICT ({col}) DO UPDATE SET {updates} WHERE {newer}').rowcount
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return changed
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def create_indexes(self):
+        """
+        Creates the secondary indexes (the ones missing), then updates the statistics of the query planner.
+        """
+        if self.schema is None:
+            return
+        table = self.table
+        statements = []
+        if self.update_col is not None and self.update_col in self.schema['scalars']:
+            statements.append(f'CREATE INDEX IF NOT EXISTS {_quote(f"{table}_{self.update_col}")} ON {_quote(table)} ({_quote(self.update_col)})')
+        flags = self.flag_cols if self.flag_cols is not None else [c for c in self.schema['scalars'] if c.endswith('_flag')]
+        for c in flags:
+            statements.append(f'CREATE INDEX IF NOT EXISTS {_quote(f"{table}_{c}")} ON {_quote(table)} ({_quote(c)}) WHERE {_quote(c)} = 1')
+        for c in self.schema['lists']:
+            statements.append(f'CREATE INDEX IF NOT EXISTS {_quote(f"{table}_{c}_value")} ON {self._child(c)} (value, {_quote(self.col)})')
+
+        self.connection.execute('BEGIN')
+        for statement in statements:
+            self.connection.execute(statement)
+        self.connection.execute('COMMIT')
+        self.connection.execute('ANALYZE')
+
+    def close(self):
+        """
+        Creates the indexes and closes the database, as a single file (the WAL journal is checkpointed and removed).
+        """
+        try:
+            self.create_indexes()
+            self.connection.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            self.connection.close()
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def write_database(df, path, keep=None, **kwargs):
+    """
+    Writes (upserts) a cleaned table into a SQLite database, see SQLiteSink.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    path : str
+        Database file
+    keep : numpy.ndarray of bool, optional
+        Rows to write (all of them when None)
+    kwargs :
+        Arguments of SQLiteSink
+
+    Returns:
+    --------
+    int
+        Number of patients inserted or replaced
+    """
+    with SQLiteSink(path, **kwargs) as sink:
+        return sink.write(df, keep)
+
+def read_database(path, where=None, params=(), table='patients'):
+    """
+    Reads the cleaned table back from a SQLite database, with the column types it was written with (list columns as
+    categorical columns of lists written as text, like encode_list_column; null lists have no rows and read back as null, and
+    SQLite stores -0.0 as 0.0).
+
+    Parameters:
+    -----------
+    path : str
+        Database file
+    where : str, optional
+        SQL condition on the main table, e.g. 'diabetes_flag = 1 AND data_atualizacao_cadastro >= ?'
+    params : tuple
+        Parameters of the condition
+    table : str
+        Name of the main table
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Rows in the order they were first inserted
+    """
+    connection = sqlite3.connect(path)
+    try:
+        schema = json.loads(connection.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()[0])
+        col = _quote(schema['col'])
+        condition = f' WHERE {where}' if where else ''
+        df = pd.read_sql(f'SELECT * FROM {_quote(table)}{condition} ORDER BY rowid', connection, params=params)
+        lists = {c: pd.read_sql(f'SELECT c.{col}, c.value FROM {_quote(f"{table}_{c}")} c WHERE c.{col} IN '
+                                f'(SELECT {col} FROM {_quote(table)}{condition}) ORDER BY c.{col}, c.position',
+                                connection, params=params)
+                 for c in schema['lists']}
+    finally:
+        connection.close()
+
+    for c, rows in lists.items():
+        labels = rows.groupby(schema['col'], sort=False)['value'].agg(lambda items: str(list(items)))
+        df[c] = df[schema['col']].map(labels).astype('category')
+    for c, dtype in schema['dtypes'].items():
+        if c in schema['lists']:
+            continue
+        if dtype.startswith('datetime64'):
+            df[c] = pd.to_datetime(df[c], format='ISO8601').astype(dtype)
+        else:
+            df[c] = df[c].astype(dtype)
+    return df[schema['columns']]
+
+#========================================================================================================================================
@@ -0,0 +1,673 @@
+import os
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import lib.functions as functions
+import lib.streaming as streaming
+from lib.loader import boolean_values, null_values, schema
+from lib.pipeline import OutlierFlags, StratifiedOutlierFlags
+
+#=============================================================================================================================================
+
+# Out-of-core backends (Polars lazy queries and embedded DuckDB)
+#
+# The pipeline of pipeline.json can run as a query of an embedded engine instead of pandas. The engine reads the extract
+# from disk, runs on all the cores and spills to disk when needed, and the result is the same as the pandas backend:
+#
+# - the raw extract is read with the schema of lib/loader.py (booleans to int8, the date layouts of functions.date_layouts,
+#   numbers), as expressions of the engine
+# - date flags, numeric conversions and the compact types are expressions of the engine too
+# - the other row steps (list parsing and flags, replacements, income, categories...) are the functions of
+#   lib/functions.py: they run in pandas on the distinct values of the columns they read, and the result is joined back
+#   to the rows by the engine. Steps that share no column are evaluated independently (see _components).
+# - the IQR limits are grouped quantiles computed by the engine, and the flags a join of the limits table on the stratum
+# - the duplicates plan (see Duplicates in lib/pipeline.py) is computed from the key columns of the duplicated IDs, and applied by
+#   row number with a filter and a join
+#
+# The cleaned table is written to a temporary Parquet file, then converted to the output files in chunks with the same
+# writers as the chunked pandas run (see streaming.run_chunked), so the CSV and Parquet outputs have the same format.
+#
+# Differences with the pandas backend: timestamps in a layout other than those of functions.date_layouts are read with
+# the ISO 8601 parser of the engine (pandas accepts a few more variants), and the integer columns of the compact types
+# keep their type.
+
+engines = ['pandas', 'polars', 'duckdb']
+
+# Steps run as expressions of the engine (the other row steps are mapped over the distinct values)
+native_steps = {'to_categorical', 'boolean_to_int', 'standardize_date', 'date_flag', 'standardize_dates', 'columns_to_numeric',
+                'compact_dtypes'}
+
+# Timestamps that pandas can hold (datetime64[ns]), the others are invalid dates
+first_date = pd.Timestamp.min.ceil('us').to_pydatetime()
+last_date = pd.Timestamp.max.floor('us').to_pydatetime()
+
+max_age = 130 # ages above it have an unknown age band (see functions.strata)
+
+def _components(groups):
+    """
+    Splits row steps into groups that share no column (each group keeps the order of the plan).
+    """
+    components = []
+    for group in groups:
+        columns = set(group.reads + group.writes)
+        merged = [component for component in components if component[0] & columns]
+        for component in merged:
+            components.remove(component)
+            columns |= component[0]
+        components.append((columns, [step for component in merged for step in component[1]] + [group]))
+    return [steps for _, steps in components]
+
+def _inputs(steps):
+    """
+    Columns read by the steps before any of them writes them: the columns whose distinct values are mapped.
+    """
+    inputs, written = [], set()
+    for step in steps:
+        inputs += [col for col in step.reads if col not in written and col not in inputs]
+        written |= set(step.writes)
+    return inputs
+
+def _outputs(steps):
+    outputs = []
+    for step in steps:
+        outputs += [col for col in step.writes if col not in outputs]
+    return outputs
+
+def _engine_values(df):
+    """
+    Columns of a pandas result in types the engines read: categorical columns as their labels.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+class Engine:
+    """
+    Runs a pipeline as a query of an embedded engine (see the notes above). The subclasses build the expressions, the
+    joins and the aggregations of each engine.
+
+    Parameters:
+    -----------
+    pipeline : lib.pipeline.Pipeline
+    directory : str
+        Directory of the temporary files
+    """
+
+    def __init__(self, pipeline, directory):
+        self.pipeline = pipeline
+        self.directory = directory
+        self.kinds = {}
+        self.categorical = {col for col, kind in schema.items() if kind == 'category'}
+        self.lists = set()
+
+    def run(self, path, outputs, chunksize=100_000, compression='zstd', row_group_size=None, verbose=False):
+        """
+        Runs the pipeline on a file and writes the outputs.
+
+        Returns:
+        --------
+        N_rows, N_null : int
+            Number of rows written and number of rows with null values
+        """
+        frame, order = self.scan(path)
+        self.kinds = {col: schema.get(col, 'string') for col in order}
+        pending = [] # row steps not evaluated yet
+
+        for group in self.pipeline.plan():
+            if verbose and group.message: print(group.message)
+            order += [col for col in group.writes if col not in order] # new columns at the end, as in the pandas backend
+
+            if not group.is_global and getattr(group, 'name', None) not in native_steps:
+                pending.append(group)
+                continue
+            if any(set(group.reads + group.writes) & set(step.reads + step.writes) for step in pending):
+                frame, pending = self._map(frame, pending), []
+
+            if isinstance(group, OutlierFlags):
+                state = self._fit_outliers(frame, group)
+                if verbose: print(group.summary(state))
+                frame = self.flag_outliers(frame, group, state)
+            elif group.is_global: # duplicates
+                state = group._plan(*self.duplicated_keys(frame, group))
+                if verbose: print(group.summary(state))
+                drop, new_ids, log = state
+                frame = self.apply_duplicates(frame, group.col, drop, new_ids)
+            else:
+                frame = self._native(frame, group)
+
+        frame = self._map(frame, pending)
+
+        cleaned = os.path.join(self.directory, 'cleaned.parquet')
+        self.sink(frame, order, cleaned)
+        return streaming.run_chunked(cleaned, self._restore(cleaned), outputs, chunksize, compression, row_group_size,
+                                     self.pipeline.column_types())
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def _native(self, frame, step):
+        args = step.args
+        if step.name == 'to_categorical':
+            self.categorical |= set(args['cols'])
+            return frame
+        if step.name == 'boolean_to_int':
+            return frame if self.kinds.get(args['col']) == 'boolean' else self.booleans(frame, [args['col']])
+        if step.name == 'columns_to_numeric':
+            return self.numbers(frame, args['cols'])
+        if step.name == 'compact_dtypes':
+            return self.float32(frame, list(args['floats']))
+
+        cols = [args['col']] if 'col' in args else list(args['cols'])
+        if step.name in ('standardize_date', 'standardize_dates'):
+            text = [col for col in cols if self.kinds.get(col) != 'datetime']
+            if text:
+                frame = self.dates(frame, text)
+                self.kinds.update({col: 'datetime' for col in text})
+        if step.name == 'date_flag' or (step.name == 'standardize_dates' and args['flags']):
+            frame = self.date_flags(frame, cols)
+        return frame
+
+    def _map(self, frame, groups):
+        """
+        Evaluates row steps on the distinct values of the columns they read and joins the results to the rows.
+        """
+        components = _components(groups)
+        keysets = [_inputs(steps) for steps in components]
+
+        for steps, keys, (table, values) in zip(components, keysets, self.distinct(frame, keysets)):
+            df = values[keys].copy()
+            for col in keys:
+                if col in self.categorical:
+                    df[col] = df[col].astype('category')
+            weights = values['__rows'].to_numpy()
+
+            for step in steps:
+                df = step.run(df, weights=weights)
+                if getattr(step, 'name', None) == 'encode_list_column':
+                    self.lists.add(step.args['col'])
+
+            writes = _outputs(steps)
+            mapping = _engine_values(df[writes]).rename(columns={col: f'__new_{col}' for col in writes})
+            mapping.insert(0, '__key', values['__key'].to_numpy())
+            frame = self.join(frame, table, keys, mapping, writes)
+            self.kinds.update({col: None for col in writes})
+        return frame
+
+    def _fit_outliers(self, frame, step):
+        """
+        IQR limits from the quartiles computed by the engine, with the arithmetic of functions.calculate_IQR_lims_by_stratum.
+        """
+        stratified = isinstance(step, StratifiedOutlierFlags)
+
+        def compute():
+            overall, grouped = self.quartiles(frame, step, stratified)
+            lims = {}
+            for col in step.cols:
+                Q1, Q3 = overall[f'{col}_q1'], overall[f'{col}_q3']
+                IQR = Q3 - Q1
+                lims[col] = [Q1 - step.factor * IQR, Q3 + step.factor * IQR]
+            if not stratified:
+                return lims
+
+            # Strata in the order of the pandas groupby: age bands in order, then sexes sorted
+            labels = functions.age_band_labels(step.age_bands) + [functions.unknown_stratum]
+            grouped['__band'] = grouped['__age_band'].map(labels.index)
+            grouped = grouped.sort_values(['__band', '__sex'])
+
+            limits = [{'age_band': '*', 'sex': '*', 'column': col, 'lower': lims[col][0], 'upper': lims[col][1],
+                       'count': int(overall[f'{col}_count'])} for col in step.cols]
+            for _, row in grouped.iterrows():
+                for col in step.cols:
+                    Q1, Q3 = row[f'{col}_q1'], row[f'{col}_q3']
+                    stratum_lims = [Q1 - step.factor * (Q3 - Q1), Q3 + step.factor * (Q3 - Q1)] if row[f'{col}_count'] >= step.min_count else lims[col]
+                    limits.append({'age_band': row['__age_band'], 'sex': row['__sex'], 'column': col, 'lower': stratum_lims[0],
+                                   'upper': stratum_lims[1], 'count': int(row[f'{col}_count'])})
+            return limits
+
+        return step._cached(compute) if stratified else step._fixed(compute())
+
+    @staticmethod
+    def _limits_table(step, limits):
+        """
+        Limits table of StratifiedOutlierFlags with one row per stratum ('__age_band', '__sex') and the columns
+        '<col>__lower' and '<col>__upper', and the overall limits (column -> (lower, upper)).
+        """
+        table = pd.DataFrame(limits)
+        is_overall = (table['age_band'] == '*') & (table['sex'] == '*')
+        overall = table[is_overall].set_index('column')
+        wide = table[~is_overall].pivot(index=['age_band', 'sex'], columns='column', values=['lower', 'upper'])
+        wide.columns = [f'{col}__{bound}' for bound, col in wide.columns]
+        wide = wide.reindex(columns=[f'{col}__{bound}' for col in step.cols for bound in ('lower', 'upper')]).astype(float)
+        wide = wide.reset_index().rename(columns={'age_band': '__age_band', 'sex': '__sex'})
+        return wide, {col: (overall.loc[col, 'lower'], overall.loc[col, 'upper']) for col in step.cols}
+
+    def _restore(self, path):
+        """
+        Transformation of the chunks of the cleaned Parquet file into the types of the pandas backend: integer columns
+        with null values as float (raw numbers, as read by loader.load_raw) or nullable integers (booleans and results of
+        the row steps), and list columns as categorical (see storage.is_list_column).
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        file = pq.ParquetFile(path)
+        nulls = {}
+        for i in range(file.metadata.num_row_groups):
+            row_group = file.metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                stats = column.statistics
+                has_nulls = stats is None or not stats.has_null_count or stats.null_count > 0
+                nulls[column.path_in_schema] = nulls.get(column.path_in_schema, False) or has_nulls
+
+        dtypes = {}
+        for field in file.schema_arrow:
+            if pa.types.is_integer(field.type) and nulls.get(field.name, True):
+                dtypes[field.name] = np.float64 if self.kinds.get(field.name) == 'int' else f'Int{field.type.bit_width}'
+
+        def restore(chunk):
+            for col, dtype in dtypes.items():
+                chunk[col] = chunk[col].astype(dtype)
+            for col in self.lists:
+                if col in chunk.columns:
+                    chunk[col] = chunk[col].astype('category')
+            return chunk
+
+        return restore
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def _polars_format(date_format):
+    return date_format.replace('.%f', '%.f')
+
+class PolarsEngine(Engine):
+    """
+    Pipeline as a Polars lazy query, executed by the streaming engine.
+    """
+
+    iso_formats = ['%Y-%m-%dT%H:%M:%S%.f', '%Y-%m-%d %H:%M:%S%.f', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+    def __init__(self, pipeline, directory):
+        import polars as pl
+        super().__init__(pipeline, directory)
+        self.pl = pl
+
+    def scan(self, path):
+        pl = self.pl
+        if str(path).lower().endswith(('.parquet', '.pq')):
+            frame = pl.scan_parquet(path)
+        else:
+            frame = pl.scan_csv(path, infer_schema=False, null_values=null_values)
+        header = frame.collect_schema().names()
+
+        conversions = []
+        for col in header:
+            kind = schema.get(col, 'string')
+            if kind == 'boolean':
+                conversions.append(self._boolean(col))
+            elif kind == 'datetime':
+                conversions.append(self._date(col))
+            elif kind in ('int', 'float'):
+                conversions.append(pl.col(col).cast(pl.Int64 if kind == 'int' else pl.Float64, strict=False))
+        return frame.with_row_index('__row').with_columns(conversions), header
+
+    def _boolean(self, col):
+        pl = self.pl
+        return pl.col(col).cast(pl.String).replace_strict(boolean_values, default=None, return_dtype=pl.Int8)
+
+    def _date(self, col):
+        pl = self.pl
+        text = pl.col(col).cast(pl.String)
+        length = text.str.len_chars()
+
+        parsed = None
+        for (size, position, separator), date_format in functions.date_layouts.items():
+            layout = (length == size) & (text.str.slice(position, 1) == separator)
+            value = text.str.strptime(pl.Datetime('us'), _polars_format(date_format), strict=False)
+            parsed = pl.when(layout).then(value) if parsed is None else parsed.when(layout).then(value)
+        parsed = parsed.otherwise(pl.coalesce([text.str.strptime(pl.Datetime('us'), date_format, strict=False)
+                                               for date_format in self.iso_formats]))
+        return pl.when(parsed.is_between(first_date, last_date)).then(parsed).cast(pl.Datetime('ns')).alias(col)
+
+    def booleans(self, frame, cols):
+        return frame.with_columns([self._boolean(col) for col in cols])
+
+    def dates(self, frame, cols):
+        return frame.with_columns([self._date(col) for col in cols])
+
+    def date_flags(self, frame, cols):
+        pl = self.pl
+        current_year = datetime.now().year
+        flags = []
+        for col in cols:
+            year = pl.col(col).dt.year()
+            flags.append(((year < current_year - 120) | (year > current_year)).fill_null(False).cast(pl.Int8).alias(col + '_flag'))
+        return frame.with_columns(flags)
+
+    def numbers(self, frame, cols):
+        pl = self.pl
+        types = frame.collect_schema()
+        return frame.with_columns([pl.col(col).cast(pl.Float64, strict=False) for col in cols if types[col] == pl.String])
+
+    def float32(self, frame, cols):
+        pl = self.pl
+        return frame.with_columns([pl.col(col).cast(pl.Float32) for col in cols])
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def _strata(self, step):
+        pl = self.pl
+        days = (pl.col(step.reference_col) - pl.col(step.birth_col)).dt.total_microseconds() // 86_400_000_000
+        age = days.cast(pl.Float64) / 365.25
+
+        band = pl.when(age.is_null() | (age < 0) | (age > max_age)).then(pl.lit(functions.unknown_stratum))
+        for low, label in reversed(list(zip(step.age_bands, functions.age_band_labels(step.age_bands)))):
+            band = band.when(age >= low).then(pl.lit(label))
+        band = band.otherwise(pl.lit(functions.unknown_stratum))
+        sex = pl.col(step.sex_col).cast(pl.String).fill_null(functions.unknown_stratum)
+        return [band.alias('__age_band'), sex.alias('__sex')]
+
+    def quartiles(self, frame, step, stratified):
+        pl = self.pl
+        aggregations = []
+        for col in step.cols:
+            value = pl.col(col).cast(pl.Float64, strict=False)
+            aggregations += [value.quantile(0.25, 'linear').alias(f'{col}_q1'), value.quantile(0.75, 'linear').alias(f'{col}_q3'),
+                             value.count().alias(f'{col}_count')]
+
+        queries = [frame.select(aggregations)]
+        if stratified:
+            queries.append(frame.with_columns(self._strata(step)).group_by(['__age_band', '__sex']).agg(aggregations))
+        results = pl.collect_all(queries)
+        return results[0].to_pandas().iloc[0], results[1].to_pandas() if stratified else None
+
+    def flag_outliers(self, frame, step, state):
+        pl = self.pl
+        if not isinstance(step, StratifiedOutlierFlags):
+            return frame.with_columns([pl.when(pl.col(col).is_between(*state[col])).then(0).otherwise(1).cast(pl.Int8)
+                                       .alias(col + '_outlier_flag') for col in step.cols])
+
+        table, overall = self._limits_table(step, state)
+        frame = frame.with_columns(self._strata(step)).join(pl.from_pandas(table).lazy(), on=['__age_band', '__sex'],
+                                                             how='left', maintain_order='left')
+        flags = []
+        for col in step.cols:
+            lower = pl.coalesce(pl.col(f'{col}__lower'), pl.lit(overall[col][0]))
+            upper = pl.coalesce(pl.col(f'{col}__upper'), pl.lit(overall[col][1]))
+            value = pl.col(col).cast(pl.Float64, strict=False)
+            flags.append(pl.when((value >= lower) & (value <= upper)).then(0).otherwise(1).cast(pl.Int8).alias(col + '_outlier_flag'))
+        return frame.with_columns(flags).drop(['__age_band', '__sex'] + list(table.columns[2:]))
+
+    def duplicated_keys(self, frame, step, block_size=1_000_000):
+        pl = self.pl
+        keys, ids = pl.collect_all([frame.filter(pl.col(step.col).is_duplicated()).select(['__row'] + step.reads),
+                                    frame.select(pl.col(step.col).unique())])
+        keys = keys.to_pandas().set_index('__row')
+        keys.index = keys.index.astype(np.int64).rename(None)
+        hashes = [functions.hash_ids(ids[step.col].slice(start, block_size).to_pandas()) for start in range(0, len(ids), block_size)]
+        return keys, np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+
+    def apply_duplicates(self, frame, col, drop, new_ids):
+        pl = self.pl
+        if len(drop):
+            frame = frame.filter(~pl.col('__row').is_in(pl.Series(np.asarray(drop), dtype=pl.UInt32).implode()))
+        if len(new_ids):
+            ids = pl.LazyFrame({'__row': pl.Series(new_ids.index.to_numpy(), dtype=pl.UInt32),
+                                '__new_id': pl.Series(new_ids.to_numpy(), dtype=pl.String)})
+            frame = frame.join(ids, on='__row', how='left', maintain_order='left')
+            frame = frame.with_columns(pl.coalesce('__new_id', col).alias(col)).drop('__new_id')
+        return frame
+
+    def distinct(self, frame, keysets):
+        pl = self.pl
+        tables = pl.collect_all([frame.group_by(keys).agg(pl.len().alias('__rows')) for keys in keysets])
+        tables = [table.with_row_index('__key') for table in tables]
+        return [(table.select(['__key'] + keys), table.to_pandas()) for keys, table in zip(keysets, tables)]
+
+    def join(self, frame, table, keys, mapping, writes):
+        pl = self.pl
+        mapping = pl.from_pandas(mapping).with_columns(pl.col('__key').cast(pl.UInt32))
+        values = table.join(mapping, on='__key').drop('__key')
+        frame = frame.join(values.lazy(), on=keys, how='left', nulls_equal=True, maintain_order='left')
+        return frame.with_columns([pl.col(f'__new_{col}').alias(col) for col in writes]).drop([f'__new_{col}' for col in writes])
+
+    def sink(self, frame, columns, path):
+        frame.select(columns).sink_parquet(path)
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def _name(col):
+    return '"' + str(col).replace('"', '""') + '"'
+
+def _text(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+class DuckDBEngine(Engine):
+    """
+    Pipeline as SQL queries of an embedded DuckDB database (a temporary file, so that large tables spill to disk).
+    The raw extract is loaded once into a table of the database, whose row order is kept in the column __row.
+    """
+
+    def __init__(self, pipeline, directory):
+        import duckdb
+        super().__init__(pipeline, directory)
+        self.con = duckdb.connect(os.path.join(directory, 'engine.duckdb'))
+        self.tables = 0
+
+    def _table(self, df):
+        """
+        Registers a pandas table in the database, returning its name.
+        """
+        self.tables += 1
+        name = f'__table_{self.tables}'
+        self.con.register(name, df)
+        return name
+
+    def _columns(self, frame):
+        return self.con.sql(frame).columns
+
+    def _with(self, frame, expressions):
+        """
+        Query adding (or replacing) columns: column -> SQL expression.
+        """
+        replaced = [col for col in self._columns(frame) if col in expressions]
+        exclude = f' EXCLUDE ({", ".join(_name(col) for col in replaced)})' if replaced else ''
+        return (f'SELECT *{exclude}, ' + ', '.join(f'{expression} AS {_name(col)}' for col, expression in expressions.items())
+                + f' FROM ({frame})')
+
+    def scan(self, path):
+        if str(path).lower().endswith(('.parquet', '.pq')):
+            source = f'read_parquet({_text(path)})'
+        else:
+            source = (f'read_csv({_text(path)}, header = true, all_varchar = true, '
+                      f'nullstr = [{", ".join(_text(value) for value in null_values)}])')
+        header = self._columns(f'SELECT * FROM {source}')
+
+        columns = []
+        for col in header:
+            kind = schema.get(col, 'string')
+            if kind == 'boolean':
+                columns.append(f'{self._boolean(col)} AS {_name(col)}')
+            elif kind == 'datetime':
+                columns.append(f'{self._date(col)} AS {_name(col)}')
+            elif kind in ('int', 'float'):
+                columns.append(f'TRY_CAST({_name(col)} AS {"BIGINT" if kind == "int" else "DOUBLE"}) AS {_name(col)}')
+            else:
+                columns.append(_name(col))
+        self.con.execute(f'CREATE TABLE raw AS SELECT {", ".join(columns)} FROM {source}')
+        return 'SELECT rowid AS __row, * FROM raw', header
+
+    def _boolean(self, col):
+        cases = ' '.join(f'WHEN {_text(text)} THEN {value}' for text, value in boolean_values.items())
+        return f'CAST(CASE CAST({_name(col)} AS VARCHAR) {cases} END AS TINYINT)'
+
+    def _date(self, col):
+        text = f'CAST({_name(col)} AS VARCHAR)'
+        cases = ' '.join(f'WHEN length({text}) = {size} AND substr({text}, {position + 1}, 1) = {_text(separator)} '
+                         f'THEN try_strptime({text}, {_text(date_format)})'
+                         for (size, position, separator), date_format in functions.date_layouts.items())
+        parsed = f'(CASE {cases} ELSE TRY_CAST({text} AS TIMESTAMP) END)'
+        return (f"CAST(CASE WHEN {parsed} BETWEEN TIMESTAMP '{first_date}' AND TIMESTAMP '{last_date}' THEN {parsed} END "
+                f'AS TIMESTAMP_NS)')
+
+    def booleans(self, frame, cols):
+        return self._with(frame, {col: self._boolean(col) for col in cols})
+
+    def dates(self, frame, cols):
+        return self._with(frame, {col: self._date(col) for col in cols})
+
+    def date_flags(self, frame, cols):
+        current_year = datetime.now().year
+        return self._with(frame, {col + '_flag': f'CAST(COALESCE(year({_name(col)}) < {current_year - 120} OR year({_name(col)}) > '
+                                                 f'{current_year}, false) AS TINYINT)' for col in cols})
+
+    def numbers(self, frame, cols):
+        types = dict(zip(self._columns(frame), self.con.sql(frame).types))
+        return self._with(frame, {col: f'TRY_CAST({_name(col)} AS DOUBLE)' for col in cols if str(types[col]) == 'VARCHAR'})
+
+    def float32(self, frame, cols):
+        return self._with(frame, {col: f'CAST({_name(col)} AS FLOAT)' for col in cols})
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def _strata(self, step):
+        days = f"floor(date_diff('microsecond', {_name(step.birth_col)}, {_name(step.reference_col)}) / 86400000000)"
+        age = f'({days} / 365.25)'
+        cases = ' '.join(f'WHEN {age} >= {low} THEN {_text(label)}'
+                         for low, label in reversed(list(zip(step.age_bands, functions.age_band_labels(step.age_bands)))))
+        unknown = _text(functions.unknown_stratum)
+        band = f'CASE WHEN {age} IS NULL OR {age} < 0 OR {age} > {max_age} THEN {unknown} {cases} ELSE {unknown} END'
+        return {'__age_band': band, '__sex': f'COALESCE(CAST({_name(step.sex_col)} AS VARCHAR), {unknown})'}
+
+    def quartiles(self, frame, step, stratified):
+        aggregations = []
+        for col in step.cols:
+            value = f'TRY_CAST({_name(col)} AS DOUBLE)'
+            aggregations += [f'quantile_cont({value}, 0.25) AS {_name(col + "_q1")}', f'quantile_cont({value}, 0.75) AS {_name(col + "_q3")}',
+                             f'count({value}) AS {_name(col + "_count")}']
+        overall = self.con.sql(f'SELECT {", ".join(aggregations)} FROM ({frame})').df().iloc[0]
+        if not stratified:
+            return overall, None
+        grouped = self.con.sql(f'SELECT __age_band, __sex, {", ".join(aggregations)} FROM ({self._with(frame, self._strata(step))}) '
+                               'GROUP BY __age_band, __sex').df()
+        return overall, grouped
+
+    def flag_outliers(self, frame, step, state):
+        if not isinstance(step, StratifiedOutlierFlags):
+            return self._with(frame, {col + '_outlier_flag': f'CAST(CASE WHEN {_name(col)} BETWEEN {float(lims[0])!r} AND {float(lims[1])!r} THEN 0 ELSE 1 END AS TINYINT)'
+                                      for col, lims in state.items()})
+
+        table, overall = self._limits_table(step, state)
+        name = self._table(table)
+        flags = []
+        for col in step.cols:
+            lower = f'COALESCE(l.{_name(col + "__lower")}, {float(overall[col][0])!r})'
+            upper = f'COALESCE(l.{_name(col + "__upper")}, {float(overall[col][1])!r})'
+            value = f'TRY_CAST(f.{_name(col)} AS DOUBLE)'
+            flags.append(f'CAST(CASE WHEN {value} >= {lower} AND {value} <= {upper} THEN 0 ELSE 1 END AS TINYINT) AS {_name(col + "_outlier_flag")}')
+
+        replaced = [col + '_outlier_flag' for col in step.cols if col + '_outlier_flag' in self._columns(frame)]
+        exclude = ['__age_band', '__sex'] + replaced
+        return (f'SELECT f.* EXCLUDE ({", ".join(_name(col) for col in exclude)}), {", ".join(flags)} '
+                f'FROM ({self._with(frame, self._strata(step))}) AS f '
+                f'LEFT JOIN {name} AS l ON f.__age_band = l.__age_band AND f.__sex = l.__sex')
+
+    def duplicated_keys(self, frame, step, block_size=1_000_000):
+        col = _name(step.col)
+        keys = self.con.sql(f'SELECT __row, {", ".join(_name(c) for c in step.reads)} FROM '
+                            f'(SELECT *, count(*) OVER (PARTITION BY {col}) AS __count FROM ({frame})) WHERE __count > 1 ORDER BY __row').df()
+        keys = keys.set_index('__row')
+        keys.index = keys.index.astype(np.int64).rename(None)
+
+        hashes = [np.empty(0, dtype=np.uint64)]
+        reader = self.con.sql(f'SELECT DISTINCT {col} FROM ({frame})').to_arrow_reader(block_size)
+        for batch in reader:
+            hashes.append(functions.hash_ids(batch.column(0).to_pandas()))
+        return keys, np.concatenate(hashes)
+
+    def apply_duplicates(self, frame, col, drop, new_ids):
+        if len(drop):
+            name = self._table(pd.DataFrame({'__row': np.asarray(drop, dtype=np.int64)}))
+            frame = f'SELECT * FROM ({frame}) WHERE __row NOT IN (SELECT __row FROM {name})'
+        if len(new_ids):
+            name = self._table(pd.DataFrame({'__row': new_ids.index.to_numpy(dtype=np.int64), '__new_id': new_ids.to_numpy(dtype=object)}))
+            frame = (f'SELECT f.* REPLACE (COALESCE(n.__new_id, f.{_name(col)}) AS {_name(col)}) FROM ({frame}) AS f '
+                     f'LEFT JOIN {name} AS n ON f.__row = n.__row')
+        return frame
+
+    def distinct(self, frame, keysets):
+        results = []
+        for keys in keysets:
+            self.tables += 1
+            name = f'__distinct_{self.tables}'
+            columns = ', '.join(_name(col) for col in keys)
+            self.con.execute(f'CREATE TEMP TABLE {name} AS SELECT row_number() OVER () AS __key, * FROM '
+                             f'(SELECT {columns}, count(*) AS __rows FROM ({frame}) GROUP BY {columns})')
+            results.append((name, self.con.table(name).df()))
+        return results
+
+    def join(self, frame, table, keys, mapping, writes):
+        name = self._table(mapping)
+        condition = ' AND '.join(f'f.{_name(col)} IS NOT DISTINCT FROM v.{_name(col)}' for col in keys)
+        replaced = [col for col in writes if col in self._columns(frame)]
+        exclude = f' EXCLUDE ({", ".join(_name(col) for col in replaced)})' if replaced else ''
+        new = ', '.join(f'v.{_name("__new_" + col)} AS {_name(col)}' for col in writes)
+        values = f'SELECT * FROM {table} JOIN {name} USING (__key)'
+        return f'SELECT f.*{exclude}, {new} FROM ({frame}) AS f LEFT JOIN ({values}) AS v ON {condition}'
+
+    def sink(self, frame, columns, path, batch_size=100_000):
+        # Written by pyarrow: the Parquet writer of DuckDB stores -0.0 as 0.0 in dictionary encoded pages
+        import pyarrow.parquet as pq
+
+        query = f'SELECT {", ".join(_name(col) for col in columns)} FROM ({frame}) ORDER BY __row'
+        reader = self.con.sql(query).to_arrow_reader(batch_size)
+        with pq.ParquetWriter(path, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+engine_classes = {'polars': PolarsEngine, 'duckdb': DuckDBEngine}
+
+def run_engine(pipeline, path, outputs, engine='polars', chunksize=100_000, compression='zstd', row_group_size=None,
+               verbose=False):
+    """
+    Runs a pipeline on a file with an embedded engine (see the notes above).
+
+    Parameters:
+    -----------
+    pipeline : lib.pipeline.Pipeline
+    path : str
+        Local CSV or Parquet file
+    outputs : dict
+        Output file -> whether rows with null values are dropped
+    engine : str
+        'polars' or 'duckdb' (requires the package)
+    chunksize : int
+        Number of rows per chunk when writing the outputs
+    compression, row_group_size :
+        Parquet options of streaming.run_chunked
+    verbose : bool
+        Whether to print the progress messages
+
+    Returns:
+    --------
+    N_rows, N_null : int
+        Number of rows written and number of rows with null values
+    """
+    if engine not in engine_classes:
+        raise ValueError(f'engine must be one of {list(engine_classes)}, not {engine!r}')
+    with tempfile.TemporaryDirectory() as directory:
+        backend = engine_classes[engine](pipeline, directory)
+        try:
+            return backend.run(path, outputs, chunksize, compression, row_group_size, verbose)
+        finally:
+            if engine == 'duckdb':
+                backend.con.close()
+
+#========================================================================================================================================
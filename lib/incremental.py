@@ -0,0 +1,367 @@
+import hashlib
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from lib.functions import parse_dates, PatientIdAllocator
+from lib.pipeline import Duplicates
+from lib.streaming import iter_chunks
+
+#=============================================================================================================================================
+
+# Incremental cleaning
+#
+# A local SQLite database keeps the cleaned latest record of each patient, the ID given to each row of the extract and a
+# high-water mark (the latest updated_at already processed). Each run only cleans the rows of the extract updated at or
+# after the mark and upserts them, so its cost grows with the rows changed since the last run, besides one scan of the
+# updated_at column. Rows at the mark are read again (the upsert only replaces older records, so this is harmless), and
+# rows whose updated_at is missing or not a date are read on every run and counted in the summary.
+#
+# Duplicates follow the rules of classify_duplicates, applied to the rows of the batch together with the stored rows of
+# the same IDs (the row of the extract, its birth date and the ID it got):
+#
+# - if all the rows of an ID have the same birth date, they are the same patient: they share its ID and the most recent
+#   record is kept
+# - otherwise each row is another patient: the first row of the extract keeps the ID and the others get a new one
+#
+# A row keeps the ID it got in earlier runs, so its next updates go to the same record, and the first run gives the same
+# table as a full clean. One case still differs from a full clean: when a row with another birth date appears for an ID
+# whose rows were merged into one patient by earlier runs, the earlier rows get their own IDs for their next updates, but
+# the merged record stays under the source ID until they are updated (a full clean splits it at once).
+#
+# The outlier limits (the state of the global steps) are computed on the first run and stored under a hash of the step
+# specification, so the flags of later rows use the same limits. A step whose specification is not in the store (added or
+# changed in pipeline.json) is fitted again on the whole extract read in chunks (see fit_stream); the stored records keep
+# the flags they were cleaned with until they are updated.
+#
+# The delta is cleaned as one table, so that duplicates are resolved over all of its rows: memory grows with the rows
+# changed since the last run, and on the first run (no high-water mark) with the whole extract, like a full clean in
+# memory.
+
+def _date_text(series):
+    """
+    Datetime column as ISO text (None for null values), the representation used in the database.
+    """
+    return series.dt.strftime('%Y-%m-%d %H:%M:%S.%f').astype(object).where(series.notna(), None)
+
+class StateStore:
+    """
+    SQLite database with the state of the incremental cleaning.
+
+    Tables:
+
+    - meta (key, value): high-water mark, state of the global steps and column types, as JSON
+    - id_map (source_id, row, birth, id_paciente): ID given to each row of the extract (row: position in the file)
+    - patients: cleaned latest record of each patient, one row per ID
+
+    Parameters:
+    -----------
+    path : str
+        Database file (created if it does not exist)
+    col : str
+        Name of the patient ID column
+    """
+
+    def __init__(self, path, col='id_paciente'):
+        self.path = path
+        self.col = col
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS id_map (source_id TEXT NOT NULL, row INTEGER NOT NULL, birth TEXT NOT NULL,
+                                               id_paciente TEXT NOT NULL, PRIMARY KEY (source_id, row));
+            CREATE INDEX IF NOT EXISTS id_map_id ON id_map (id_paciente);
+        ''')
+
+    def get(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set(self, key, value):
+        self.connection.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                                (key, json.dumps(value, default=float)))
+
+    @property
+    def high_water_mark(self):
+        """
+        Latest updated_at already processed (None before the first run).
+        """
+        mark = self.get('high_water_mark')
+        return pd.Timestamp(mark) if mark is not None else None
+
+    def close(self):
+        self.connection.close()
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def resolve_ids(self, df, birth_col, update_col, seed=None):
+        """
+        Resolves the duplicated IDs of a batch against the stored rows (see the rules above).
+
+        Parameters:
+        -----------
+        df : pandas.DataFrame
+            Cleaned batch (date columns in datetime), indexed by row position in the extract
+        birth_col : str
+            Name of the birth date column
+        update_col : str
+            Name of the last update column
+        seed : int, optional
+            Seed of the new IDs
+
+        Returns:
+        --------
+        df : pandas.DataFrame
+            One row per patient, with its final ID
+        """
+        col = self.col
+        batch = pd.DataFrame({'source_id': df[col].astype(str).to_numpy(), 'row': df.index.to_numpy(dtype=np.int64),
+                              'birth': _date_text(df[birth_col]).fillna('').to_numpy()})
+
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS batch (source_id TEXT)')
+        self.connection.execute('DELETE FROM batch')
+        self.connection.executemany('INSERT INTO batch VALUES (?)', ((i,) for i in batch['source_id'].unique()))
+        stored = pd.read_sql('SELECT m.source_id, m.row, m.birth, m.id_paciente FROM id_map m JOIN batch b '
+                             'ON m.source_id = b.source_id', self.connection)
+
+        # Rows of the batch (with the ID they got before, if any) and the stored rows of the same IDs, in extract order
+        batch = batch.merge(stored[['source_id', 'row', 'id_paciente']], on=['source_id', 'row'], how='left')
+        other = ~pd.MultiIndex.from_frame(stored[['source_id', 'row']]).isin(pd.MultiIndex.from_frame(batch[['source_id', 'row']]))
+        rows = pd.concat([batch.assign(in_batch=True), stored.loc[other].assign(in_batch=False)], ignore_index=True)
+        rows = rows.sort_values(['source_id', 'row'], kind='stable', ignore_index=True)
+        source, previous = rows['source_id'], rows['id_paciente']
+
+        birth = rows['birth'].where(rows['birth'] != '') # missing birth dates do not count as another date
+        mixed = (birth.groupby(source, sort=False).transform('nunique') > 1).to_numpy()
+
+        # Same birth date: one patient, under the ID its rows got before (the source ID for a new one)
+        ids = previous.groupby(source, sort=False).transform('first').fillna(source).to_numpy(dtype=object)
+
+        # Different birth dates: one patient per row, each row keeping its previous ID unless an earlier row has it
+        own = previous.where(~(previous.notna() & rows.duplicated(['source_id', 'id_paciente']))).to_numpy(dtype=object)
+        taken = pd.Series(own == source.to_numpy()).groupby(source.to_numpy(), sort=False).transform('any').to_numpy()
+        first = mixed & ~source.duplicated().to_numpy() & pd.isna(own) & ~taken # first row of a new shared ID
+        own[first] = source.to_numpy()[first]
+        reassign = mixed & pd.isna(own)
+        if reassign.any():
+            own[reassign] = self._new_ids(int(reassign.sum()), df[col], seed)
+        ids = np.where(mixed, own, ids)
+
+        changed = rows['in_batch'].to_numpy() | (ids != previous.to_numpy(dtype=object))
+        self.connection.executemany('INSERT INTO id_map VALUES (?, ?, ?, ?) ON CONFLICT (source_id, row) DO UPDATE SET '
+                                    'birth = excluded.birth, id_paciente = excluded.id_paciente',
+                                    zip(source[changed], rows['row'][changed].tolist(), rows['birth'][changed], ids[changed]))
+
+        # Same patient more than once in the batch: the most recent row is kept (the first one in case of a tie)
+        in_batch = rows['in_batch'].to_numpy()
+        resolved = pd.Series(ids[in_batch], index=rows['row'][in_batch].to_numpy())
+        df = df.copy()
+        df[col] = resolved.loc[df.index].to_numpy()
+        keys = pd.DataFrame({'id': df[col].to_numpy(), 'update': df[update_col].to_numpy(), 'position': np.arange(len(df))})
+        keys = keys.sort_values(['update', 'position'], ascending=[False, True], na_position='last', kind='stable')
+        return df.iloc[np.sort(keys['position'][~keys.duplicated('id')].to_numpy())]
+
+    def _new_ids(self, n, batch_ids, seed=None):
+        """
+        New IDs that collide neither with the IDs of the batch nor with the stored IDs.
+        """
+        allocator = PatientIdAllocator(batch_ids, seed)
+        ids = allocator.allocate(n)
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS candidates (id_paciente TEXT)')
+        while True:
+            self.connection.execute('DELETE FROM candidates')
+            self.connection.executemany('INSERT INTO candidates VALUES (?)', ((i,) for i in ids))
+            taken = {row[0] for row in self.connection.execute('SELECT c.id_paciente FROM candidates c JOIN id_map m '
+                                                                'ON c.id_paciente = m.id_paciente')}
+            if not taken:
+                return ids
+            ids = [i for i in ids if i not in taken] + allocator.allocate(len(taken))
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def upsert(self, df, update_col):
+        """
+        Inserts the patients of a batch, replacing the stored record of a patient only when the new one is more recent.
+
+        Parameters:
+        -----------
+        df : pandas.DataFrame
+            Cleaned batch with one row per patient (see resolve_ids)
+        update_col : str
+            Name of the last update column
+
+        Returns:
+        --------
+        int
+            Number of rows inserted or replaced
+        """
+        schema = self.get('schema')
+        if schema is None:
+            schema = {'datetime': [c for c in df.columns if pd.api.types.is_datetime64_any_dtype(df[c])],
+                      'category': [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)],
+                      'columns': list(df.columns)}
+            types = {c: 'INTEGER' if pd.api.types.is_integer_dtype(df[c]) else 'REAL' if pd.api.types.is_float_dtype(df[c]) else 'TEXT'
+                     for c in df.columns}
+            columns = ', '.join(f'"{c}" {types[c]}' for c in df.columns)
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS patients ({columns}, PRIMARY KEY ("{self.col}"))')
+            self.set('schema', schema)
+
+        columns = schema['columns']
+        values = df[columns].astype(object)
+        for c in schema['datetime']:
+            values[c] = _date_text(df[c])
+        values = values.where(df[columns].notna(), None)
+
+        names = ', '.join(f'"{c}"' for c in columns)
+        updates = ', '.join(f'"{c}" = excluded."{c}"' for c in columns if c != self.col)
+        before = self.connection.total_changes
+        self.connection.executemany(
+            f'INSERT INTO patients ({names}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT ("{self.col}") DO UPDATE SET {updates} '
+            f'WHERE patients."{update_col}" IS NULL OR excluded."{update_col}" > patients."{update_col}"',
+            values.itertuples(index=False))
+        return self.connection.total_changes - before
+
+    def load(self):
+        """
+        Reads the stored cleaned table, with the column types of the cleaned batches.
+
+        Returns:
+        --------
+        pandas.DataFrame
+        """
+        schema = self.get('schema')
+        if schema is None:
+            return pd.DataFrame()
+
+        df = pd.read_sql('SELECT * FROM patients ORDER BY rowid', self.connection)
+        for c in schema['datetime']:
+            df[c] = pd.to_datetime(df[c])
+        for c in schema['category']:
+            df[c] = df[c].astype('category')
+        return df
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def _state_key(step):
+    """
+    Key of the stored state of a global step: a hash of its name and arguments (the progress message and the limits file
+    left out), so that a state is only reused by the same step, wherever it is in the specification.
+    """
+    spec = {'step': step.name, **{key: value for key, value in step.kwargs.items() if key not in ('message', 'limits_file')}}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+def read_delta(path, mark, chunksize, update_col='updated_at'):
+    """
+    Reads the rows of the extract updated at or after the high-water mark, and the rows whose update time is missing or
+    not a date (they cannot be compared with the mark, so they are read on every run).
+
+    The file is scanned in chunks but the delta is returned as one table: without a mark (first run) it holds the whole
+    extract.
+
+    Parameters:
+    -----------
+    path : str
+        Path or URL of the CSV or Parquet file
+    mark : pandas.Timestamp or None
+        High-water mark (every row is read when None)
+    chunksize : int
+        Number of rows per chunk
+    update_col : str
+        Name of the column compared with the mark
+
+    Returns:
+    --------
+    delta : pandas.DataFrame or None
+        Rows of the delta, indexed by global row position (None when there are none)
+    N_undated : int
+        Number of rows whose update time is missing or not a date
+    """
+    delta, N_undated = [], 0
+    for chunk in iter_chunks(path, chunksize):
+        updated = parse_dates(chunk[update_col])
+        N_undated += int(updated.isna().sum())
+        if mark is not None:
+            chunk = chunk.loc[((updated >= mark) | updated.isna()).to_numpy()]
+        if len(chunk):
+            delta.append(chunk)
+    return (pd.concat(delta) if delta else None), N_undated
+
+def run_incremental(pipeline, path, store_path, chunksize=100_000, update_col='updated_at', seed=None, verbose=False,
+                    profiler=None):
+    """
+    Cleans the rows of the extract updated since the last run and upserts them into the state store. The rows updated
+    since the last run are cleaned in memory, so the first run needs the memory of a full clean (see read_delta).
+
+    Parameters:
+    -----------
+    pipeline : Pipeline
+        Cleaning pipeline (its duplicates step is replaced by the resolution against the store)
+    path : str
+        Path or URL of the CSV or Parquet file
+    store_path : str
+        SQLite database of the state store
+    chunksize : int
+        Number of rows per chunk when reading the extract
+    update_col : str
+        Column used for the high-water mark
+    seed : int, optional
+        Seed of the new IDs
+    verbose : bool
+        Whether to print the progress messages
+    profiler : profiling.Profiler, optional
+        Records the time, memory and changes of each step
+
+    Returns:
+    --------
+    N_delta : int
+        Number of rows updated since the last run
+    N_upserted : int
+        Number of patients inserted or replaced
+    N_undated : int
+        Number of rows whose update time is missing or not a date (part of the delta of every run)
+    """
+    store = StateStore(store_path)
+    try:
+        mark = store.high_water_mark
+        if verbose: print(f'High-water mark: {mark}' if mark is not None else 'No high-water mark, cleaning the whole table.')
+
+        delta, N_undated = read_delta(path, mark, chunksize, update_col)
+        if delta is None:
+            return 0, 0, N_undated
+
+        duplicates = next(step for step in pipeline.steps if isinstance(step, Duplicates))
+
+        stored = store.get('states', {}) # hash of the step specification -> state, computed on the first run
+        states, kept = {}, {}
+        for step in pipeline.steps:
+            if isinstance(step, Duplicates):
+                states[step.position] = (pd.Index([]), pd.Series([], dtype=object), None) # resolved against the store
+            elif step.is_global:
+                key = _state_key(step)
+                if key not in stored:
+                    if mark is None:
+                        stored[key] = step.fit(delta)
+                    else:
+                        if verbose: print(f'{step!r} is not in the state store (new or changed), fitting it on the whole extract.')
+                        stored[key] = step.fit_stream(path, chunksize)
+                    if verbose: print(step.summary(stored[key]))
+                states[step.position] = kept[key] = stored[key]
+        store.set('states', kept)
+
+        cleaned = pipeline.run(delta, states=states, verbose=verbose, profiler=profiler)
+        cleaned = store.resolve_ids(cleaned, duplicates.birth_col, duplicates.update_col, seed)
+        N_upserted = store.upsert(cleaned, duplicates.update_col)
+
+        new_mark = cleaned[update_col].max()
+        if pd.notna(new_mark) and (mark is None or new_mark > mark):
+            store.set('high_water_mark', new_mark.isoformat())
+
+        store.connection.commit()
+        return len(delta), N_upserted, N_undated
+
+    finally:
+        store.close()
+
+#========================================================================================================================================
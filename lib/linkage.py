@@ -0,0 +1,390 @@
+import numpy as np
+import pandas as pd
+
+from lib.functions import parse_dates
+
+#=============================================================================================================================================
+
+# Record linkage
+#
+# The duplicates step only fixes rows that share an id_paciente. The same person registered twice under different IDs is
+# found here, on the cleaned table, in three vectorized passes:
+#
+# - blocking: the rows are grouped by a blocking key (birth date, sex and neighbourhood by default) and only the pairs of
+#   rows of the same block are compared, so the number of candidate pairs grows with the number of rows times the size
+#   of the blocks instead of with its square. Several blockings can be given (e.g. one with the CF/CMS health unit of
+#   the patient, for extracts that have it), their pairs are scored separately. Blocks larger than max_block (usually
+#   a placeholder value shared by many rows) are skipped and counted.
+# - scoring: each pair gets a Fellegi-Sunter match weight, the sum over the compared fields of log2(m / u) when the two
+#   rows agree and log2((1 - m) / (1 - u)) when they do not (0 when either value is missing). m is the probability that
+#   the field agrees for two records of the same patient (given), u the probability that it agrees for two different
+#   patients (estimated on random pairs of rows). A weight of s means that the pattern of agreements is 2^s times more
+#   likely for the same patient than for two different ones. The fields are compared through integer codes (or a
+#   tolerance, for numbers), over batches of at most batch_pairs pairs.
+# - clustering: the pairs above the threshold are the edges of a graph whose connected components are the patients.
+#   The canonical ID of a cluster is the ID of its most recently updated row, like the row kept by the duplicates step.
+
+# Columns of each blocking key
+blocking = [['data_nascimento', 'sexo', 'bairro']]
+
+# Compared field -> m probability and, for numeric fields, the largest difference that still agrees
+comparisons = {
+    'raca_cor': {'m': 0.95},
+    'escolaridade': {'m': 0.9},
+    'religiao': {'m': 0.9},
+    'nacionalidade': {'m': 0.99},
+    'identidade_genero': {'m': 0.9},
+    'orientacao_sexual': {'m': 0.9},
+    'ocupacao': {'m': 0.85},
+    'doencas_condicoes': {'m': 0.8},
+    'altura': {'m': 0.9, 'tolerance': 3},
+}
+
+def _codes(series):
+    """
+    Integer code of each value (-1 for null values, int32 to halve the memory of the compared fields) and number of
+    distinct values.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy().astype(np.int32), len(series.cat.categories)
+    codes, uniques = pd.factorize(series)
+    return codes.astype(np.int32), len(uniques)
+
+def _dates(series):
+    """
+    Date column in datetime; text dates (also categorical) are parsed once per distinct value.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        parsed = parse_dates(pd.Series(series.cat.categories, dtype=object)).to_numpy()
+        return pd.Series(np.append(parsed, np.datetime64('NaT', 'ns'))[series.cat.codes.to_numpy()], index=series.index)
+    return parse_dates(series)
+
+def block_ids(df, cols):
+    """
+    Block of each row: one integer per distinct combination of the key columns, -1 when any of them is null.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    cols : list of str
+        Columns of the blocking key
+
+    Returns:
+    --------
+    numpy.ndarray of int64
+    """
+    key = np.zeros(len(df), dtype=np.int64)
+    null = np.zeros(len(df), dtype=bool)
+    for col in cols:
+        codes, size = _codes(df[col])
+        null |= codes < 0
+        key, _ = pd.factorize(key * (size + 1) + codes.astype(np.int64)) # renumbered after each column, so it never overflows
+        key = key.astype(np.int64)
+    key[null] = -1
+    return key
+
+def candidate_pairs(blocks, max_block=1000, batch_pairs=5_000_000):
+    """
+    Pairs of rows of the same block, in batches of whole blocks.
+
+    Parameters:
+    -----------
+    blocks : numpy.ndarray of int64
+        Block of each row (see block_ids), -1 for rows without a block
+    max_block : int
+        Blocks with more rows are skipped
+    batch_pairs : int
+        Approximate number of pairs per batch (a single block can go over it)
+
+    Returns:
+    --------
+    batches : generator
+        (left, right) row positions of each batch, left < right
+    skipped : dict
+        Number of blocks and of rows skipped for being larger than max_block
+    """
+    order = np.argsort(blocks, kind='stable')
+    sorted_blocks = blocks[order]
+    starts = np.flatnonzero(np.r_[True, sorted_blocks[1:] != sorted_blocks[:-1]]) if len(blocks) else np.array([], dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(blocks)])
+
+    valid = (sorted_blocks[starts] >= 0) if len(blocks) else np.array([], dtype=bool)
+    large = valid & (sizes > max_block)
+    skipped = {'blocks': int(large.sum()), 'rows': int(sizes[large].sum())}
+    compared = valid & ~large & (sizes > 1)
+    starts, sizes = starts[compared], sizes[compared]
+
+    pairs = sizes * (sizes - 1) // 2
+    batch = np.cumsum(pairs) // max(batch_pairs, 1) # batch of each block
+
+    firsts = np.flatnonzero(np.r_[True, batch[1:] != batch[:-1]]) if len(batch) else np.array([], dtype=np.int64)
+
+    def batches():
+        for first, last in zip(firsts, np.r_[firsts[1:], len(batch)]):
+            block_starts, block_sizes = starts[first:last], sizes[first:last]
+            # Every row of the batch with the rows after it in its block
+            position = np.repeat(block_starts, block_sizes) + (np.arange(block_sizes.sum()) -
+                                                              np.repeat(np.cumsum(block_sizes) - block_sizes, block_sizes))
+            end = np.repeat(block_starts + block_sizes, block_sizes)
+            counts = end - position - 1
+            left = np.repeat(position, counts)
+            right = left + 1 + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+            yield order[left], order[right]
+
+    return batches(), skipped
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def comparison_fields(df, comparisons=comparisons):
+    """
+    Values of the compared fields prepared for the pair comparisons: integer codes for the exact comparisons, floats
+    for the numeric ones. Fields missing from the table are skipped.
+
+    Returns:
+    --------
+    dict
+        Field -> (values, tolerance or None, m)
+    """
+    fields = {}
+    for col, options in comparisons.items():
+        if col not in df.columns:
+            continue
+        tolerance = options.get('tolerance')
+        if tolerance is not None:
+            values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float32)
+        else:
+            values = _codes(df[col])[0]
+        fields[col] = (values, tolerance, options['m'])
+    return fields
+
+def _agreement(values, tolerance, left, right):
+    """
+    Whether each pair agrees on a field and whether both of its values are present.
+    """
+    a, b = values[left], values[right]
+    if tolerance is not None:
+        present = ~(np.isnan(a) | np.isnan(b))
+        return np.abs(a - b) <= tolerance, present
+    return a == b, (a >= 0) & (b >= 0)
+
+def match_weights(fields, sample=1_000_000, seed=0):
+    """
+    Agreement and disagreement weights of each field, with u estimated on random pairs of rows.
+
+    Parameters:
+    -----------
+    fields : dict
+        See comparison_fields
+    sample : int
+        Number of random pairs
+    seed : int
+
+    Returns:
+    --------
+    dict
+        Field -> (weight when the values agree, weight when they do not, u)
+    """
+    n = len(next(iter(fields.values()))[0]) if fields else 0
+    rng = np.random.default_rng(seed)
+    left, right = rng.integers(0, max(n, 1), (2, sample if n > 1 else 0))
+    different = left != right
+    left, right = left[different], right[different]
+
+    weights = {}
+    for col, (values, tolerance, m) in fields.items():
+        agree, present = _agreement(values, tolerance, left, right)
+        u = agree[present].mean() if present.any() else 0.5
+        u = min(max(u, 1e-6), 1 - 1e-6)
+        if u >= m: # agreeing is not more likely for the same patient (e.g. a column with a single value): no weight
+            weights[col] = (0.0, 0.0, u)
+        else:
+            weights[col] = (np.log2(m / u), np.log2((1 - m) / (1 - u)), u)
+    return weights
+
+def score_pairs(fields, weights, left, right):
+    """
+    Match weight of each pair: sum of the weights of the fields (see the notes above).
+
+    Returns:
+    --------
+    numpy.ndarray of float32
+    """
+    score = np.zeros(len(left), dtype=np.float32)
+    for col, (values, tolerance, m) in fields.items():
+        agree, present = _agreement(values, tolerance, left, right)
+        agree_weight, disagree_weight, _ = weights[col]
+        score += np.where(present, np.where(agree, agree_weight, disagree_weight), 0).astype(np.float32)
+    return score
+
+def connected_components(left, right):
+    """
+    Connected components of the graph whose edges are the pairs, by label propagation with pointer jumping (each
+    round is a few vectorized passes over the edges).
+
+    Returns:
+    --------
+    nodes : numpy.ndarray
+        Rows that are in at least one pair, sorted
+    labels : numpy.ndarray
+        Component of each node (the position in nodes of its smallest node)
+    """
+    nodes = np.unique(np.concatenate([left, right]))
+    left, right = np.searchsorted(nodes, left), np.searchsorted(nodes, right)
+    labels = np.arange(len(nodes))
+    while True:
+        smallest = np.minimum(labels[left], labels[right])
+        new = labels.copy()
+        np.minimum.at(new, left, smallest)
+        np.minimum.at(new, right, smallest)
+        new = new[new]
+        if np.array_equal(new, labels):
+            return nodes, labels
+        labels = new
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def read_columns(path, columns, numeric=()):
+    """
+    Reads only the given columns of a cleaned table (CSV, Parquet or SQLite, by extension), the text columns as
+    categorical. Columns missing from the file are left out.
+
+    Parameters:
+    -----------
+    path : str
+        Cleaned table (CSV with ';' or ',' as separator)
+    columns : list of str
+    numeric : list of str
+        Columns read as numbers
+
+    Returns:
+    --------
+    pandas.DataFrame
+    """
+    lower = str(path).lower()
+    if lower.endswith(('.parquet', '.pq')):
+        import pyarrow as pa # requires pyarrow
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names
+        table = pq.read_table(path, columns=[c for c in columns if c in names])
+        for i, field in enumerate(table.schema): # list columns: their items joined, to be compared as one value
+            if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+                table = table.set_column(i, field.name, pc.binary_join(table.column(i), '\x1f'))
+        df = table.to_pandas()
+    elif lower.endswith(('.sqlite', '.sqlite3', '.db')):
+        import sqlite3
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True) # fails instead of creating a missing file
+        try:
+            names = [row[1] for row in connection.execute('PRAGMA table_info(patients)')] # list columns are in child tables
+            selected = ', '.join('"' + c + '"' for c in columns if c in names)
+            df = pd.read_sql(f'SELECT {selected} FROM patients ORDER BY rowid', connection)
+        finally:
+            connection.close()
+    else:
+        with open(path, encoding='utf-8') as file:
+            sep = ';' if ';' in file.readline() else ','
+        df = pd.read_csv(path, sep=sep, decimal=',' if sep == ';' else '.', usecols=lambda c: c in columns,
+                         dtype={c: 'category' for c in columns if c not in numeric}, engine='c')
+
+    for c in df.columns:
+        if c not in numeric and not isinstance(df[c].dtype, pd.CategoricalDtype) and not pd.api.types.is_datetime64_any_dtype(df[c]):
+            df[c] = df[c].astype('category')
+    return df
+
+def link_records(df, col='id_paciente', update_col='data_atualizacao_cadastro', blocking=blocking, comparisons=comparisons,
+                 threshold=8.0, max_block=1000, batch_pairs=5_000_000, sample=1_000_000, seed=0):
+    """
+    Finds the patients registered more than once under different IDs (see the notes above).
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Cleaned table (only the ID, update, blocking and compared columns are used)
+    col : str
+        Name of the patient ID column
+    update_col : str
+        Column that chooses the canonical ID of a cluster (the ID of the most recent row, the first one in case of a tie)
+    blocking : list of list of str
+        Columns of each blocking key
+    comparisons : dict
+        Compared field -> {'m': probability, 'tolerance': largest difference of a numeric field}
+    threshold : float
+        Smallest match weight of a link
+    max_block : int
+        Blocks with more rows are skipped
+    batch_pairs : int
+        Number of pairs scored at a time
+    sample : int
+        Number of random pairs used to estimate the u probabilities
+    seed : int
+        Seed of the random pairs
+
+    Returns:
+    --------
+    clusters : pandas.DataFrame
+        One line per row in a cluster of 2 or more rows (same index as df), with columns col, cluster (number of the
+        cluster), canonical_id and score (largest match weight of the row)
+    links : pandas.DataFrame
+        Pairs above the threshold: left and right (index labels of the rows), left_id, right_id and score
+    summary : dict
+        Numbers of rows, candidate pairs, skipped blocks and rows, links, clusters, linked rows and patients
+    """
+    missing = [c for key in blocking for c in key if c not in df.columns]
+    if missing:
+        raise KeyError(f'Blocking columns not found in the table: {missing}')
+
+    fields = comparison_fields(df, comparisons)
+    weights = match_weights(fields, sample, seed)
+
+    lefts, rights, scores = [], [], []
+    summary = {'rows': len(df), 'candidate_pairs': 0, 'skipped_blocks': 0, 'skipped_rows': 0}
+    for key in blocking:
+        batches, skipped = candidate_pairs(block_ids(df, key), max_block, batch_pairs)
+        summary['skipped_blocks'] += skipped['blocks']
+        summary['skipped_rows'] += skipped['rows']
+        for left, right in batches:
+            summary['candidate_pairs'] += len(left)
+            score = score_pairs(fields, weights, left, right)
+            linked = score >= threshold
+            lefts.append(left[linked])
+            rights.append(right[linked])
+            scores.append(score[linked])
+
+    left = np.concatenate(lefts) if lefts else np.array([], dtype=np.int64)
+    right = np.concatenate(rights) if rights else np.array([], dtype=np.int64)
+    score = np.concatenate(scores) if scores else np.array([], dtype=np.float32)
+
+    # Pairs found by more than one blocking: counted once
+    pair = pd.DataFrame({'left': left, 'right': right, 'score': score}).drop_duplicates(['left', 'right'])
+    left, right, score = (pair[c].to_numpy() for c in ('left', 'right', 'score'))
+
+    ids = df[col].to_numpy()
+    links = pd.DataFrame({'left': df.index[left], 'right': df.index[right], 'left_id': ids[left], 'right_id': ids[right],
+                          'score': score})
+
+    nodes, labels = connected_components(left, right)
+    cluster = np.unique(labels, return_inverse=True)[1]
+
+    # Canonical ID: most recent row of each cluster (null dates last, then the first row)
+    update = np.full(len(nodes), np.iinfo(np.int64).min) # null dates: smallest
+    if update_col in df.columns:
+        dates = _dates(df[update_col]).to_numpy(dtype='datetime64[ns]')[nodes]
+        update[~np.isnat(dates)] = dates[~np.isnat(dates)].view(np.int64)
+    order = np.lexsort((nodes, ~update, cluster)) # ~update: most recent first, without overflow
+    first = order[np.r_[True, cluster[order][1:] != cluster[order][:-1]]] if len(order) else order
+    canonical = ids[nodes[first]][cluster]
+
+    best = np.full(len(nodes), -np.inf, dtype=np.float32)
+    np.maximum.at(best, np.searchsorted(nodes, left), score)
+    np.maximum.at(best, np.searchsorted(nodes, right), score)
+
+    clusters = pd.DataFrame({col: ids[nodes], 'cluster': cluster, 'canonical_id': canonical, 'score': best},
+                            index=df.index[nodes])
+
+    summary.update({'links': len(links), 'clusters': int(cluster.max()) + 1 if len(cluster) else 0, 'linked_rows': len(nodes)})
+    summary['patients'] = summary['rows'] - summary['linked_rows'] + summary['clusters']
+    return clusters, links, summary
+
+#========================================================================================================================================
@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+from lib.functions import parse_dates
+
+#=============================================================================================================================================
+
+# Typed loader of the raw extract
+#
+# pd.read_csv infers the types: every text column is read as object, with one Python string per row, and the booleans and
+# dates are converted later by the pipeline. The loader reads the extract with an explicit schema instead:
+#
+# - low-cardinality text columns, the list columns, the booleans and the dates are read dictionary encoded (categorical),
+#   so each distinct text is stored once
+# - booleans ('0' / '1' / 'True' / 'False') are converted to int8 on their distinct values, so boolean_to_int has
+#   nothing left to do
+# - dates are parsed on their distinct values with parse_dates (the same rules as standardize_date)
+# - numeric columns are parsed by the reader
+# - only the requested columns are read (see Pipeline.input_columns)
+#
+# The CSV file is parsed by pyarrow's multithreaded reader when pyarrow is installed, by the pandas C parser otherwise.
+# Values that do not match the schema (unknown booleans, invalid dates or numbers) become null and are listed in the
+# validation report, as well as the missing and unexpected columns.
+
+# Column -> kind ('string', 'category', 'boolean', 'datetime', 'int' or 'float')
+schema = {
+    'id_paciente': 'string',
+    'sexo': 'category',
+    'obito': 'boolean',
+    'bairro': 'category',
+    'raca_cor': 'category',
+    'ocupacao': 'string',
+    'religiao': 'category',
+    'luz_eletrica': 'boolean',
+    'data_cadastro': 'datetime',
+    'escolaridade': 'category',
+    'nacionalidade': 'category',
+    'renda_familiar': 'category',
+    'data_nascimento': 'datetime',
+    'em_situacao_de_rua': 'boolean',
+    'frequenta_escola': 'int',
+    'meios_transporte': 'category',
+    'doencas_condicoes': 'category',
+    'identidade_genero': 'category',
+    'meios_comunicacao': 'category',
+    'orientacao_sexual': 'category',
+    'possui_plano_saude': 'boolean',
+    'em_caso_doenca_procura': 'category',
+    'situacao_profissional': 'category',
+    'vulnerabilidade_social': 'boolean',
+    'data_atualizacao_cadastro': 'datetime',
+    'familia_beneficiaria_auxilio_brasil': 'boolean',
+    'crianca_matriculada_creche_pre_escola': 'boolean',
+    'altura': 'float',
+    'peso': 'float',
+    'pressao_sistolica': 'float',
+    'pressao_diastolica': 'float',
+    'n_atendimentos_atencao_primaria': 'int',
+    'n_atendimentos_hospital': 'int',
+    'updated_at': 'datetime',
+    'tipo': 'category',
+}
+
+boolean_values = {'True': 1, 'False': 0, '1': 1, '0': 0, 'true': 1, 'false': 0}
+
+# Same null markers as pandas.read_csv
+null_values = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+               'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+report_columns = ['column', 'problem', 'rows', 'first_rows', 'examples']
+
+def _problem(report, col, problem, rows, values):
+    """
+    Adds a line to the validation report for the rows (positions) of a column with a problem.
+    """
+    if len(rows):
+        report.append({'column': col, 'problem': problem, 'rows': len(rows), 'first_rows': [int(row) for row in rows[:5]],
+                       'examples': list(pd.unique(np.asarray(values, dtype=object)))[:5]})
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Conversions applied on the distinct values of the dictionary encoded columns
+
+def _booleans(series, report):
+    categories = pd.Series(series.cat.categories, dtype=object)
+    labels = categories.map(boolean_values).to_numpy(dtype=float)
+    codes = series.cat.codes.to_numpy()
+
+    invalid = np.isnan(labels)
+    if invalid.any():
+        rows = np.flatnonzero(invalid[codes] & (codes != -1))
+        _problem(report, series.name, 'invalid boolean', rows, categories.to_numpy()[codes[rows]])
+
+    values = np.append(labels, np.nan)[codes]
+    if np.isnan(values).any():
+        return pd.Series(values, index=series.index, name=series.name).astype('Int8')
+    return pd.Series(values.astype(np.int8), index=series.index, name=series.name)
+
+def _dates(series, report):
+    categories = pd.Series(series.cat.categories, dtype=object)
+    parsed = parse_dates(categories).to_numpy()
+    codes = series.cat.codes.to_numpy()
+
+    invalid = np.isnat(parsed)
+    if invalid.any():
+        rows = np.flatnonzero(invalid[codes] & (codes != -1))
+        _problem(report, series.name, 'invalid date', rows, categories.to_numpy()[codes[rows]])
+
+    values = np.append(parsed, np.datetime64('NaT', 'ns'))[codes]
+    return pd.Series(values, index=series.index, name=series.name)
+
+def _numbers(series, kind, report):
+    """
+    Numeric column read as text (after the reader failed to parse it): invalid values become null and are reported.
+    """
+    numbers = pd.to_numeric(series, errors='coerce')
+    rows = np.flatnonzero((numbers.isna() & series.notna()).to_numpy())
+    _problem(report, series.name, 'invalid number', rows, series.to_numpy()[rows])
+    if kind == 'int' and not numbers.isna().any():
+        numbers = numbers.astype(np.int64)
+    return numbers
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def _read_arrow(path, columns, kinds, numbers_as_text):
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    arrow_types = {'string': pa.string(), 'category': pa.dictionary(pa.int32(), pa.string()),
+                   'boolean': pa.dictionary(pa.int32(), pa.string()), 'datetime': pa.dictionary(pa.int32(), pa.string()),
+                   'int': pa.int64(), 'float': pa.float64()}
+    types = {col: pa.string() if numbers_as_text and kind in ('int', 'float') else arrow_types[kind] for col, kind in kinds.items()}
+    options = csv.ConvertOptions(column_types=types, include_columns=columns, null_values=null_values,
+                                 strings_can_be_null=True)
+    return _arrow_columns(csv.read_csv(path, convert_options=options))
+
+def _arrow_columns(table):
+    """
+    Converts an Arrow table to pandas one column at a time, releasing each Arrow column once converted, so that the
+    table is never held twice in memory.
+    """
+    for name in table.column_names:
+        column = table.column(name)
+        table = table.drop_columns([name])
+        yield name, column.to_pandas().rename(name)
+
+def _read_pandas(path, columns, kinds, numbers_as_text):
+    # Integer columns are read as float (they may have null values) and converted back below when they have none
+    pandas_types = {'string': object, 'category': 'category', 'boolean': 'category', 'datetime': 'category',
+                    'int': np.float64, 'float': np.float64}
+    dtype = {col: object if numbers_as_text and kind in ('int', 'float') else pandas_types[kind] for col, kind in kinds.items()}
+    df = pd.read_csv(path, usecols=columns, dtype=dtype)
+    for col, kind in kinds.items():
+        if kind == 'int' and not numbers_as_text and df[col].notna().all():
+            df[col] = df[col].astype(np.int64)
+    return ((col, df.pop(col)) for col in list(df.columns))
+
+def load_raw(path, columns=None, engine='pyarrow', schema=schema):
+    """
+    Reads the raw extract with an explicit schema (see the notes above).
+
+    Parameters:
+    -----------
+    path : str
+        Local CSV file
+    columns : list, optional
+        Columns to read (all the columns of the file by default)
+    engine : str
+        'pyarrow' (multithreaded, used only if pyarrow is installed) or 'c' (pandas parser)
+    schema : dict
+        Column -> kind ('string', 'category', 'boolean', 'datetime', 'int' or 'float')
+
+    Returns:
+    --------
+    df : pandas.DataFrame
+    report : pandas.DataFrame
+        Validation report, one line per column and problem, with columns column, problem, rows (number of rows),
+        first_rows (positions of the first rows) and examples (some of the values). Empty when everything matches.
+    """
+    report = []
+
+    header = list(pd.read_csv(path, nrows=0).columns)
+    for col in schema:
+        if col not in header and (columns is None or col in columns):
+            report.append({'column': col, 'problem': 'missing column', 'rows': 0, 'first_rows': [], 'examples': []})
+    for col in header:
+        if col not in schema and (columns is None or col in columns):
+            report.append({'column': col, 'problem': 'unexpected column', 'rows': 0, 'first_rows': [], 'examples': []})
+
+    if columns is not None:
+        absent = [col for col in columns if col not in header]
+        if absent:
+            raise KeyError(f'Columns not found in {path}: {absent}')
+    columns = [col for col in header if columns is None or col in columns]
+    kinds = {col: schema.get(col, 'string') for col in columns}
+
+    if engine == 'pyarrow':
+        try:
+            import pyarrow as pa
+            read = _read_arrow
+            errors = (pa.ArrowInvalid,)
+        except ImportError:
+            engine = 'c'
+    if engine == 'c':
+        read = _read_pandas
+        errors = (ValueError,)
+
+    try:
+        read_columns = read(path, columns, kinds, numbers_as_text=False)
+        numbers_as_text = False
+    except errors: # a numeric column has values that are not numbers: read as text and converted below
+        read_columns = read(path, columns, kinds, numbers_as_text=True)
+        numbers_as_text = True
+
+    # Converted as they are read, so that only one column is held both raw and converted at a time
+    converted = {}
+    for col, series in read_columns:
+        kind = kinds[col]
+        if kind == 'boolean':
+            series = _booleans(series, report)
+        elif kind == 'datetime':
+            series = _dates(series, report)
+        elif kind in ('int', 'float') and numbers_as_text:
+            series = _numbers(series, kind, report)
+        converted[col] = series
+
+    return pd.DataFrame(converted), pd.DataFrame(report, columns=report_columns)
+
+def print_report(report, path=''):
+    """
+    Prints the validation report of load_raw.
+    """
+    if report.empty:
+        print(f'{path} matches the schema.' if path else 'The table matches the schema.')
+        return
+    print('Values that do not match the schema (set to null):')
+    for _, row in report.iterrows():
+        if row['problem'] in ('missing column', 'unexpected column'):
+            print(f"    {row['column']}: {row['problem']}")
+        else:
+            print(f"    {row['column']}: {row['rows']} rows with {row['problem']} values, e.g. {row['examples'][:3]} "
+                  f"(rows {row['first_rows']})")
+
+#========================================================================================================================================
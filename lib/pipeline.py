@@ -0,0 +1,941 @@
+import contextlib
+import inspect
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import lib.functions as functions
+import lib.streaming as streaming
+from lib.functions import LRUCache, map_unique
+from lib.loader import schema as raw_schema
+from lib.profiling import Profiler
+from lib.sketch import KLLSketch
+
+#=============================================================================================================================================
+
+# Declarative cleaning pipeline
+#
+# A pipeline is a list of steps read from a specification (a dictionary or a JSON file, see pipeline.json). Each step is a
+# function of lib/functions.py, which declares the columns it reads and writes (see functions.declares), or one of the global
+# steps below, which need information from the whole table. From the declarations the pipeline:
+#
+# - builds the dependency graph between the steps
+# - drops the steps that are not needed for the requested columns
+# - fuses consecutive steps that transform the same column value by value into a single pass over the distinct values
+#
+# The same pipeline can run on a table in memory (run), on a file read in chunks (run_chunked) or on row shards processed
+# by several worker processes (run_parallel).
+
+def _columns(template, args):
+    """
+    Resolves a column declaration with the arguments of the call (see functions.declares).
+    """
+    if callable(template):
+        return list(template(args))
+
+    columns = []
+    for item in template:
+        name = item[1:-1] if item.startswith('{') and item.endswith('}') else None
+        if name in args and isinstance(args[name], (list, tuple)):
+            columns.extend(args[name])
+        else:
+            columns.append(item.format(**args))
+    return columns
+
+def _types(declaration, args):
+    """
+    Resolves the column types declared by a step with the arguments of the call (see functions.declares).
+    """
+    if callable(declaration):
+        return dict(declaration(args))
+    return {col: kind for template, kind in declaration.items() for col in _columns([template], args)}
+
+def _from_json(value):
+    """
+    Converts JSON null values inside lists to NaN, so that they match the null values of the table.
+    """
+    if isinstance(value, list):
+        return [np.nan if item is None else _from_json(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _from_json(item) for key, item in value.items()}
+    return value
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Steps
+
+class Step:
+    """
+    Call of a cleaning function of lib/functions.py.
+
+    Parameters:
+    -----------
+    name : str
+        Name of the function
+    kwargs : dict
+        Arguments of the call (besides the DataFrame)
+    message : str, optional
+        Progress message printed before the step
+    """
+
+    is_global = False
+    changes_rows = False
+
+    def __init__(self, name, kwargs, message=None):
+        self.name = name
+        self.kwargs = kwargs
+        self.message = message
+        self.func = getattr(functions, name)
+
+        signature = inspect.signature(self.func)
+        args = signature.bind_partial(**kwargs)
+        args.apply_defaults()
+        self.args = dict(args.arguments)
+
+        self.reads = _columns(self.func.reads, self.args)
+        self.writes = _columns(self.func.writes, self.args)
+        self.types = _types(self.func.types, self.args)
+        self.cache = LRUCache() if 'cache' in signature.parameters else None
+        self.report = {} if 'report' in signature.parameters else None
+        self.weighted = 'weights' in signature.parameters
+
+        # Built here so that invalid arguments (e.g. conflicting replacement rules) fail when the pipeline is loaded
+        self._value_func = self.func.value_func(self.args) if self.func.value_func is not None else None
+
+    @property
+    def value_func(self):
+        """
+        Function applied to each value, for steps that transform a single column value by value (None otherwise).
+        Steps that report what they did are fused only if their report can count weighted rows (see FusedMap).
+        """
+        if self._value_func is None or self.reads != self.writes or len(self.writes) != 1:
+            return None
+        if self.report is not None and not self.weighted:
+            return None
+        return self._value_func
+
+    def run(self, df, state=None, weights=None):
+        """
+        Runs the step. weights (number of rows each row of df stands for, e.g. when df holds distinct values) is passed
+        to the steps that report what they did, so that their report counts rows.
+        """
+        kwargs = dict(self.kwargs)
+        if self.cache is not None:
+            kwargs['cache'] = self.cache
+        if self.report is not None:
+            kwargs['report'] = self.report
+            if weights is not None and self.weighted:
+                kwargs['weights'] = weights
+        return self.func(df, **kwargs)
+
+    def __repr__(self):
+        return f'{self.name}({", ".join(f"{key}={value!r}" for key, value in self.kwargs.items())})'
+
+class FusedMap:
+    """
+    Consecutive value by value steps on the same column, applied in a single pass over its distinct values. The steps
+    that report what they did (e.g. replace_values with the raw renda_familiar rule, followed by
+    transform_family_income) also run on the distinct values, weighted by their number of rows, so that their reports
+    count the same rows as when they run alone.
+
+    Parameters:
+    -----------
+    steps : list of Step
+    """
+
+    is_global = False
+    changes_rows = False
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.col = steps[0].writes[0]
+        self.reads = self.writes = [self.col]
+        self.types = {col: kind for step in steps for col, kind in step.types.items()}
+        self.message = steps[0].message
+        self.cache = LRUCache()
+
+        funcs = [step.value_func for step in steps]
+        self.reported = max((i + 1 for i, step in enumerate(steps) if step.report is not None), default=0)
+
+        def fused(value):
+            for func in funcs:
+                value = func(value)
+            return value
+
+        self.value_func = fused
+
+    def _report(self, series, weights=None):
+        """
+        Runs the steps up to the last one that reports on the distinct values of the column, with their number of rows
+        as weights.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            uniques = list(series.cat.categories) + [np.nan]
+            codes = series.cat.codes.to_numpy()
+            codes = np.where(codes == -1, len(uniques) - 1, codes)
+        else:
+            codes, uniques = pd.factorize(series, use_na_sentinel=False)
+
+        counts = np.bincount(codes, weights=weights, minlength=len(uniques))
+        values = pd.DataFrame({self.col: pd.Series(list(uniques), dtype=object)})
+        for step in self.steps[:self.reported]:
+            values = step.run(values, weights=counts)
+
+    def run(self, df, state=None, weights=None):
+        if self.reported:
+            self._report(df[self.col], weights)
+        df[self.col] = map_unique(df[self.col], self.value_func, self.cache)
+        return df
+
+    def __repr__(self):
+        return 'fused(' + ', '.join(repr(step) for step in self.steps) + ')'
+
+class OutlierFlags:
+    """
+    Outlier flags of quantitative columns, with IQR limits computed over the whole table.
+
+    Parameters (spec):
+    ------------------
+    cols : list
+        Quantitative columns
+    factor : float
+        IQR multiplier
+    lower_limits, upper_limits : dict, optional
+        Column -> fixed limit replacing the computed one (e.g. {'altura': 40}, considering newborn babies)
+    """
+
+    is_global = True
+    changes_rows = False
+    value_func = None
+
+    def __init__(self, name, kwargs, message=None):
+        self.name = name
+        self.kwargs = kwargs
+        self.message = message
+        self.cols = kwargs['cols']
+        self.factor = kwargs.get('factor', 1.5)
+        self.lower_limits = kwargs.get('lower_limits', {})
+        self.upper_limits = kwargs.get('upper_limits', {})
+        self.reads = list(self.cols)
+        self.writes = [col + '_outlier_flag' for col in self.cols]
+        self.types = {col: 'flag' for col in self.writes}
+
+    def _fixed(self, lims):
+        for col, limit in self.lower_limits.items():
+            lims[col][0] = limit
+        for col, limit in self.upper_limits.items():
+            lims[col][1] = limit
+        return lims
+
+    def fit(self, df):
+        """
+        Exact limits from a table in memory.
+        """
+        return self._fixed(functions.calculate_IQR_lims_multiple(df, self.cols, self.factor))
+
+    def fit_stream(self, path, chunksize):
+        """
+        Approximated limits from quantile sketches built in one pass over the file.
+        """
+        sketches = streaming.sketch_columns(path, self.cols, chunksize, seed=0)
+        return self._fixed({col: functions.calculate_IQR_lims_from_sketch(sketches[col], self.factor) for col in self.cols})
+
+    def summary(self, state):
+        return 'Outlier limits: ' + ', '.join(f'{col} [{lims[0]:.1f}, {lims[1]:.1f}]' for col, lims in state.items())
+
+    def run(self, df, state):
+        for col in self.cols:
+            df = functions.identify_outliers(df, col, state[col][0], state[col][1])
+        return df
+
+    def __repr__(self):
+        return f'{self.name}({self.cols})'
+
+class StratifiedOutlierFlags(OutlierFlags):
+    """
+    Outlier flags of quantitative columns, with IQR limits computed within each age band and sex (see
+    functions.strata). The limits of all the strata and columns are computed in one grouped pass (or, from a file, one
+    pass of quantile sketches per stratum) and applied to each chunk or shard by joining the limits table on the stratum.
+
+    Parameters (spec):
+    ------------------
+    cols : list
+        Quantitative columns
+    factor : float
+        IQR multiplier
+    age_bands : list
+        Lower bounds of the age bands in years (e.g. [0, 1, 2, 5, 10, 15, 20, 60])
+    sex_col, birth_col, reference_col : str
+        Sex, birth date and reference date of the age (last update of the registration by default)
+    min_count : int
+        Strata with fewer values get the limits of the whole column
+    lower_limits, upper_limits : dict, optional
+        Column -> fixed limit replacing the computed one in every stratum (e.g. {'altura': 40}: the younger bands
+        often have fewer than min_count heights and would get the limits of the whole column, flagging newborn babies)
+    limits_file : str, optional
+        JSON file where the limits table is kept: when it exists and was computed with the same parameters, the limits
+        are read from it instead of computed, so that later runs use the same limits (delete it to compute them again)
+    """
+
+    def __init__(self, name, kwargs, message=None):
+        super().__init__(name, kwargs, message)
+        self.age_bands = kwargs.get('age_bands', [0, 1, 2, 5, 10, 15, 20, 60])
+        self.sex_col = kwargs.get('sex_col', 'sexo')
+        self.birth_col = kwargs.get('birth_col', 'data_nascimento')
+        self.reference_col = kwargs.get('reference_col', 'data_atualizacao_cadastro')
+        self.min_count = kwargs.get('min_count', 30)
+        self.limits_file = kwargs.get('limits_file')
+        self.reads = list(self.cols) + [self.sex_col, self.birth_col, self.reference_col]
+
+    def _keys(self, df):
+        return functions.strata(df, self.sex_col, self.birth_col, self.reference_col, self.age_bands)
+
+    def _parameters(self):
+        return {key: value for key, value in self.kwargs.items() if key not in ('limits_file', 'message')}
+
+    def _fixed(self, limits):
+        for record in limits:
+            if record['column'] in self.lower_limits:
+                record['lower'] = self.lower_limits[record['column']]
+            if record['column'] in self.upper_limits:
+                record['upper'] = self.upper_limits[record['column']]
+        return limits
+
+    def _cached(self, compute):
+        """
+        Limits read from limits_file, or computed (and written to it).
+        """
+        if self.limits_file is not None and os.path.exists(self.limits_file):
+            with open(self.limits_file, encoding='utf-8') as file:
+                cached = json.load(file)
+            if cached.get('parameters') == json.loads(json.dumps(self._parameters())):
+                return cached['limits']
+
+        limits = self._fixed(compute())
+        if self.limits_file is not None:
+            tmp = self.limits_file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as file:
+                json.dump({'parameters': self._parameters(), 'limits': limits}, file, indent=1, default=float)
+            os.replace(tmp, self.limits_file)
+        return limits
+
+    def fit(self, df):
+        """
+        Exact limits from a table in memory.
+        """
+        return self._cached(lambda: functions.calculate_IQR_lims_by_stratum(df, self.cols, self._keys(df), self.factor,
+                                                                            self.min_count))
+
+    def fit_stream(self, path, chunksize):
+        """
+        Approximated limits from one quantile sketch per stratum and column, built in one pass over the file.
+        """
+        def compute():
+            overall = {col: KLLSketch(seed=0) for col in self.cols}
+            sketches = {}
+            for chunk in streaming.iter_chunks(path, chunksize, usecols=self.reads):
+                values = pd.DataFrame({col: pd.to_numeric(chunk[col], errors='coerce') for col in self.cols})
+                for col in self.cols:
+                    overall[col].update(values[col])
+                for stratum, group in values.groupby(self._keys(chunk), observed=True):
+                    for col in self.cols:
+                        sketches.setdefault((*stratum, col), KLLSketch(seed=0)).update(group[col])
+
+            names = ['age_band', 'sex'] # see functions.strata
+            lims = {col: functions.calculate_IQR_lims_from_sketch(overall[col], self.factor) for col in self.cols}
+            limits = [{**{name: '*' for name in names}, 'column': col, 'lower': lims[col][0], 'upper': lims[col][1],
+                       'count': overall[col].n} for col in self.cols]
+            for (*stratum, col), sketch in sorted(sketches.items()):
+                stratum_lims = functions.calculate_IQR_lims_from_sketch(sketch, self.factor) if sketch.n >= self.min_count else lims[col]
+                limits.append({**dict(zip(names, stratum)), 'column': col, 'lower': stratum_lims[0],
+                               'upper': stratum_lims[1], 'count': sketch.n})
+            return limits
+
+        return self._cached(compute)
+
+    def summary(self, state):
+        small = sum(record['count'] < self.min_count for record in state if record['sex'] != '*')
+        strata = {(record['age_band'], record['sex']) for record in state if record['sex'] != '*'}
+        return (f'Outlier limits computed for {len(strata)} strata of age band and sex '
+                f'({small} stratum columns with fewer than {self.min_count} values use the overall limits).')
+
+    def run(self, df, state):
+        return functions.identify_outliers_by_stratum(df, self.cols, self._keys(df), state)
+
+class Duplicates:
+    """
+    Resolution of duplicated patient IDs (see functions.resolve_duplicates). The plan is computed from the key columns of
+    the whole table and applied by index, so it can be applied to each chunk or shard separately.
+
+    Parameters (spec):
+    ------------------
+    col, birth_col, update_col : str
+        Patient ID, birth date and last update columns
+    seed : int, optional
+        Seed of the new IDs
+    """
+
+    is_global = True
+    changes_rows = True
+    value_func = None
+
+    def __init__(self, name, kwargs, message=None):
+        self.name = name
+        self.kwargs = kwargs
+        self.message = message
+        self.col = kwargs.get('col', 'id_paciente')
+        self.birth_col = kwargs.get('birth_col', 'data_nascimento')
+        self.update_col = kwargs.get('update_col', 'data_atualizacao_cadastro')
+        self.seed = kwargs.get('seed')
+        self.reads = [self.col, self.birth_col, self.update_col]
+        self.writes = [self.col]
+        self.types = {}
+
+    def _plan(self, keys, hashes):
+        dates = [c for c in (self.birth_col, self.update_col) if not pd.api.types.is_datetime64_any_dtype(keys[c])]
+        keys = functions.standardize_dates(keys.copy(), dates, flags=False)
+        return streaming.plan_duplicates(keys, self.col, hashes, self.birth_col, self.update_col, self.seed)
+
+    def fit(self, df):
+        """
+        Plan from a table in memory.
+        """
+        keys = df.loc[df.duplicated(self.col, keep=False), self.reads]
+        return self._plan(keys, functions.hash_ids(df[self.col]))
+
+    def fit_stream(self, path, chunksize):
+        """
+        Plan from a file read in chunks (see streaming.find_duplicated_rows).
+        """
+        keys, hashes = streaming.find_duplicated_rows(path, self.col, [self.birth_col, self.update_col], chunksize)
+        return self._plan(keys, hashes)
+
+    def summary(self, state):
+        drop, new_ids, log = state
+        return f'{len(drop)} duplicated entries are removed and {len(new_ids)} entries get a new ID.'
+
+    def run(self, df, state):
+        drop, new_ids, log = state
+        return streaming.apply_duplicates_plan(df, self.col, drop, new_ids)
+
+    def __repr__(self):
+        return f'{self.name}({self.col})'
+
+global_steps = {'outlier_flags': OutlierFlags, 'stratified_outlier_flags': StratifiedOutlierFlags, 'duplicates': Duplicates}
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Worker processes
+#
+# Steps hold closures and caches, so the workers rebuild the pipeline from its specification instead of receiving it. The
+# pipeline is kept by each worker between tasks, so the caches of the row functions are reused.
+
+_worker_pipelines = {}
+
+def _worker_pipeline(spec):
+    key = json.dumps(spec, sort_keys=True)
+    if key not in _worker_pipelines:
+        _worker_pipelines[key] = Pipeline.from_spec(spec)
+    return _worker_pipelines[key]
+
+def _worker_profiler(profile):
+    return Profiler(**profile) if profile is not None else None
+
+def _run_shard(spec, states, columns, profile, shard):
+    """
+    Runs a pipeline on a row shard, in a worker process.
+
+    Returns:
+    --------
+    shard : pandas.DataFrame
+    reports : dict
+        Reports of the steps for this shard (see Pipeline.reports)
+    records : dict
+        Profiler records for this shard (empty when not profiling)
+    """
+    pipeline = _worker_pipeline(spec)
+    pipeline.reset_reports()
+    profiler = _worker_profiler(profile)
+    with profiler or contextlib.nullcontext():
+        shard = pipeline.run(shard, columns, states, profiler=profiler)
+    return shard, pipeline.reports(), profiler.records if profiler is not None else {}
+
+def _run_column_group(spec, states, columns, profile, indices, df):
+    """
+    Runs some groups of the execution plan on the columns they read, in a worker process.
+
+    Returns:
+    --------
+    written : pandas.DataFrame
+        Columns written by the groups
+    created : dict
+        New column -> position in the plan of the group that created it
+    reports : dict
+        Reports of the steps for these groups (see Pipeline.reports)
+    records : dict
+        Profiler records for these groups (empty when not profiling)
+    """
+    pipeline = _worker_pipeline(spec)
+    pipeline.reset_reports()
+    profiler = _worker_profiler(profile)
+    plan = pipeline.plan(columns)
+    created = {}
+
+    with profiler or contextlib.nullcontext():
+        for index in indices:
+            group = plan[index]
+            token = profiler.begin(index, group, df) if profiler is not None else None
+            df = group.run(df, states.get(getattr(group, 'position', None)))
+            if token is not None:
+                profiler.end(token, df)
+            for column in df.columns:
+                created.setdefault(column, index)
+
+    written = [column for column in df.columns if any(column in plan[index].writes for index in indices)]
+    return df[written], created, pipeline.reports(), profiler.records if profiler is not None else {}
+
+def _concat_shards(shards):
+    """
+    Concatenates row shards, merging the categories of categorical columns (each shard has its own categories).
+    """
+    df = pd.concat(shards)
+    for column in shards[0].columns:
+        if isinstance(shards[0][column].dtype, pd.CategoricalDtype) and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            values = pd.api.types.union_categoricals([shard[column] for shard in shards])
+            df[column] = pd.Categorical(values, categories=values.categories)
+    return df
+
+class Pipeline:
+    """
+    Cleaning pipeline built from a specification.
+
+    Parameters:
+    -----------
+    spec : dict
+        {'steps': [...]}, where each step is a dictionary with the name of the step ('step'), its arguments, an optional
+        progress message ('message') and optionally 'for_each', a list of argument dictionaries (or a dictionary of
+        lists) that repeats the step once per item. The optional 'compact' list holds steps that store the cleaned
+        table in smaller types (see functions.compact_dtypes).
+    compact : bool
+        Whether the 'compact' steps are appended to the steps. They are written into self.spec, so the worker processes
+        build the same pipeline.
+    """
+
+    def __init__(self, spec, compact=False):
+        if compact and spec.get('compact'):
+            spec = {**spec, 'steps': list(spec['steps']) + list(spec['compact']), 'compact': []}
+        self.spec = spec
+        self.steps = []
+
+        for entry in spec['steps']:
+            entry = _from_json(dict(entry))
+            name = entry.pop('step')
+            message = entry.pop('message', None)
+            for_each = entry.pop('for_each', [{}])
+
+            if isinstance(for_each, dict):
+                for_each = [dict(zip(for_each, values)) for values in zip(*for_each.values())]
+
+            for i, item in enumerate(for_each):
+                kwargs = {**entry, **item}
+                step_class = global_steps.get(name, Step)
+                self.steps.append(step_class(name, kwargs, message if i == 0 else None))
+
+        for position, step in enumerate(self.steps):
+            step.position = position
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(spec)
+
+    @classmethod
+    def from_file(cls, path, compact=False):
+        """
+        Loads the specification from a JSON file.
+
+        Parameters:
+        -----------
+        path : str
+        compact : bool
+            Whether the 'compact' steps of the specification are included
+
+        Returns:
+        --------
+        Pipeline
+        """
+        with open(path, encoding='utf-8') as file:
+            return cls(json.load(file), compact)
+
+    def dependencies(self):
+        """
+        Dependency graph between the steps: step j depends on step i (i < j) when j reads or writes a column written by
+        i, or writes a column read by i.
+
+        Returns:
+        --------
+        graph : dict
+            Step position -> set of the positions of the steps it depends on
+        """
+        graph = {}
+        for j, after in enumerate(self.steps):
+            graph[j] = set()
+            for i, before in enumerate(self.steps[:j]):
+                if set(after.reads + after.writes) & set(before.writes) or set(after.writes) & set(before.reads):
+                    graph[j].add(i)
+        return graph
+
+    def needed(self, columns=None):
+        """
+        Steps needed to produce the requested columns (all steps when columns is None).
+
+        Parameters:
+        -----------
+        columns : list, optional
+
+        Returns:
+        --------
+        list of steps
+        """
+        if columns is None:
+            return list(self.steps)
+
+        graph = self.dependencies()
+        keep = set()
+        for position, step in enumerate(self.steps):
+            if step.changes_rows or set(step.writes) & set(columns):
+                keep.add(position)
+
+        queue = list(keep)
+        while queue:
+            for dependency in graph[queue.pop()]:
+                if dependency not in keep:
+                    keep.add(dependency)
+                    queue.append(dependency)
+
+        return [step for position, step in enumerate(self.steps) if position in keep]
+
+    def input_columns(self, columns=None):
+        """
+        Columns of the raw table needed to produce the requested columns, so that only them are read (see
+        loader.load_raw).
+
+        Parameters:
+        -----------
+        columns : list, optional
+            Requested columns (None when all columns are needed)
+
+        Returns:
+        --------
+        list or None
+        """
+        if columns is None:
+            return None
+
+        live = set(columns)
+        for step in reversed(self.needed(columns)):
+            live = (live - set(step.writes)) | set(step.reads)
+        return sorted(live)
+
+    def column_types(self):
+        """
+        Kind of each column of the cleaned table (see functions.declares): the kind of the raw column in loader.schema,
+        replaced by the one declared by the last step that writes the column. They do not depend on the values, so every
+        chunk of a file is written with the same types (see storage.ParquetChunkWriter).
+
+        Returns:
+        --------
+        dict
+            Column -> kind
+        """
+        raw_kinds = {'boolean': 'flag'}
+        types = {col: raw_kinds.get(kind, kind) for col, kind in raw_schema.items()}
+        for step in self.steps:
+            types.update(step.types)
+        return types
+
+    def plan(self, columns=None):
+        """
+        Execution plan: the needed steps, with consecutive value by value steps on the same column fused.
+
+        Parameters:
+        -----------
+        columns : list, optional
+            Requested columns (all steps when None)
+
+        Returns:
+        --------
+        groups : list
+            Steps and FusedMap groups, in execution order
+        """
+        groups = []
+        last = {} # column -> index of the last group that touched it
+
+        for step in self.needed(columns):
+            col = step.writes[0] if step.value_func is not None else None
+            target = last.get(col)
+
+            if col is not None and target is not None and isinstance(groups[target], list):
+                groups[target].append(step) # no step in between touches the column
+                continue
+
+            groups.append([step] if col is not None else step)
+            for column in step.reads + step.writes:
+                last[column] = len(groups) - 1
+
+        return [(FusedMap(group) if len(group) > 1 else group[0]) if isinstance(group, list) else group for group in groups]
+
+    def fit(self, df, verbose=False):
+        """
+        Computes the state of the global steps from a table in memory.
+
+        Returns:
+        --------
+        states : dict
+            Step position -> state
+        """
+        states = {}
+        for step in self.steps:
+            if step.is_global:
+                states[step.position] = step.fit(df)
+                if verbose: print(step.summary(states[step.position]))
+        return states
+
+    def fit_stream(self, path, chunksize, verbose=False):
+        """
+        Computes the state of the global steps from a file read in chunks.
+
+        Returns:
+        --------
+        states : dict
+            Step position -> state
+        """
+        states = {}
+        for step in self.steps:
+            if step.is_global:
+                states[step.position] = step.fit_stream(path, chunksize)
+                if verbose: print(step.summary(states[step.position]))
+        return states
+
+    def reports(self):
+        """
+        What the steps that keep a report did so far (e.g. rows changed by each replacement rule).
+
+        Returns:
+        --------
+        reports : dict
+            Step position -> report (dictionary)
+        """
+        return {step.position: dict(step.report) for step in self.steps if getattr(step, 'report', None) is not None}
+
+    def merge_reports(self, reports):
+        """
+        Adds reports computed elsewhere (e.g. in worker processes) to the reports of the steps.
+        """
+        for position, report in reports.items():
+            for key, count in report.items():
+                self.steps[position].report[key] = self.steps[position].report.get(key, 0) + count
+
+    def reset_reports(self):
+        for step in self.steps:
+            if getattr(step, 'report', None) is not None:
+                step.report.clear()
+
+    def report_table(self):
+        """
+        Reports of all the steps as a table with columns step, item and count.
+
+        Returns:
+        --------
+        pandas.DataFrame
+        """
+        rows = [(self.steps[position].name, key, count) for position, report in self.reports().items() for key, count in report.items()]
+        return pd.DataFrame(rows, columns=['step', 'item', 'count'])
+
+    def run(self, df, columns=None, states=None, verbose=False, profiler=None):
+        """
+        Runs the pipeline on a table in memory.
+
+        Parameters:
+        -----------
+        df : pandas.DataFrame
+        columns : list, optional
+            Requested columns. Only the steps needed for them are run and only them are returned.
+        states : dict, optional
+            State of the global steps (from fit or fit_stream). By default it is computed from df when each global step
+            is reached.
+        verbose : bool
+            Whether to print the progress messages
+        profiler : profiling.Profiler, optional
+            Records the time, memory and changes of each step
+
+        Returns:
+        --------
+        df : pandas.DataFrame
+        """
+        for index, group in enumerate(self.plan(columns)):
+            if verbose and group.message: print(group.message)
+            token = profiler.begin(index, group, df) if profiler is not None else None
+
+            if group.is_global:
+                state = states[group.position] if states is not None else group.fit(df)
+                if verbose and states is None: print(group.summary(state))
+                df = group.run(df, state)
+            else:
+                df = group.run(df)
+
+            if token is not None:
+                profiler.end(token, df)
+
+        return df[columns] if columns is not None else df
+
+    def run_chunked(self, path, outputs, chunksize, columns=None, verbose=False, profiler=None, **write_options):
+        """
+        Runs the pipeline on a CSV (or Parquet) file read in chunks, writing each chunk as soon as it is cleaned (see
+        streaming.run_chunked).
+
+        Parameters:
+        -----------
+        path : str
+            Path or URL of the CSV or Parquet file
+        outputs : dict
+            Output file -> whether rows with null values are dropped
+        chunksize : int
+            Number of rows per chunk
+        columns : list, optional
+            Requested columns
+        verbose : bool
+            Whether to print the progress messages
+        profiler : profiling.Profiler, optional
+            Records the time, memory and changes of each step, summed over the chunks
+        write_options :
+            Parquet options of streaming.run_chunked (compression, row_group_size). The column types are the declared
+            ones (see column_types).
+
+        Returns:
+        --------
+        N_rows, N_null : int
+            Number of rows written and number of rows with null values
+        """
+        states = self.fit_stream(path, chunksize, verbose)
+        return streaming.run_chunked(path, lambda chunk: self.run(chunk, columns, states, profiler=profiler), outputs, chunksize,
+                                     types=self.column_types(), **write_options)
+
+    def column_groups(self, columns=None):
+        """
+        Splits the execution plan into groups that share no column, so they can run independently. Steps that change
+        the rows (duplicates) are left out, they are applied to the whole table first.
+
+        Parameters:
+        -----------
+        columns : list, optional
+            Requested columns
+
+        Returns:
+        --------
+        groups : list of list
+            Positions in the plan of each independent group, in execution order
+        """
+        plan = self.plan(columns)
+        parent = list(range(len(plan)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owner = {} # column -> first position in the plan that touches it
+        for index, group in enumerate(plan):
+            if group.changes_rows:
+                continue
+            for column in group.reads + group.writes:
+                if column in owner:
+                    parent[find(index)] = find(owner[column])
+                else:
+                    owner[column] = index
+
+        groups = {}
+        for index, group in enumerate(plan):
+            if not group.changes_rows:
+                groups.setdefault(find(index), []).append(index)
+        return list(groups.values())
+
+    def run_parallel(self, df, workers=None, columns=None, by='rows', verbose=False, profiler=None):
+        """
+        Runs the pipeline in several worker processes, either on row shards of the table or on groups of steps that
+        share no column (see column_groups). The global steps are computed on the whole table first, so the result is
+        the same as run, whatever the number of workers.
+
+        Parameters:
+        -----------
+        df : pandas.DataFrame
+        workers : int, optional
+            Number of worker processes (number of CPUs by default)
+        columns : list, optional
+            Requested columns
+        by : str
+            'rows' or 'columns'
+        verbose : bool
+            Whether to print the progress messages
+        profiler : profiling.Profiler, optional
+            Records the time, memory and changes of each step. The workers profile their part and the records are
+            summed (times are the sum over the workers, not the elapsed time).
+
+        Returns:
+        --------
+        df : pandas.DataFrame
+        """
+        states = self.fit(df, verbose)
+        workers = workers or os.cpu_count()
+        profile = profiler.options() if profiler is not None else None
+
+        if by == 'rows':
+            shards = [df.iloc[shard] for shard in np.array_split(np.arange(len(df)), workers)]
+            with ProcessPoolExecutor(workers) as executor:
+                # executor.map keeps the order of the shards
+                results = list(executor.map(_run_shard, *zip(*[(self.spec, states, columns, profile, shard) for shard in shards])))
+            for _, reports, records in results:
+                self.merge_reports(reports)
+                if profiler is not None:
+                    profiler.merge(records)
+            return _concat_shards([shard for shard, _, _ in results])
+
+        if by != 'columns':
+            raise ValueError(f"by must be 'rows' or 'columns', not {by!r}")
+
+        plan = self.plan(columns)
+        for index, group in enumerate(plan):
+            if group.changes_rows:
+                token = profiler.begin(index, group, df) if profiler is not None else None
+                df = group.run(df, states[group.position])
+                if token is not None:
+                    profiler.end(token, df)
+
+        tasks = []
+        for indices in self.column_groups(columns):
+            reads = {column for index in indices for column in plan[index].reads + plan[index].writes}
+            tasks.append((self.spec, states, columns, profile, indices, df[[column for column in df.columns if column in reads]]))
+
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_run_column_group, *zip(*tasks)))
+
+        # Reassembling in the same column order as run: existing columns in place, new columns by the step that created them
+        out = df.copy(deep=False)
+        new = []
+        for written, created, reports, records in results:
+            self.merge_reports(reports)
+            if profiler is not None:
+                profiler.merge(records)
+            for column in written.columns:
+                if column in df.columns:
+                    out[column] = written[column]
+                else:
+                    new.append((created[column], list(written.columns).index(column), written[column]))
+        for _, _, series in sorted(new, key=lambda item: item[:2]):
+            out[series.name] = series
+
+        return out[columns] if columns is not None else out
+
+#========================================================================================================================================
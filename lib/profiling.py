@@ -0,0 +1,285 @@
+import collections
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+#=============================================================================================================================================
+
+# Instrumentation of the cleaning pipeline
+#
+# A Profiler passed to Pipeline.run (or run_chunked, run_parallel) records for each group of the execution plan:
+#
+# - wall time and CPU time, number of calls (one per chunk or shard)
+# - rows in and rows out, rows per second
+# - peak memory growth: growth of the peak resident size of the process, or, with memory=True, the peak of the
+#   allocations traced by tracemalloc during the step (more precise, but tracing slows the allocations down)
+# - rows changed in each column written by the step (new columns count their non-null values)
+#
+# Without a profiler the pipeline only checks `profiler is not None` once per step, so the instrumentation costs nothing
+# when it is disabled. The results are written as JSON or CSV (one row per step and column, see Profiler.table).
+#
+# A sampling profiler can be attached with sampler=: any object with start() and stop() methods (e.g. pyinstrument's
+# Profiler), told the current step through enter_step(label) when it has one. StackSampler is a small built-in one that
+# writes collapsed stacks per step, the input format of flamegraph.pl and speedscope.
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+
+def step_label(group):
+    """
+    Short name of a group of the execution plan (e.g. 'replace_values(religiao)', 'fused(a(x)+b(x))').
+    """
+    if hasattr(group, 'steps'):
+        return 'fused(' + '+'.join(step_label(step) for step in group.steps) + ')'
+    col = group.kwargs.get('col')
+    return f'{group.name}({col})' if isinstance(col, str) else group.name
+
+def count_changed(before, after):
+    """
+    Number of rows whose value differs between two versions of a column (null values are equal to each other).
+
+    Parameters:
+    -----------
+    before, after : pandas.Series
+        Column before and after a step. When the step dropped rows, before is aligned on the rows left.
+
+    Returns:
+    --------
+    int
+    """
+    if len(before) != len(after) or not before.index.equals(after.index):
+        before = before.reindex(after.index)
+    a, b = after.to_numpy(dtype=object), before.to_numpy(dtype=object)
+    equal = np.asarray(a == b, dtype=bool) | (pd.isna(a) & pd.isna(b))
+    return int((~equal).sum())
+
+class Profiler:
+    """
+    Records what each step of a pipeline run costs and changes.
+
+    Parameters:
+    -----------
+    memory : bool
+        Whether to trace the allocations with tracemalloc for the peak memory of each step
+    changes : bool
+        Whether to count the rows changed in the written columns (compares each written column before and after the step)
+    sampler : object, optional
+        Sampling profiler with start() and stop() methods (see StackSampler)
+    """
+
+    def __init__(self, memory=False, changes=True, sampler=None):
+        self.memory = memory
+        self.changes = changes
+        self.sampler = sampler
+        self.records = {} # plan index -> record
+        self._tracing = False
+
+    def options(self):
+        """
+        Arguments of a Profiler with the same settings, for the worker processes (without the sampler).
+        """
+        return {'memory': self.memory, 'changes': self.changes}
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        if self.sampler is not None:
+            self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def begin(self, index, group, df):
+        """
+        Called by the pipeline before a group of the plan runs.
+
+        Returns:
+        --------
+        token
+            Passed back to end
+        """
+        label = step_label(group)
+        if self.sampler is not None and hasattr(self.sampler, 'enter_step'):
+            self.sampler.enter_step(label)
+
+        before = {}
+        if self.changes:
+            before = {col: df[col].copy() for col in group.writes if col in df.columns}
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+        return (index, group, label, len(df), before, tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+                _max_rss_mb(), time.perf_counter(), time.process_time())
+
+    def end(self, token, df):
+        """
+        Called by the pipeline after a group of the plan ran, with its output.
+        """
+        wall_end, cpu_end = time.perf_counter(), time.process_time()
+        index, group, label, rows_in, before, traced, rss, wall, cpu = token
+
+        if traced is not None:
+            peak = (tracemalloc.get_traced_memory()[1] - traced) / 2 ** 20
+        else:
+            peak = _max_rss_mb() - rss
+
+        record = self.records.setdefault(index, {'step': label, 'name': getattr(group, 'name', type(group).__name__),
+                                                 'columns': list(group.writes), 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                 'rows_in': 0, 'rows_out': 0, 'peak_mb': 0.0,
+                                                 'changed': {col: 0 for col in group.writes}})
+        record['calls'] += 1
+        record['wall_s'] += wall_end - wall
+        record['cpu_s'] += cpu_end - cpu
+        record['rows_in'] += rows_in
+        record['rows_out'] += len(df)
+        record['peak_mb'] = max(record['peak_mb'], peak)
+
+        if self.sampler is not None and hasattr(self.sampler, 'enter_step'):
+            self.sampler.enter_step(None)
+
+        if self.changes:
+            for col in group.writes:
+                if col not in df.columns:
+                    continue
+                if col in before:
+                    record['changed'][col] += count_changed(before[col], df[col])
+                else:
+                    record['changed'][col] += int(df[col].notna().sum())
+
+    def merge(self, records):
+        """
+        Adds records computed elsewhere (e.g. in worker processes, see options).
+        """
+        for index, other in records.items():
+            record = self.records.setdefault(index, {**other, 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rows_in': 0, 'rows_out': 0,
+                                                     'peak_mb': 0.0, 'changed': {col: 0 for col in other['changed']}})
+            for key in ('calls', 'wall_s', 'cpu_s', 'rows_in', 'rows_out'):
+                record[key] += other[key]
+            record['peak_mb'] = max(record['peak_mb'], other['peak_mb'])
+            for col, count in other['changed'].items():
+                record['changed'][col] = record['changed'].get(col, 0) + count
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def table(self):
+        """
+        Results as a table with one row per step and written column (steps that write no column get one row).
+
+        Returns:
+        --------
+        pandas.DataFrame
+            Columns position, step, column, calls, wall_s, cpu_s, rows_in, rows_out, rows_per_s, peak_mb and rows_changed
+        """
+        rows = []
+        for index, record in sorted(self.records.items()):
+            rows_per_s = record['rows_in'] / record['wall_s'] if record['wall_s'] > 0 else None
+            common = {'position': index, 'step': record['step'], 'calls': record['calls'], 'wall_s': record['wall_s'],
+                      'cpu_s': record['cpu_s'], 'rows_in': record['rows_in'], 'rows_out': record['rows_out'],
+                      'rows_per_s': rows_per_s, 'peak_mb': record['peak_mb']}
+            columns = record['columns'] or [None]
+            for col in columns:
+                rows.append({**common, 'column': col, 'rows_changed': record['changed'].get(col) if self.changes else None})
+
+        return pd.DataFrame(rows, columns=['position', 'step', 'column', 'calls', 'wall_s', 'cpu_s', 'rows_in', 'rows_out',
+                                           'rows_per_s', 'peak_mb', 'rows_changed'])
+
+    def write(self, path):
+        """
+        Writes the results as JSON (one object per step) or as CSV (see table), depending on the extension of the path.
+        """
+        if str(path).lower().endswith('.csv'):
+            self.table().to_csv(path, index=False)
+            return
+
+        steps = []
+        for index, record in sorted(self.records.items()):
+            steps.append({'position': index, **record,
+                          'rows_per_s': record['rows_in'] / record['wall_s'] if record['wall_s'] > 0 else None})
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'memory': 'tracemalloc' if self.memory else 'max_rss', 'steps': steps}, file, indent=1)
+
+    def summary(self, top=5):
+        """
+        The slowest steps, as text.
+        """
+        records = sorted(self.records.values(), key=lambda record: record['wall_s'], reverse=True)[:top]
+        total = sum(record['wall_s'] for record in self.records.values())
+        lines = [f'Slowest steps ({total:.2f} s in total):']
+        for record in records:
+            lines.append(f"    {record['wall_s']:8.3f} s  {record['peak_mb']:8.1f} MB  {record['step'][:80]}")
+        return '\n'.join(lines)
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+class StackSampler:
+    """
+    Sampling profiler: a thread that records the stack of the profiled thread at regular intervals, grouped by step.
+
+    Parameters:
+    -----------
+    interval : float
+        Seconds between samples
+    thread : int, optional
+        Identifier of the profiled thread (the one that calls start by default)
+    """
+
+    def __init__(self, interval=0.005, thread=None):
+        self.interval = interval
+        self.thread = thread
+        self.step = None
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._worker = None
+
+    def enter_step(self, label):
+        self.step = label
+
+    def _stack(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        return names[::-1]
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread)
+            if frame is not None:
+                stack = [(self.step or 'outside steps').replace(';', ',')] + self._stack(frame)
+                self.counts[';'.join(stack)] += 1
+
+    def start(self):
+        self.thread = self.thread or threading.get_ident()
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._sample, daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def write(self, path):
+        """
+        Writes the samples as collapsed stacks (one 'step;frame;frame count' line per distinct stack).
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.counts.most_common():
+                file.write(f'{stack} {count}\n')
+
+#========================================================================================================================================
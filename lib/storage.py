@@ -0,0 +1,286 @@
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib.functions import parse_list_string
+from lib.streaming import write_csv
+
+#=============================================================================================================================================
+
+# Columnar (Parquet / Arrow) input and output
+#
+# The cleaned table is converted to Arrow keeping its types, instead of being written as text:
+#
+# - list columns (encoded by encode_list_column) become real list<string> columns
+# - datetimes stay timestamps
+# - 0/1 integer columns (flags and boolean columns) become int8
+# - categorical columns, and text columns with few distinct values, are dictionary encoded
+#
+# Those rules look at the values, so two chunks of the same file could get different types (an all-null chunk, a count
+# that fits int8 in one chunk only). When the kinds of the columns declared by the pipeline are given (see
+# Pipeline.column_types) they decide the types instead, and only the undeclared columns follow the rules above.
+#
+# The raw extract can also be read from a Parquet copy (see csv_to_parquet), so repeated runs skip parsing the CSV file.
+
+parquet_extensions = ('.parquet', '.pq')
+
+def is_parquet(path):
+    """
+    Whether a path points to a Parquet file (by its extension).
+    """
+    return str(path).lower().endswith(parquet_extensions)
+
+def is_list_column(series):
+    """
+    Whether a column is a list column encoded by encode_list_column (categorical whose labels are lists written as text).
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return False
+    categories = series.cat.categories
+    return len(categories) > 0 and all(isinstance(label, str) and label[:1] == '[' and label[-1:] == ']' for label in categories)
+
+# Arrow type of each kind of column declared by the pipeline (see functions.declares)
+arrow_types = {
+    'string': pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'list': pa.large_list(pa.string()),
+    'flag': pa.int8(),
+    'int': pa.int64(),
+    'float': pa.float64(),
+    'float32': pa.float32(),
+    'datetime': pa.timestamp('ns'),
+}
+
+def list_column_to_arrow(series):
+    """
+    Converts an encoded list column to an Arrow list array. Each category is parsed once and the rows take their list
+    by code.
+
+    Parameters:
+    -----------
+    series : pandas.Series
+        Categorical list column (see encode_list_column)
+
+    Returns:
+    --------
+    pyarrow.LargeListArray
+    """
+    lists = pa.array([parse_list_string(label) for label in series.cat.categories], type=pa.large_list(pa.string()))
+    codes = series.cat.codes.to_numpy()
+    return lists.take(pa.array(codes, mask=codes == -1))
+
+def declared_array(series, kind):
+    """
+    Converts a column to the Arrow type of its declared kind, whatever its values (all null included).
+
+    Parameters:
+    -----------
+    series : pandas.Series
+    kind : str
+        Kind of the column (see arrow_types)
+
+    Returns:
+    --------
+    pyarrow.Array
+    """
+    arrow_type = arrow_types[kind]
+
+    if kind == 'list':
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return list_column_to_arrow(series)
+        return pa.array(series, type=arrow_type, from_pandas=True)
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        array = pa.DictionaryArray.from_pandas(series)
+        if kind != 'category':
+            array = array.dictionary_decode()
+    else:
+        array = pa.array(series, from_pandas=True)
+        if kind == 'category' and not pa.types.is_null(array.type):
+            array = array.dictionary_encode()
+    return array.cast(arrow_type)
+
+def to_arrow(df, dictionary_ratio=0.5, types=None):
+    """
+    Converts a cleaned table to an Arrow table keeping its types.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    dictionary_ratio : float
+        Text columns whose number of distinct values is at most this fraction of the rows are dictionary encoded
+    types : dict, optional
+        Column -> declared kind (see Pipeline.column_types). The declared columns get the type of their kind, the others
+        a type chosen from their values.
+
+    Returns:
+    --------
+    pyarrow.Table
+    """
+    arrays = {}
+    types = types or {}
+
+    for col in df.columns:
+        series = df[col]
+
+        if col in types:
+            arrays[col] = declared_array(series, types[col])
+
+        elif is_list_column(series):
+            arrays[col] = list_column_to_arrow(series)
+
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            arrays[col] = pa.DictionaryArray.from_pandas(series)
+
+        elif pd.api.types.is_integer_dtype(series.dtype) and series.isin([0, 1]).all():
+            arrays[col] = pa.array(series.to_numpy(), type=pa.int8())
+
+        elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+            array = pa.array(series, from_pandas=True)
+            if pa.types.is_string(array.type) and series.nunique() <= dictionary_ratio * len(series):
+                array = array.dictionary_encode()
+            arrays[col] = array
+
+        else:
+            arrays[col] = pa.array(series, from_pandas=True)
+
+    return pa.table(arrays)
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Output
+
+def write_table(df, path, compression='zstd', row_group_size=None, keep=None, types=None):
+    """
+    Writes a cleaned table, as Parquet or as CSV depending on the extension of the path.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    path : str
+        Output file (.parquet or .csv)
+    compression : str
+        Parquet compression codec ('zstd', 'snappy', 'gzip', 'brotli', 'lz4' or 'none')
+    row_group_size : int, optional
+        Maximum number of rows per Parquet row group
+    keep : numpy.ndarray of bool, optional
+        Rows to write (all of them when None). The rows are selected on the Arrow table (or block by block for CSV, see
+        streaming.write_csv), so no filtered copy of the DataFrame is made.
+    types : dict, optional
+        Column -> declared kind of the Parquet columns (see to_arrow)
+    """
+    if is_parquet(path):
+        table = to_arrow(df, types=types)
+        if keep is not None:
+            table = table.filter(pa.array(keep))
+        pq.write_table(table, path, compression=compression, row_group_size=row_group_size)
+    else:
+        write_csv(df, path, keep, sep=';', decimal=',') # you can change decimal delimiter to '.' if you want
+
+class ParquetChunkWriter:
+    """
+    Writes a table chunk by chunk to a single Parquet file. The declared columns always get the type of their kind;
+    the types of the other columns are the ones of the first chunk, the next chunks are cast to them.
+
+    Parameters:
+    -----------
+    path : str
+        Output file
+    compression : str
+        Compression codec
+    row_group_size : int, optional
+        Maximum number of rows per row group (each chunk is at least one row group)
+    types : dict, optional
+        Column -> declared kind (see Pipeline.column_types)
+    """
+
+    def __init__(self, path, compression='zstd', row_group_size=None, types=None):
+        self.path = path
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.types = types
+        self.writer = None
+
+    def write(self, df):
+        table = to_arrow(df, types=self.types)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Input
+
+def read_table(path, columns=None):
+    """
+    Reads the raw extract from a CSV file or from a Parquet copy of it.
+
+    Parameters:
+    -----------
+    path : str
+        Path or URL of the file
+    columns : list, optional
+        Columns to read. All columns are read when None.
+
+    Returns:
+    --------
+    pandas.DataFrame
+    """
+    if is_parquet(path):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+def iter_parquet(path, chunksize, columns=None):
+    """
+    Reads a Parquet file in chunks, with the global row position as index (like pandas.read_csv with chunksize).
+
+    Parameters:
+    -----------
+    path : str
+    chunksize : int
+        Number of rows per chunk
+    columns : list, optional
+        Columns to read
+
+    Returns:
+    --------
+    Iterator of pandas.DataFrame
+    """
+    start = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+        chunk = batch.to_pandas()
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
+def csv_to_parquet(src, dst, compression='zstd', row_group_size=None):
+    """
+    Saves a Parquet copy of the raw extract. The CSV file is parsed by pandas, so reading the copy gives the same table
+    as reading the CSV file.
+
+    Parameters:
+    -----------
+    src : str
+        Path or URL of the CSV file
+    dst : str
+        Parquet file
+    compression : str
+        Compression codec
+    row_group_size : int, optional
+        Maximum number of rows per row group
+    """
+    table = pa.Table.from_pandas(pd.read_csv(src), preserve_index=False)
+    pq.write_table(table, dst, compression=compression, row_group_size=row_group_size)
+
+#========================================================================================================================================
+
+if __name__ == '__main__':
+    # python -m lib.storage raw.csv raw.parquet
+    csv_to_parquet(sys.argv[1], sys.argv[2])
@@ -0,0 +1,299 @@
+import os
+import numpy as np
+import pandas as pd
+from lib.sketch import KLLSketch
+from lib.functions import classify_duplicates, hash_ids, null_rows as find_null_rows, PatientIdAllocator
+
+#=============================================================================================================================================
+
+# Chunked (streaming) execution of the cleaning process.
+#
+# The raw extract is read in chunks of `chunksize` rows. Steps that only look at one row at a time are applied to each chunk
+# independently and the result is appended to the output files. Steps that need the whole table (IQR limits and duplicate
+# resolution) are computed beforehand in separate passes that only read the columns they need.
+
+def iter_chunks(path, chunksize, usecols=None):
+    """
+    Reads a CSV file (or a Parquet copy of it, see storage.csv_to_parquet) in chunks.
+
+    Parameters:
+    -----------
+    path : str
+        Path or URL of the CSV or Parquet file
+    chunksize : int
+        Number of rows per chunk
+    usecols : list, optional
+        Columns to read. All columns are read when None.
+
+    Returns:
+    --------
+    Iterator of pandas.DataFrame whose index is the global row position in the file
+    """
+    if str(path).lower().endswith(('.parquet', '.pq')):
+        from lib.storage import iter_parquet # requires pyarrow
+        return iter_parquet(path, chunksize, usecols)
+    return pd.read_csv(path, chunksize=chunksize, usecols=usecols)
+
+def sketch_columns(path, cols, chunksize, k=200, seed=None):
+    """
+    Builds one quantile sketch per column in a single pass over the file.
+
+    Parameters:
+    -----------
+    path : str
+        Path or URL of the CSV file
+    cols : list
+        Numeric columns to summarize
+    chunksize : int
+        Number of rows per chunk
+    k : int
+        Accuracy parameter of the sketches
+    seed : int, optional
+        Seed of the sketches, for reproducible results
+
+    Returns:
+    --------
+    sketches : dict
+        Column name -> KLLSketch
+    """
+    sketches = {col: KLLSketch(k, seed) for col in cols}
+    for chunk in iter_chunks(path, chunksize, usecols=cols):
+        for col in cols:
+            sketches[col].update(pd.to_numeric(chunk[col], errors='coerce'))
+    return sketches
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Duplicate resolution
+
+def find_duplicated_rows(path, col, key_cols, chunksize):
+    """
+    Finds the rows whose ID appears more than once in the file.
+
+    The first pass keeps the sorted distinct hashes of the IDs (8 bytes per distinct ID, needed anyway to allocate new
+    IDs that do not exist in the file): each chunk is reduced to its distinct hashes, which are merged into the running
+    set once they add up to its size, so the hashes of every row are never held at once. The second pass keeps the key
+    columns of the rows whose hash is duplicated, so that part grows with the number of duplicates only.
+
+    Parameters:
+    -----------
+    path : str
+        Path or URL of the CSV file
+    col : str
+        Name of the patient ID column
+    key_cols : list
+        Other columns needed to resolve the duplicates
+    chunksize : int
+        Number of rows per chunk
+
+    Returns:
+    --------
+    keys : pandas.DataFrame
+        Key columns of the duplicated rows, indexed by global row position
+    hashes : numpy.ndarray
+        Sorted unique hashes of every ID in the file
+    """
+    unique = np.empty(0, dtype=np.uint64)
+    repeated = [np.empty(0, dtype=np.uint64)]
+    pending = []
+
+    def merge():
+        merged, counts = np.unique(np.concatenate([unique] + pending), return_counts=True)
+        repeated.append(merged[counts > 1])
+        pending.clear()
+        return merged
+
+    for chunk in iter_chunks(path, chunksize, usecols=[col]):
+        chunk_unique, counts = np.unique(hash_ids(chunk[col]), return_counts=True)
+        repeated.append(chunk_unique[counts > 1])
+        pending.append(chunk_unique)
+        if sum(map(len, pending)) >= len(unique):
+            unique = merge()
+    if pending:
+        unique = merge()
+    repeated = np.unique(np.concatenate(repeated))
+
+    keys = []
+    for chunk in iter_chunks(path, chunksize, usecols=[col] + key_cols):
+        mask = np.isin(hash_ids(chunk[col]), repeated)
+        if mask.any():
+            keys.append(chunk.loc[mask])
+
+    keys = pd.concat(keys) if keys else pd.DataFrame(columns=[col] + key_cols)
+    # Hash collisions between different IDs are dropped here
+    keys = keys.loc[keys.duplicated(col, keep=False)]
+    return keys, unique
+
+def plan_duplicates(keys, col, hashes, birth_col='data_nascimento', update_col='data_atualizacao_cadastro', seed=None):
+    """
+    Decides what to do with each duplicated row, following the same rules as resolve_duplicates.
+
+    Parameters:
+    -----------
+    keys : pandas.DataFrame
+        Output of find_duplicated_rows (dates already in datetime)
+    col : str
+        Name of the patient ID column
+    hashes : numpy.ndarray
+        Sorted hashes of every ID in the file, used to avoid generating an existing ID
+    birth_col : str
+        Name of the birth date column
+    update_col : str
+        Name of the last update column
+    seed : int, optional
+        Seed for reproducible new IDs
+
+    Returns:
+    --------
+    drop : pandas.Index
+        Global positions of the rows to be removed
+    new_ids : pandas.Series
+        New IDs indexed by the global position of the row that receives them
+    log : pandas.DataFrame
+        Output of classify_duplicates with a 'new_id' column
+    """
+    log = classify_duplicates(keys, col, birth_col, update_col)
+    reassign = log.index[log['action'] == 'reassigned']
+
+    allocator = PatientIdAllocator.from_hashes(hashes, seed)
+    new_ids = pd.Series(allocator.allocate(len(reassign)), index=reassign, dtype=object)
+    log['new_id'] = new_ids
+
+    return log.index[log['action'] == 'dropped'], new_ids, log
+
+def apply_duplicates_plan(chunk, col, drop, new_ids):
+    """
+    Applies the duplicates plan to a chunk.
+
+    Parameters:
+    -----------
+    chunk : pandas.DataFrame
+        Chunk indexed by global row position
+    col : str
+        Name of the patient ID column
+    drop : pandas.Index
+        Global positions of the rows to be removed
+    new_ids : pandas.Series
+        New IDs indexed by global row position
+
+    Returns:
+    --------
+    chunk : pandas.DataFrame
+    """
+    chunk = chunk.drop(drop.intersection(chunk.index))
+    reassign = new_ids.index.intersection(chunk.index)
+    chunk.loc[reassign, col] = new_ids.loc[reassign]
+    return chunk
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+# Output
+
+def write_chunk(df, path, first, **kwargs):
+    """
+    Writes a chunk to a CSV file, overwriting it for the first chunk and appending afterwards.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    path : str
+        Output file
+    first : bool
+        Whether this is the first chunk written to the file
+    """
+    df.to_csv(path, mode='w' if first else 'a', header=first, index=False, **kwargs)
+
+def write_csv(df, path, keep=None, block_size=100_000, **kwargs):
+    """
+    Writes a table to a CSV file in blocks of rows, keeping only the rows selected by a mask. Only one block of the kept
+    rows is copied at a time, where df.loc[keep].to_csv (or df.dropna().to_csv) would copy all of them first.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    path : str
+        Output file
+    keep : numpy.ndarray of bool, optional
+        Rows to write (all of them when None), e.g. ~functions.null_rows(df) for the table without null values
+    block_size : int
+        Number of rows per block
+    """
+    if keep is None:
+        df.to_csv(path, index=False, **kwargs)
+        return
+    for start in range(0, max(len(df), 1), block_size):
+        block = df.iloc[start:start + block_size]
+        write_chunk(block[keep[start:start + block_size]], path, start == 0, **kwargs)
+
+def run_chunked(path, transform, outputs, chunksize, compression='zstd', row_group_size=None, types=None):
+    """
+    Streams the file through a transformation and writes every chunk as soon as it is ready.
+
+    Parameters:
+    -----------
+    path : str
+        Path or URL of the CSV or Parquet file
+    transform : function
+        Function applied to each chunk. Must only use information from the chunk itself (or precomputed global state, such
+        as the duplicates plan).
+    outputs : dict
+        Output file -> whether rows with null values are dropped before writing. Files ending in .parquet are written as
+        Parquet (see storage.ParquetChunkWriter), files ending in .sqlite or .db are upserted into a SQLite database (see
+        database.SQLiteSink), the others are written as CSV.
+    chunksize : int
+        Number of rows per chunk
+    compression : str
+        Parquet compression codec
+    row_group_size : int, optional
+        Maximum number of rows per Parquet row group
+    types : dict, optional
+        Column -> declared kind of the Parquet columns (see Pipeline.column_types), so that every chunk gets the same
+        types whatever its values
+
+    Returns:
+    --------
+    N_rows : int
+        Number of rows written (before dropping null values)
+    N_null : int
+        Number of rows with at least one null value
+    """
+    writers = {}
+    for output in outputs:
+        if output.lower().endswith(('.sqlite', '.sqlite3', '.db')): # kept: the chunks are upserted into it
+            from lib.database import SQLiteSink
+            writers[output] = SQLiteSink(output)
+            continue
+        if os.path.exists(output):
+            os.remove(output)
+        if output.lower().endswith(('.parquet', '.pq')):
+            from lib.storage import ParquetChunkWriter # requires pyarrow
+            writers[output] = ParquetChunkWriter(output, compression, row_group_size, types)
+
+    N_rows, N_null = 0, 0
+    first = True
+
+    try:
+        for chunk in iter_chunks(path, chunksize):
+
+            chunk = transform(chunk)
+
+            null_rows = find_null_rows(chunk)
+            N_rows += len(chunk)
+            N_null += int(null_rows.sum())
+
+            for output, dropna in outputs.items():
+                df = chunk[~null_rows] if dropna else chunk
+                if output in writers:
+                    writers[output].write(df)
+                else:
+                    write_chunk(df, output, first, sep=';', decimal=',')
+
+            first = False
+
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return N_rows, N_null
+
+#========================================================================================================================================
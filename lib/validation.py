@@ -0,0 +1,245 @@
+import numpy as np
+import pandas as pd
+
+from lib.functions import hash_ids, parse_dates, valid_uuids
+
+#=============================================================================================================================================
+
+# Data quality report
+#
+# validate checks a table (the raw extract, a chunk, a shard or the cleaned table) against a set of rules:
+#
+# - null values of every column
+# - format of the UUID columns (fixed-width code point comparisons, see functions.valid_uuids)
+# - allowed values of categorical columns (checked on the distinct values only)
+# - ranges of the date columns (text dates are parsed once per distinct value, see functions.parse_dates)
+# - duplicated values of the key columns
+#
+# Each rule is one vectorized pass over its column, and the results are counts and a few examples, not filtered copies of
+# the table. A QualityReport can be merged with the report of another chunk, shard or worker: duplicates are tracked with
+# 64-bit hashes of the keys and their counts, so keys repeated across chunks are found too.
+
+# Rules for the home visits extract, valid both before and after the cleaning
+rules = {
+    'uuid': ['id_paciente'],
+    'unique': ['id_paciente'],
+    'domains': {
+        'sexo': ['female', 'male'],
+        'tipo': ['historico', 'rotineiro'],
+        'frequenta_escola': [0, 1],
+        **{col: [0, 1, '0', '1', 'True', 'False', True, False]
+           for col in ['obito', 'luz_eletrica', 'em_situacao_de_rua', 'possui_plano_saude', 'vulnerabilidade_social',
+                       'familia_beneficiaria_auxilio_brasil', 'crianca_matriculada_creche_pre_escola']},
+    },
+    'date_ranges': {col: ['1900-01-01', None] # None: the current date
+                    for col in ['data_nascimento', 'data_cadastro', 'data_atualizacao_cadastro', 'updated_at']},
+}
+
+report_columns = ['column', 'check', 'rows', 'share', 'first_rows', 'examples']
+
+class QualityReport:
+    """
+    Counts of the rows that fail each check, mergeable across chunks and workers (see validate).
+
+    Parameters:
+    -----------
+    examples : int
+        Number of example values and rows kept per check
+    """
+
+    def __init__(self, examples=5):
+        self.examples = examples
+        self.rows = 0
+        self.checks = {} # (column, check) -> {'rows': int, 'first_rows': list, 'examples': list}
+        self.keys = {} # column -> list of (sorted unique hashes, counts), one per chunk until combined
+
+    def add(self, column, check, failed, series):
+        """
+        Adds the rows of a column that failed a check.
+
+        Parameters:
+        -----------
+        column, check : str
+        failed : numpy.ndarray of bool
+            Rows that failed, aligned with series
+        series : pandas.Series
+            Checked column (for the examples and row labels)
+        """
+        positions = np.flatnonzero(failed)
+        entry = self.checks.setdefault((column, check), {'rows': 0, 'first_rows': [], 'examples': []})
+        entry['rows'] += len(positions)
+        if len(positions) and len(entry['first_rows']) < self.examples:
+            head = positions[:self.examples]
+            entry['first_rows'] += [int(row) if isinstance(row, (int, np.integer)) else str(row) for row in series.index[head]]
+            entry['first_rows'] = entry['first_rows'][:self.examples]
+            for value in series.iloc[head].astype(object):
+                value = None if pd.isna(value) else str(value)
+                if value not in entry['examples'] and len(entry['examples']) < self.examples:
+                    entry['examples'].append(value)
+
+    def add_keys(self, column, series):
+        """
+        Adds the values of a key column, for the duplicates check.
+        """
+        hashes = hash_ids(series[series.notna()])
+        self.keys.setdefault(column, []).append(np.unique(hashes, return_counts=True))
+
+    def _combined_keys(self, column):
+        """
+        Hashes and counts of all the chunks of a key column, combined in a single sort when the results are asked for
+        (combining at each chunk would sort the keys seen so far again every time).
+        """
+        parts = self.keys[column]
+        if len(parts) > 1:
+            hashes, inverse = np.unique(np.concatenate([hashes for hashes, _ in parts]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts in parts])).astype(np.int64)
+            self.keys[column] = parts = [(hashes, counts)]
+        return parts[0]
+
+    def merge(self, other):
+        """
+        Adds the results of another report (e.g. of another chunk or worker).
+
+        Returns:
+        --------
+        self : QualityReport
+        """
+        self.rows += other.rows
+        for key, entry in other.checks.items():
+            mine = self.checks.setdefault(key, {'rows': 0, 'first_rows': [], 'examples': []})
+            mine['rows'] += entry['rows']
+            mine['first_rows'] = (mine['first_rows'] + entry['first_rows'])[:self.examples]
+            mine['examples'] = (mine['examples'] + [value for value in entry['examples'] if value not in mine['examples']])[:self.examples]
+        for column, parts in other.keys.items():
+            self.keys.setdefault(column, []).extend(parts)
+        return self
+
+    #---------------------------------------------------------------------------------------------------------------------------------
+
+    def duplicates(self, column):
+        """
+        Number of rows whose key appears more than once and number of distinct keys that appear more than once.
+        """
+        hashes, counts = self._combined_keys(column)
+        repeated = counts > 1
+        return int(counts[repeated].sum()), int(repeated.sum())
+
+    def table(self):
+        """
+        Results as a table with one row per column and failed check (checks without failures are left out).
+
+        Returns:
+        --------
+        pandas.DataFrame
+            Columns column, check, rows (number of rows that failed), share (fraction of the rows), first_rows (labels
+            of the first rows) and examples (some of the values). For the duplicates check, examples holds the number
+            of distinct repeated values.
+        """
+        lines = [{'column': column, 'check': check, **entry} for (column, check), entry in self.checks.items() if entry['rows']]
+        for column in self.keys:
+            rows, values = self.duplicates(column)
+            if rows:
+                lines.append({'column': column, 'check': 'duplicated', 'rows': rows, 'first_rows': [],
+                              'examples': [f'{values} repeated values']})
+        table = pd.DataFrame(lines, columns=[col for col in report_columns if col != 'share'])
+        table.insert(3, 'share', table['rows'] / self.rows if self.rows else 0.0)
+        return table
+
+    def to_dict(self):
+        """
+        Summary of the report for JSON files (e.g. the batch manifest), without the key hashes.
+        """
+        return {'rows': self.rows, 'problems': self.table().to_dict('records')}
+
+    def __str__(self):
+        table = self.table()
+        if table.empty:
+            return f'No data quality problems found in {self.rows} rows.'
+        lines = [f'Data quality problems in {self.rows} rows:']
+        for _, row in table.iterrows():
+            if row['check'] == 'null':
+                examples = f", e.g. rows {row['first_rows'][:3]}"
+            elif row['check'] == 'duplicated':
+                examples = f" ({row['examples'][0]})"
+            else:
+                examples = f", e.g. {row['examples'][:3]}"
+            lines.append(f"    {row['column']}: {row['rows']} rows {row['check']} ({row['share']:.2%}){examples}")
+        return '\n'.join(lines)
+
+#-------------------------------------------------------------------------------------------------------------------------------------
+
+def _date_range(series, low, high):
+    """
+    Rows of a date column (datetime or text) outside [low, high] and rows whose text is not a date.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        dates = parse_dates(pd.Series(series.cat.categories, dtype=object))
+        dates = pd.Series(np.append(dates.to_numpy(), np.datetime64('NaT', 'ns'))[series.cat.codes.to_numpy()])
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        dates = series
+    else:
+        dates = parse_dates(series)
+
+    dates = dates.to_numpy(dtype='datetime64[ns]')
+    low = np.datetime64(pd.Timestamp(low)) if low is not None else None
+    high = np.datetime64(pd.Timestamp(high) if high is not None else pd.Timestamp.now())
+    invalid = np.isnat(dates) & series.notna().to_numpy()
+    outside = ~np.isnat(dates) & (((dates < low) if low is not None else False) | (dates > high))
+    return invalid, outside
+
+def _outside_domain(series, allowed):
+    """
+    Non-null rows whose value is not allowed, checked on the distinct values.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        ok = np.append(pd.Series(series.cat.categories).isin(allowed).to_numpy(), True) # code -1: null
+        return ~ok[series.cat.codes.to_numpy()]
+    codes, uniques = pd.factorize(series)
+    ok = np.append(pd.Series(uniques, dtype=object).isin(allowed).to_numpy(), True)
+    return ~ok[codes]
+
+def validate(df, rules=rules, report=None):
+    """
+    Checks a table against data quality rules (see the notes above).
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+    rules : dict
+        'uuid' (columns in UUID format), 'unique' (key columns), 'domains' (column -> allowed values) and 'date_ranges'
+        (column -> [first, last] date, None for no limit or, as last date, the current date). Columns missing from the
+        table are skipped.
+    report : QualityReport, optional
+        Report the results are added to (e.g. the report of the previous chunks). A new one by default.
+
+    Returns:
+    --------
+    report : QualityReport
+    """
+    report = report if report is not None else QualityReport()
+    report.rows += len(df)
+
+    for col in df.columns:
+        report.add(col, 'null', df[col].isna().to_numpy(), df[col])
+
+    for col in rules.get('uuid', []):
+        if col in df.columns:
+            report.add(col, 'not a UUID', ~valid_uuids(df[col]) & df[col].notna().to_numpy(), df[col])
+
+    for col, allowed in rules.get('domains', {}).items():
+        if col in df.columns:
+            report.add(col, 'not an allowed value', _outside_domain(df[col], allowed), df[col])
+
+    for col, (low, high) in rules.get('date_ranges', {}).items():
+        if col in df.columns:
+            invalid, outside = _date_range(df[col], low, high)
+            report.add(col, 'not a date', invalid, df[col])
+            report.add(col, 'out of the date range', outside, df[col])
+
+    for col in rules.get('unique', []):
+        if col in df.columns:
+            report.add_keys(col, df[col])
+
+    return report
+
+#========================================================================================================================================
@@ -0,0 +1,47 @@
+import argparse
+import time
+from lib.linkage import blocking, comparisons, link_records, read_columns
+
+#=============================================================================================================================================
+
+# Finds the patients registered more than once under different IDs in a cleaned table (see lib/linkage.py) and writes
+# the clusters with their canonical ID, e.g.:
+#
+#   python link_records.py final_dataset.csv --output clusters.csv --links links.csv
+#   python link_records.py final_dataset.parquet --block data_nascimento sexo bairro --block data_nascimento sexo raca_cor
+
+def main():
+    parser = argparse.ArgumentParser(description='Links the records of the same patient registered under different IDs.')
+    parser.add_argument('input', help='cleaned table (CSV, Parquet or SQLite)')
+    parser.add_argument('--output', default='clusters.csv', help='CSV file of the rows in a cluster and their canonical ID')
+    parser.add_argument('--links', default=None, help='CSV file of the linked pairs and their match weights')
+    parser.add_argument('--block', nargs='+', action='append', default=None, metavar='COLUMN',
+                        help='columns of a blocking key (can be repeated, birth date, sex and neighbourhood by default)')
+    parser.add_argument('--threshold', type=float, default=8.0, help='smallest match weight of a link (log2 likelihood ratio)')
+    parser.add_argument('--max-block', type=int, default=1000, help='blocks with more rows are skipped')
+    parser.add_argument('--batch-pairs', type=int, default=5_000_000, help='number of pairs scored at a time')
+    parser.add_argument('--col', default='id_paciente', help='patient ID column')
+    parser.add_argument('--update-col', default='data_atualizacao_cadastro', help='column that chooses the canonical ID')
+    args = parser.parse_args()
+
+    keys = args.block or blocking
+    numeric = [col for col, options in comparisons.items() if 'tolerance' in options]
+    columns = list(dict.fromkeys([args.col, args.update_col] + [col for key in keys for col in key] + list(comparisons)))
+
+    start = time.perf_counter()
+    df = read_columns(args.input, columns, numeric)
+    clusters, links, summary = link_records(df, args.col, args.update_col, keys, threshold=args.threshold,
+                                            max_block=args.max_block, batch_pairs=args.batch_pairs)
+
+    clusters.to_csv(args.output, sep=';', decimal=',', index_label='row')
+    if args.links is not None:
+        links.to_csv(args.links, sep=';', decimal=',', index=False)
+
+    if summary['skipped_blocks']:
+        print(f"{summary['skipped_blocks']} blocks larger than {args.max_block} rows skipped ({summary['skipped_rows']} rows).")
+    print(f"{summary['candidate_pairs']} candidate pairs, {summary['links']} links: {summary['linked_rows']} rows in "
+          f"{summary['clusters']} clusters.")
+    print('-'*40, f"{summary['rows']} rows, {summary['patients']} patients ({time.perf_counter() - start:.1f} s)", '-'*40)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from benchmarks.synthetic import write
+
+@pytest.fixture(scope='session')
+def raw_extract(tmp_path_factory):
+    """
+    Small synthetic raw extract (see benchmarks/synthetic.py), as a CSV file.
+    """
+    path = str(tmp_path_factory.mktemp('raw') / 'raw.csv')
+    write(3_000, path, seed=0)
+    return path
+
+@pytest.fixture
+def duplicated_patients():
+    """
+    Patients sharing IDs: 'a' (same birth date), 'b' (three entries, two birth dates), 'c' (same birth date, one update
+    date missing), 'd' (same birth date and update date) and 'e' (not duplicated), indexed from 10.
+    """
+    return pd.DataFrame({
+        'id_paciente': ['a', 'a', 'b', 'b', 'b', 'c', 'c', 'd', 'd', 'e'],
+        'data_nascimento': pd.to_datetime(['1990-01-01', '1990-01-01', '1980-05-05', '1985-05-05', '1980-05-05',
+                                           '1970-01-01', '1970-01-01', '2000-01-01', '2000-01-01', '1960-01-01']),
+        'data_atualizacao_cadastro': pd.to_datetime(['2020-01-01', '2022-01-01', '2021-01-01', '2020-01-01', '2019-01-01',
+                                                     None, '2019-01-01', '2020-01-01', '2020-01-01', '2020-01-01']),
+    }, index=range(10, 20))
+
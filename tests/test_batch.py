@@ -0,0 +1,93 @@
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from lib.batch import run_batch
+from lib.database import read_database
+from lib.pipeline import Pipeline
+
+# Batch cleaning of URL inputs with several worker processes.
+
+spec = Pipeline.from_file(str(Path(__file__).resolve().parents[1] / 'pipeline.json')).spec
+
+class Source(BaseHTTPRequestHandler):
+    """
+    Serves Source.content at any path ending in .csv (404 otherwise), counting the requests of each path.
+    """
+
+    content = b''
+    requests = Counter()
+
+    def do_GET(self):
+        Source.requests[self.path] += 1
+        if not self.path.endswith('.csv'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(Source.content)))
+        self.end_headers()
+        self.wfile.write(Source.content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def source(raw_extract):
+    with open(raw_extract, 'rb') as file:
+        Source.content = file.read()
+    Source.requests = Counter()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Source)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+def test_urls_are_downloaded_once_by_the_parent(source, raw_extract, tmp_path):
+    urls = [f'{source}/region{i}/extract.csv' for i in range(4)]
+    manifest = run_batch(spec, urls, str(tmp_path / 'out'), dropna='keep', jobs=3, verbose=False,
+                         cache_dir=str(tmp_path / 'cache'))
+
+    assert manifest['totals'] == {'ok': 4, 'failed': 0, 'skipped': 0}
+    assert Source.requests == Counter({f'/region{i}/extract.csv': 1 for i in range(4)})
+    assert [entry['input'] for entry in manifest['files']] == urls
+
+    local = run_batch(spec, [raw_extract], str(tmp_path / 'local'), dropna='keep', jobs=1, verbose=False)
+    (expected,) = local['files'][0]['outputs']
+    expected = pd.read_csv(expected, sep=';').drop(columns='id_paciente') # new random IDs for patients sharing an ID
+    for entry in manifest['files']:
+        (output,) = entry['outputs']
+        pd.testing.assert_frame_equal(pd.read_csv(output, sep=';').drop(columns='id_paciente'), expected)
+
+def test_failed_download_is_a_failed_attempt(source, tmp_path):
+    urls = [f'{source}/extract.csv', f'{source}/missing']
+    manifest = run_batch(spec, urls, str(tmp_path / 'out'), dropna='keep', jobs=2, retries=1, retry_delay=0,
+                         verbose=False, cache_dir=str(tmp_path / 'cache'))
+
+    ok, failed = manifest['files']
+    assert ok['status'] == 'ok'
+    assert failed['status'] == 'failed' and failed['attempts'] == 2
+    assert 'RawExtractUnavailable' in failed['error']
+    assert sorted(os.listdir(tmp_path / 'out')) == ['extract.csv', 'manifest.json']
+
+def test_database_outputs_keep_the_rows_of_earlier_runs(raw_extract, tmp_path):
+    raw = pd.read_csv(raw_extract)
+    path = str(tmp_path / 'extract.csv')
+    read_ids = lambda: set(read_database(str(tmp_path / 'out' / 'extract.sqlite'))['id_paciente'])
+
+    raw.iloc[:1500].to_csv(path, index=False)
+    run_batch(spec, [path], str(tmp_path / 'out'), output_format='sqlite', dropna='keep', jobs=1, verbose=False)
+    first = read_ids()
+
+    raw.iloc[1500:].to_csv(path, index=False) # next month's extract, same name
+    manifest = run_batch(spec, [path], str(tmp_path / 'out'), output_format='sqlite', dropna='keep', jobs=1, verbose=False)
+    both = read_ids()
+
+    assert manifest['totals']['ok'] == 1
+    assert first < both
+    assert len(both) > manifest['files'][0]['rows_out'] # more patients than the second run wrote
+    assert not [name for name in os.listdir(tmp_path / 'out') if '.partial' in name]
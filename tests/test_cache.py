@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from lib.cache import RawCache
+
+# The raw extract cache against a local HTTP stand-in of the source, shared by several processes.
+
+root = Path(__file__).resolve().parents[1]
+
+def content(name):
+    return (f'id,value\n' + ''.join(f'{name},{i}\n' for i in range(20_000))).encode()
+
+class Source(BaseHTTPRequestHandler):
+    """
+    Serves a different content at each path, always as new (no ETag), so every refresh downloads it.
+    """
+
+    def do_GET(self):
+        data = content(self.path.strip('/'))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def source():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Source)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+worker = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from lib.cache import RawCache
+cache = RawCache(sys.argv[2])
+for _ in range(5):
+    for url in sys.argv[3:]:
+        with open(cache.fetch(url, refresh=True), 'rb') as file: # removed by another process otherwise
+            file.read()
+"""
+
+def test_processes_share_the_cache(source, tmp_path):
+    urls = [f'{source}/extract{i}.csv' for i in range(12)]
+    processes = [subprocess.Popen([sys.executable, '-c', worker, str(root), str(tmp_path), *urls[i::3]],
+                                  stderr=subprocess.PIPE, text=True) for i in range(3)]
+    errors = [process.communicate(timeout=300)[1] for process in processes]
+    assert [process.returncode for process in processes] == [0, 0, 0], errors
+
+    index = json.loads((tmp_path / 'index.json').read_text())
+    assert set(index) == set(urls)
+    for url in urls:
+        path = RawCache(str(tmp_path))._object(index[url]['sha256'], 'csv')
+        with open(path, 'rb') as file:
+            assert file.read() == content(url.rsplit('/', 1)[1])
+    objects = os.listdir(tmp_path / 'objects')
+    assert not [name for name in objects if name.endswith('.tmp')]
+    assert len(objects) == len(urls)
+
+def test_download_is_hashed_while_streamed(source, tmp_path):
+    cache = RawCache(str(tmp_path))
+    url = f'{source}/extract.csv'
+    path = cache.fetch(url)
+    digest = hashlib.sha256(content('extract.csv')).hexdigest()
+    assert os.path.basename(path) == f'{digest}.csv'
+    assert json.loads((tmp_path / 'index.json').read_text())[url]['size'] == len(content('extract.csv'))
+
+def test_downloads_in_progress_are_kept(source, tmp_path):
+    cache = RawCache(str(tmp_path))
+    url = f'{source}/extract.csv'
+    cache.fetch(url)
+    tmp = cache._temporary() # another process downloading
+    cache.invalidate(url)
+    assert os.listdir(tmp_path / 'objects') == [os.path.basename(tmp)]
+    cache.clear()
+    assert os.path.exists(tmp)
+
+def test_objects_newer_than_the_index_read_are_kept(source, tmp_path):
+    cache = RawCache(str(tmp_path))
+    index = cache._index()
+    newer = cache._object('0' * 64, 'csv') # written by another process after the index was read
+    Path(newer).write_bytes(b'id\n')
+    os.utime(newer, (cache._read_at + 1, cache._read_at + 1))
+    cache._remove_unreferenced(index)
+    assert os.path.exists(newer)
@@ -0,0 +1,49 @@
+import sqlite3
+
+import pandas as pd
+
+from lib.database import read_database, SQLiteSink, write_database
+from lib.functions import encode_list_column
+
+# Upserts into the SQLite output: the most recent record of each patient wins, with its lists.
+
+def patients(ids, updated, diseases, flags, heights):
+    df = pd.DataFrame({'id_paciente': ids, 'data_atualizacao_cadastro': pd.to_datetime(updated),
+                       'doencas_condicoes': diseases, 'diabetes_flag': flags, 'altura': heights})
+    return encode_list_column(df, 'doencas_condicoes')
+
+def test_patients_are_upserted_with_their_lists(tmp_path):
+    path = str(tmp_path / 'patients.sqlite')
+    write_database(patients(['a', 'b'], ['2020-01-01', '2020-01-01'],
+                            ["['Diabetes', 'Asma']", "['Hipertensão']"], [1, 0], [150.0, 170.0]), path)
+    write_database(patients(['a', 'b', 'c'], ['2021-01-01', '2019-01-01', '2021-01-01'], # 'b' is older than the stored one
+                            ["['Asma']", '[]', None], [0, 1, 0], [151.0, 171.0, 180.0]), path)
+
+    df = read_database(path)
+    assert list(df['id_paciente']) == ['a', 'b', 'c']
+    assert list(df['data_atualizacao_cadastro']) == list(pd.to_datetime(['2021-01-01', '2020-01-01', '2021-01-01']))
+    assert list(df['altura']) == [151.0, 170.0, 180.0]
+    assert list(df['diabetes_flag']) == [0, 0, 0]
+    assert list(df['doencas_condicoes']) == ["['Asma']", "['Hipertensão']", "['Não informado']"]
+
+    with sqlite3.connect(path) as connection: # the lists of 'a' were replaced, not added to
+        assert connection.execute("SELECT value FROM patients_doencas_condicoes WHERE id_paciente = 'a' "
+                                  "ORDER BY position").fetchall() == [('Asma',)]
+
+def test_repeated_id_in_one_write_keeps_the_latest(tmp_path):
+    path = str(tmp_path / 'patients.sqlite')
+    write_database(patients(['a', 'a'], ['2021-01-01', '2020-01-01'], ["['Asma']", "['Diabetes']"], [0, 1], [150.0, 160.0]), path)
+    df = read_database(path)
+    assert list(df['altura']) == [150.0] and list(df['doencas_condicoes']) == ["['Asma']"]
+
+def test_indexes_exist_after_close(tmp_path):
+    path = str(tmp_path / 'patients.sqlite')
+    with SQLiteSink(path) as sink:
+        sink.write(patients(['a', 'b'], ['2020-01-01', '2021-01-01'], ["['Asma']", None], [1, 0], [150.0, 160.0]))
+
+    with sqlite3.connect(path) as connection:
+        indexes = dict(connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"))
+        journal, = connection.execute('PRAGMA journal_mode').fetchone()
+    assert set(indexes) == {'patients_data_atualizacao_cadastro', 'patients_diabetes_flag', 'patients_doencas_condicoes_value'}
+    assert indexes['patients_diabetes_flag'].endswith('WHERE "diabetes_flag" = 1') # partial: only the flagged rows
+    assert journal == 'delete'
@@ -0,0 +1,27 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from lib.engines import engine_classes, run_engine
+from lib.loader import load_raw
+from lib.pipeline import Pipeline
+from lib.streaming import write_csv
+
+# The Polars and DuckDB backends write the same table as the pandas pipeline run in memory.
+
+pipeline_file = str(Path(__file__).resolve().parents[1] / 'pipeline.json')
+
+@pytest.mark.parametrize('engine', list(engine_classes))
+def test_engine_equals_the_run_in_memory(engine, raw_extract, tmp_path):
+    pytest.importorskip(engine)
+    expected, output = str(tmp_path / 'pandas.csv'), str(tmp_path / f'{engine}.csv')
+    pipeline = Pipeline.from_file(pipeline_file)
+    write_csv(pipeline.run(load_raw(raw_extract)[0]), expected, None, sep=';', decimal=',')
+
+    engine_pipeline = Pipeline.from_file(pipeline_file)
+    run_engine(engine_pipeline, raw_extract, {output: False}, engine)
+
+    read = lambda path: pd.read_csv(path, sep=';', decimal=',').drop(columns='id_paciente') # new random IDs for shared IDs
+    pd.testing.assert_frame_equal(read(output), read(expected))
+    assert engine_pipeline.reports() == pipeline.reports()
@@ -0,0 +1,184 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.database import _list_rows
+from lib.functions import (calculate_IQR_lims_by_stratum, classify_duplicates, clean_values, contains_any, disease_flag_col,
+                           diseases_flag, encode_list_column, handle_lists, identify_outliers_by_stratum, multi_hot,
+                           parse_list_string, PatientIdAllocator, replace_strings, replace_tokens, replace_values,
+                           ReplacementTable, resolve_duplicates, strata, valid_uuids)
+from lib.pipeline import Pipeline
+from lib.storage import list_column_to_arrow
+
+# Encoded list columns (see encode_list_column): the category labels are parsed like the raw values.
+
+raw = ['["Hipertens\\u00e3o", "Diabetes"]', "['Carro']", 'Diabetes, Asma', "[\"d'água\", 'x\\\\y']", '[]', None]
+
+def encoded():
+    return encode_list_column(pd.DataFrame({'col': raw}), 'col')['col']
+
+def test_labels_are_parsed_like_the_raw_values():
+    series = encoded()
+    expected = [parse_list_string(value) for value in raw]
+
+    vocabulary, matrix = multi_hot(series)
+    assert [[vocabulary[i] for i in np.flatnonzero(matrix[code])] for code in series.cat.codes] == expected
+    assert list_column_to_arrow(series).to_pylist() == expected
+
+    ids, positions, values = _list_rows(np.arange(len(raw)), series)
+    assert values.tolist() == [item for items in expected for item in items]
+    assert positions == [i for items in expected for i in range(len(items))]
+
+    fixed = replace_tokens(pd.DataFrame({'col': series}), 'col', ['Diabetes', 'Asma'])['col']
+    assert [parse_list_string(label) for label in fixed.astype(str)] == [[item if item in ['Diabetes', 'Asma'] else 'Outros'
+                                                                         for item in items] for items in expected]
+
+def test_labels_that_are_not_python_literals():
+    series = pd.Series(['Diabetes, Asma', 'Carro'], dtype='category')
+    assert contains_any(series, ['Asma']).tolist() == [1, 0]
+    assert list_column_to_arrow(series).to_pylist() == [['Diabetes', 'Asma'], ['Carro']]
+
+def test_null_lists_contain_nothing():
+    # Null rows have code -1, the position of the last category ('Diabetes')
+    series = pd.Series(pd.Categorical.from_codes([-1, 0, -1, 1], categories=["['Carro']", "['Diabetes']"]))
+    assert contains_any(series, ['Diabetes']).tolist() == [0, 0, 0, 1]
+    assert contains_any(series.astype(object).map(parse_list_string, na_action='ignore'), ['Diabetes']).tolist() == [0, 0, 0, 1]
+    assert contains_any(pd.Series([None, None], dtype='category'), ['Diabetes']).tolist() == [0, 0]
+
+    df = diseases_flag(pd.DataFrame({'doencas_condicoes': series}))
+    lists = diseases_flag(pd.DataFrame({'doencas_condicoes': series.astype(object).map(parse_list_string, na_action='ignore')}))
+    assert df[disease_flag_col('Diabetes')].tolist() == lists[disease_flag_col('Diabetes')].tolist() == [0, 0, 0, 1]
+
+@pytest.mark.parametrize('value, expected', [
+    ("[r'a\\n']", ['a\\n']), # raw string: the backslash is kept
+    ("['\\N{DEGREE SIGN}', u'\\u00e3']", ['°', 'ã']),
+    ("['\\N{NO SUCH NAME}']", ['Não informado']),
+    ("['''Carro''', \"\"\"d'água\"\"\"]", ['Carro', "d'água"]),
+    ("['Ca' r'rro',\\\n 'Asma']", ['Carro', 'Asma']), # adjacent strings and a line continuation
+    ("['''Carro']", ['Não informado']), # unterminated triple quote
+    ("[b'Carro']", ['Não informado']), # bytes cannot be joined
+])
+def test_lists_are_read_like_python_literals(value, expected):
+    assert parse_list_string(value) == expected
+
+def test_lists_are_read_like_clean_values_then_handle_lists():
+    rng = np.random.default_rng(0)
+    pieces = list("[]'\", \\rRubNnx0A{}\n") + ['\\N{DEGREE SIGN}', "r'", 'u"', "'''"]
+    for _ in range(20_000):
+        value = '[' + ''.join(rng.choice(pieces, rng.integers(0, 12))) + ']'
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # invalid escape sequences
+            expected = handle_lists(clean_values(value))
+        assert parse_list_string(value) == expected, value
+
+# Duplicated patient IDs (see the duplicated_patients fixture): same birth date -> the latest entry is kept, different
+# birth dates -> the others get a new ID.
+
+def test_duplicates_are_classified_by_birth_date(duplicated_patients):
+    log = classify_duplicates(duplicated_patients)
+    assert list(log.index) == list(range(10, 19)) # 'e' is not duplicated
+    assert list(log['rule']) == ['same_birth'] * 2 + ['different_birth'] * 3 + ['same_birth'] * 4
+    assert list(log['action']) == ['dropped', 'kept',                   # the latest update is kept
+                                   'kept', 'reassigned', 'reassigned',  # the first entry keeps the ID
+                                   'dropped', 'kept',                   # a missing update date loses
+                                   'kept', 'dropped']                   # ties keep the first entry
+
+def test_duplicates_are_resolved_with_new_unique_ids(duplicated_patients):
+    df = duplicated_patients
+    resolved, log = resolve_duplicates(df, allocator=PatientIdAllocator(df['id_paciente'], seed=0))
+
+    assert list(resolved.index) == [11, 12, 13, 14, 16, 17, 19]
+    assert list(resolved.loc[[11, 12, 16, 17, 19], 'id_paciente']) == ['a', 'b', 'c', 'd', 'e']
+    new_ids = resolved.loc[[13, 14], 'id_paciente']
+    assert list(new_ids) == list(log.loc[[13, 14], 'new_id'])
+    assert resolved['id_paciente'].is_unique and valid_uuids(new_ids).all()
+
+# Replacement rules compiled into one table: conflicts always raise, chains raise unless allowed.
+
+def test_conflicting_rules_raise():
+    with pytest.raises(ValueError, match="Conflicting replacement rules: 'Não' in rules 0 and 1"):
+        ReplacementTable([{'Input': ['Não', 'Nao'], 'output': 'Sem religião'}, {'Input': 'Não', 'output': 'Não informado'}])
+    with pytest.raises(ValueError, match='Conflicting'): # null values are one input too
+        ReplacementTable([(None, 'Não informado'), ([np.nan, 'x'], 'Outra')])
+    with pytest.raises(ValueError, match='Conflicting'): # when the pipeline is loaded, not when it runs
+        Pipeline({'steps': [{'step': 'replace_values', 'col': 'religiao', 'rules': [['A', 'B'], ['A', 'C']]}]})
+
+@pytest.mark.parametrize('rules, expected', [
+    ([('A', 'B'), ('B', 'C')], ['C', 'C', 'C', 'D']),  # the output of rule 0 goes through rule 1
+    ([('B', 'C'), ('A', 'B')], ['B', 'C', 'C', 'D']),  # rule 1 comes after rule 0: 'A' stops at 'B'
+])
+def test_chained_rules_raise_unless_allowed(rules, expected):
+    with pytest.raises(ValueError, match='Chained replacement rules'):
+        ReplacementTable(rules)
+
+    values = pd.Series(['A', 'B', 'C', 'D'])
+    sequential = pd.DataFrame({'col': values})
+    for Input, output in rules:
+        sequential = replace_strings(sequential, 'col', [Input], output)
+    assert list(sequential['col']) == expected
+
+    report = {}
+    table = replace_values(pd.DataFrame({'col': values}), 'col', rules, allow_chains=True, report=report)
+    assert list(table['col']) == expected
+    assert sum(report.values()) == sum(a != b for a, b in zip(values, expected))
+
+# New patient IDs: reproducible with a seed, never an existing ID nor twice the same.
+
+def test_seeded_ids_are_reproducible():
+    first, second = PatientIdAllocator(seed=7).allocate(500), PatientIdAllocator(seed=7).allocate(500)
+    assert first == second
+    assert first != PatientIdAllocator(seed=8).allocate(500)
+    assert valid_uuids(pd.Series(first)).all()
+
+def test_ids_collide_neither_with_existing_ones_nor_with_each_other(monkeypatch):
+    existing = PatientIdAllocator(seed=1).allocate(200)
+    allocator = PatientIdAllocator(existing[:100], seed=1) # the same random stream: its first candidates exist
+    ids = allocator.allocate(300)
+    assert len(set(ids)) == 300 and not set(ids) & set(existing[:100])
+    assert not set(allocator.allocate(300)) & set(ids) # the allocated IDs are added to the index
+
+    candidates = iter([['x', 'x', 'y'], ['y', 'z', 'w']]) # repeated candidates, within and across batches
+    allocator = PatientIdAllocator(['w'])
+    monkeypatch.setattr(allocator, '_candidates', lambda n: next(candidates))
+    assert allocator.allocate(3) == ['x', 'y', 'z']
+
+# Outlier limits by age band and sex: adult women and men get their own limits, a small band those of the whole column.
+
+def heights(rows):
+    """
+    Rows of (sex, age, height), updated on 2020-01-01.
+    """
+    sex, age, height = zip(*rows)
+    return pd.DataFrame({'sexo': sex, 'data_nascimento': [f'{2020 - a}-01-01' for a in age],
+                         'data_atualizacao_cadastro': '2020-01-01', 'altura': height})
+
+def fitted_heights():
+    women = [('feminino', 40, 150 + i % 10) for i in range(40)]
+    men = [('masculino', 40, 180 + i % 10) for i in range(40)]
+    children = [('feminino', 5, 100 + i) for i in range(5)] # fewer than min_count
+    return heights(women + men + children)
+
+def test_each_stratum_gets_its_own_limits():
+    df = fitted_heights()
+    keys = strata(df, 'sexo', 'data_nascimento', 'data_atualizacao_cadastro', [0, 18])
+    limits = pd.DataFrame(calculate_IQR_lims_by_stratum(df, ['altura'], keys)).set_index(['age_band', 'sex'])
+    women, men, children = limits.loc[('18+', 'feminino')], limits.loc[('18+', 'masculino')], limits.loc[('0-18', 'feminino')]
+    assert women['upper'] < men['lower'] # two strata whose limits differ
+    assert (women['count'], men['count'], children['count']) == (40, 40, 5)
+    assert children[['lower', 'upper']].tolist() == limits.loc[('*', '*'), ['lower', 'upper']].tolist()
+
+    rows = heights([('feminino', 40, 158), ('masculino', 40, 158), ('feminino', 40, 185), ('masculino', 40, 185),
+                    ('feminino', 5, 105), (None, 40, 158)]) # the last stratum was not in the fitted table
+    keys = strata(rows, 'sexo', 'data_nascimento', 'data_atualizacao_cadastro', [0, 18])
+    flags = identify_outliers_by_stratum(rows, ['altura'], keys, limits.reset_index().to_dict('records'))
+    assert flags['altura_outlier_flag'].tolist() == [0, 1, 1, 0, 1, 0]
+
+def test_fixed_lower_limit_applies_to_every_stratum():
+    step = {'step': 'stratified_outlier_flags', 'cols': ['altura'], 'age_bands': [0, 18], 'sex_col': 'sexo',
+            'birth_col': 'data_nascimento', 'reference_col': 'data_atualizacao_cadastro'}
+    df = fitted_heights()
+    assert Pipeline({'steps': [step]}).run(df.copy())['altura_outlier_flag'].tail(5).tolist() == [1] * 5
+    floored = Pipeline({'steps': [{**step, 'lower_limits': {'altura': 40}}]}).run(df.copy())
+    assert floored['altura_outlier_flag'].tail(5).tolist() == [0] * 5 # the children are no longer flagged
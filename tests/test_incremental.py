@@ -0,0 +1,128 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.incremental import StateStore, read_delta, run_incremental
+from lib.loader import load_raw
+from lib.pipeline import Pipeline, StratifiedOutlierFlags
+
+# Incremental cleaning against a full clean of the same extract, and the high-water mark.
+
+spec_path = str(Path(__file__).resolve().parents[1] / 'pipeline.json')
+
+def full_clean(path):
+    df, _ = load_raw(path)
+    return Pipeline.from_file(spec_path).run(df)
+
+def incremental(path, store):
+    result = run_incremental(Pipeline.from_file(spec_path), path, store, chunksize=1_000)
+    state = StateStore(store)
+    df = state.load()
+    state.close()
+    return result, df
+
+def same_table(left, right, col='id_paciente'):
+    """
+    Whether two cleaned tables hold the same rows, whatever their order and column types. The IDs given to the patients
+    sharing an ID are random, so they are only compared as the set of IDs kept from the extract.
+    """
+    def rows(df):
+        text = df.drop(columns=col).astype(str).replace({'nan': 'None', 'NaT': 'None', '<NA>': 'None'})
+        return text.sort_values(list(text.columns), ignore_index=True)
+    assert len(left) == len(right)
+    pd.testing.assert_frame_equal(rows(left), rows(right), check_dtype=False)
+
+def mixed_births(df):
+    """
+    Number of rows whose ID is shared by rows of another birth date, among them rows with the same birth date.
+    """
+    mixed = df.groupby('id_paciente')['data_nascimento'].transform('nunique') > 1
+    return int((mixed & df.duplicated(['id_paciente', 'data_nascimento'], keep=False)).sum())
+
+def test_first_run_equals_full_clean(raw_extract, tmp_path):
+    assert mixed_births(pd.read_csv(raw_extract)) # IDs shared by different patients, some with the same birth date
+    (N_delta, N_upserted, N_undated), df = incremental(raw_extract, str(tmp_path / 'state.db'))
+    full = full_clean(raw_extract)
+    assert (N_delta, N_upserted) == (3_000, len(full))
+    same_table(df, full)
+
+def test_later_runs_equal_full_clean(raw_extract, tmp_path):
+    extract = pd.read_csv(raw_extract, dtype=str, keep_default_na=False)
+    first = str(tmp_path / 'first.csv')
+    extract.to_csv(first, index=False)
+
+    # Updates in place of single patients and of rows of IDs shared by patients with the same birth date. The update date
+    # moves by a second only, so that the age band of the outlier limits (stored on the first run) stays the same.
+    registered = pd.to_datetime(extract['data_atualizacao_cadastro'], format='ISO8601', errors='coerce')
+    groups = extract.groupby('id_paciente')['data_nascimento']
+    shared = (groups.transform('nunique') > 1) & extract.duplicated(['id_paciente', 'data_nascimento'], keep=False)
+    single = extract['id_paciente'].map(extract['id_paciente'].value_counts()) == 1
+    updated = np.concatenate([extract.index[shared & registered.notna()][:4], extract.index[single & registered.notna()][:20]])
+    later = extract.copy()
+    later.loc[updated, 'updated_at'] = '2025-02-01 08:00:00'
+    later.loc[updated, 'data_atualizacao_cadastro'] = (registered[updated] + pd.Timedelta(seconds=1)).dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    later.loc[updated, 'bairro'] = 'Tijuca'
+
+    # New rows (without vitals, so the outlier limits stay the same): a new patient and a new ID shared by two patients
+    new = extract.iloc[:4].copy()
+    new['id_paciente'] = ['00000000-0000-4000-8000-000000000001'] + ['00000000-0000-4000-8000-000000000002'] * 3
+    new['data_nascimento'] = ['1990-01-01', '1980-05-05', '1970-07-07', '1980-05-05']
+    new[['altura', 'peso', 'pressao_sistolica', 'pressao_diastolica']] = ''
+    new[['updated_at', 'data_atualizacao_cadastro']] = '2025-02-02 08:00:00'
+    later = pd.concat([later, new], ignore_index=True)
+    second = str(tmp_path / 'second.csv')
+    later.to_csv(second, index=False)
+
+    store = str(tmp_path / 'state.db')
+    incremental(first, store)
+    (N_delta, N_upserted, _), df = incremental(second, store)
+    assert N_delta == len(updated) + len(new) + 1 # and the row at the mark of the first run
+    assert N_upserted == len(updated) + len(new)
+    same_table(df, full_clean(second))
+
+    (N_delta, N_upserted, _), again = incremental(second, store) # the new rows are at the mark: read again, no changes
+    assert (N_delta, N_upserted) == (len(new), 0)
+    same_table(again, df)
+
+def test_high_water_mark(tmp_path):
+    path = str(tmp_path / 'extract.csv')
+    pd.DataFrame({'id': list('abcdef'),
+                  'updated_at': ['2024-01-01', '2024-03-01 10:00:00', '2024-03-01 10:00:00.500', '', 'not a date',
+                                 '2024-02-29 23:59:59']}).to_csv(path, index=False)
+
+    delta, N_undated = read_delta(path, None, 2)
+    assert list(delta['id']) == list('abcdef') and N_undated == 2
+
+    delta, N_undated = read_delta(path, pd.Timestamp('2024-03-01 10:00:00'), 2)
+    assert list(delta['id']) == list('bcde') # at or after the mark, and the rows without a valid date
+    assert list(delta.index) == [1, 2, 3, 4] and N_undated == 2
+
+    assert read_delta(path, pd.Timestamp('2024-03-02'), 2)[0]['id'].tolist() == list('de')
+
+def test_stored_states_follow_the_step_specification(raw_extract, tmp_path, monkeypatch):
+    store = str(tmp_path / 'state.db')
+    spec = json.loads(Path(spec_path).read_text(encoding='utf-8'))
+    run_incremental(Pipeline(spec), raw_extract, store, chunksize=1_000)
+    state = StateStore(store)
+    (limits,) = state.get('states').values()
+    state.close()
+
+    fits = []
+    monkeypatch.setattr(StratifiedOutlierFlags, 'fit_stream', lambda self, path, chunksize: fits.append(self) or limits)
+
+    # Steps moved: the stored limits are still found
+    moved = {**spec, 'steps': spec['steps'][1:2] + spec['steps'][:1] + spec['steps'][2:]}
+    run_incremental(Pipeline(moved), raw_extract, store, chunksize=1_000)
+    assert fits == []
+
+    # Parameters changed: the limits are fitted again instead of reusing the ones of the old step
+    changed = {**spec, 'steps': [{**step, 'factor': 3.0} if step['step'] == 'stratified_outlier_flags' else step
+                                 for step in spec['steps']]}
+    run_incremental(Pipeline(changed), raw_extract, store, chunksize=1_000)
+    assert [step.factor for step in fits] == [3.0]
+    state = StateStore(store)
+    assert len(state.get('states')) == 1 # the states of steps no longer in the specification are dropped
+    state.close()
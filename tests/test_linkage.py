@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+from lib.linkage import block_ids, candidate_pairs, comparison_fields, link_records, match_weights, score_pairs
+
+# Record linkage on a small table where some patients are registered twice under different IDs.
+
+comparisons = {'raca_cor': {'m': 0.95}, 'escolaridade': {'m': 0.9}, 'religiao': {'m': 0.9}, 'altura': {'m': 0.9, 'tolerance': 3}}
+
+def registrations():
+    """
+    Random patients (so that the u probabilities are estimated on different people) and, in a neighbourhood of their
+    own: 'p1' and 'p1-copy' (same person, one height a bit off), 'p2', 'p2-copy' and 'p2-again' (same person three
+    times) and 'p3' (the values of 'p1' but another birth date, so another block).
+    """
+    rng = np.random.default_rng(0)
+    n = 300
+    df = pd.DataFrame({
+        'id_paciente': [f'other-{i}' for i in range(n)],
+        'data_nascimento': rng.choice(pd.date_range('1950-01-01', periods=40, freq='YS'), n),
+        'sexo': rng.choice(['masculino', 'feminino'], n),
+        'bairro': rng.choice(['Centro', 'Tijuca', 'Méier'], n),
+        'raca_cor': rng.choice(['Branca', 'Parda', 'Preta', 'Amarela', 'Indígena'], n),
+        'escolaridade': rng.choice(['Fundamental', 'Médio', 'Superior', 'Iletrado', 'Pós'], n),
+        'religiao': rng.choice(['Católica', 'Evangélica', 'Sem religião', 'Espírita', 'Outra'], n),
+        'altura': rng.normal(165, 15, n).round(),
+        'data_atualizacao_cadastro': pd.Timestamp('2020-01-01'),
+    })
+    person = {'sexo': 'feminino', 'bairro': 'Copacabana', 'raca_cor': 'Parda', 'escolaridade': 'Superior',
+              'religiao': 'Católica', 'altura': 160.0}
+    known = pd.DataFrame([
+        {**person, 'id_paciente': 'p1', 'data_nascimento': pd.Timestamp('1990-03-01'),
+         'data_atualizacao_cadastro': pd.Timestamp('2021-01-01')},
+        {**person, 'id_paciente': 'p1-copy', 'altura': 162.0, 'data_nascimento': pd.Timestamp('1990-03-01'),
+         'data_atualizacao_cadastro': pd.Timestamp('2023-01-01')},
+        {**person, 'id_paciente': 'p2', 'religiao': 'Espírita', 'data_nascimento': pd.Timestamp('1985-07-07'),
+         'data_atualizacao_cadastro': pd.Timestamp('2022-01-01')},
+        {**person, 'id_paciente': 'p2-copy', 'religiao': 'Espírita', 'data_nascimento': pd.Timestamp('1985-07-07'),
+         'data_atualizacao_cadastro': pd.Timestamp('2020-06-01')},
+        {**person, 'id_paciente': 'p2-again', 'religiao': 'Espírita', 'data_nascimento': pd.Timestamp('1985-07-07'),
+         'data_atualizacao_cadastro': None},
+        {**person, 'id_paciente': 'p3', 'data_nascimento': pd.Timestamp('1990-03-02')}, # another birth date
+    ])
+    return pd.concat([df, known], ignore_index=True)
+
+def test_known_matches_end_up_in_one_cluster():
+    df = registrations()
+    clusters, links, summary = link_records(df, comparisons=comparisons, threshold=6.0, sample=20_000)
+
+    by_id = clusters.set_index('id_paciente')
+    assert by_id.loc['p1', 'cluster'] == by_id.loc['p1-copy', 'cluster']
+    assert by_id.loc['p2', 'cluster'] == by_id.loc['p2-copy', 'cluster'] == by_id.loc['p2-again', 'cluster']
+    assert by_id.loc['p1', 'cluster'] != by_id.loc['p2', 'cluster']
+    assert 'p3' not in by_id.index # never compared: another block
+    assert by_id.loc[['p1', 'p1-copy'], 'canonical_id'].tolist() == ['p1-copy'] * 2 # most recently updated
+    assert by_id.loc[['p2', 'p2-copy', 'p2-again'], 'canonical_id'].tolist() == ['p2'] * 3
+    assert summary['patients'] == summary['rows'] - summary['linked_rows'] + summary['clusters']
+
+def test_blocking_only_pairs_rows_of_the_same_block():
+    df = registrations()
+    key = ['data_nascimento', 'sexo', 'bairro']
+    blocks = block_ids(df, key)
+    batches, skipped = candidate_pairs(blocks, batch_pairs=50)
+    pairs = [pair for left, right in batches for pair in zip(left, right)]
+
+    assert skipped == {'blocks': 0, 'rows': 0}
+    assert all(left != right and blocks[left] == blocks[right] for left, right in pairs)
+    sizes = pd.Series(blocks).value_counts()
+    assert len(pairs) == len(set(map(frozenset, pairs))) == int((sizes * (sizes - 1) // 2).sum()) # every pair once
+
+    with_null = df.assign(bairro=df['bairro'].where(df['id_paciente'] != 'p1-copy'))
+    assert block_ids(with_null, key)[df['id_paciente'] == 'p1-copy'] == -1 # no block without the whole key
+
+    batches, skipped = candidate_pairs(blocks, max_block=2)
+    assert skipped['blocks'] == int((sizes > 2).sum())
+    assert all((sizes[blocks[left]] <= 2).all() for left, _ in batches)
+
+def test_score_grows_with_the_agreeing_fields():
+    df = registrations()
+    fields = comparison_fields(df, comparisons)
+    weights = match_weights(fields, sample=20_000)
+    assert all(agree > 0 > disagree for agree, disagree, _ in weights.values())
+
+    # Pairs of a row with copies of it that disagree on fewer and fewer fields
+    row = df.iloc[[-1]]
+    others = {'raca_cor': 'Branca', 'escolaridade': 'Iletrado', 'religiao': 'Outra', 'altura': 190.0}
+    copies = [row.assign(**dict(list(others.items())[:k])) for k in range(len(others), -1, -1)]
+    table = pd.concat([df] + copies, ignore_index=True)
+    fields = comparison_fields(table, comparisons)
+    left = np.full(len(copies), len(df) - 1)
+    right = np.arange(len(df), len(table))
+    score = score_pairs(fields, weights, left, right)
+    assert np.all(np.diff(score) > 0)
+
+    missing = table.assign(raca_cor=table['raca_cor'].where(table.index != right[0]))
+    score_missing = score_pairs(comparison_fields(missing, comparisons), weights, left[:1], right[:1])
+    assert score[0] < score_missing[0] < score[1] # a missing value counts neither for nor against
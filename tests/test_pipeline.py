@@ -0,0 +1,60 @@
+from pathlib import Path
+
+import pandas as pd
+
+from lib.loader import load_raw
+from lib.pipeline import FusedMap, Pipeline
+
+# Steps fused into a single pass over the distinct values give the same table and reports as the steps run one by one.
+
+pipeline_file = str(Path(__file__).resolve().parents[1] / 'pipeline.json')
+
+def unfused(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, 'plan', pipeline.needed)
+    return pipeline
+
+def test_shipped_spec_fuses_replacements_and_income():
+    (group,) = [group for group in Pipeline.from_file(pipeline_file).plan() if isinstance(group, FusedMap)]
+    assert [step.name for step in group.steps] == ['replace_values', 'transform_family_income']
+    assert group.col == 'renda_familiar'
+
+def test_fused_run_equals_steps_one_by_one(raw_extract, monkeypatch):
+    for read in (pd.read_csv, lambda path: load_raw(path)[0]): # object and categorical columns
+        fused = Pipeline.from_file(pipeline_file)
+        eager = unfused(Pipeline.from_file(pipeline_file), monkeypatch)
+        expected = eager.run(read(raw_extract)).drop(columns='id_paciente') # new random IDs for patients sharing an ID
+        result = fused.run(read(raw_extract)).drop(columns='id_paciente')
+
+        pd.testing.assert_frame_equal(result, expected)
+        assert result.to_csv(sep=';', decimal=',').encode() == expected.to_csv(sep=';', decimal=',').encode()
+        assert fused.reports() == eager.reports()
+        assert any(key.startswith('renda_familiar') and count > 0 for key, count in fused.report_table()[['item', 'count']].values)
+
+def test_fused_report_counts_weighted_rows():
+    pipeline = Pipeline({'steps': [
+        {'step': 'replace_values', 'col': 'renda_familiar', 'rules': [{'Input': 'Manhã', 'output': 'Não informado'}]},
+        {'step': 'transform_family_income'},
+    ]})
+    (group,) = pipeline.plan()
+    distinct = pd.DataFrame({'renda_familiar': ['Manhã', 'Até 1 Salário Mínimo', 'Internet']})
+    group.run(distinct, weights=[5, 2, 1]) # distinct values standing for 8 rows (see lib/engines.py)
+    assert pipeline.reports() == {0: {'renda_familiar: Manhã -> Não informado': 5}}
+
+def test_parallel_runs_equal_the_run_in_memory(raw_extract):
+    expected = Pipeline.from_file(pipeline_file).run(load_raw(raw_extract)[0]).drop(columns='id_paciente')
+    for by in ('rows', 'columns'):
+        result = Pipeline.from_file(pipeline_file).run_parallel(load_raw(raw_extract)[0], 2, by=by)
+        pd.testing.assert_frame_equal(result.drop(columns='id_paciente'), expected)
+
+def test_chunked_duplicates_plan_equals_the_run_in_memory(duplicated_patients, tmp_path):
+    spec = {'steps': [{'step': 'duplicates', 'col': 'id_paciente', 'seed': 0}]}
+    df = duplicated_patients.reset_index(drop=True)
+    path, output = str(tmp_path / 'raw.csv'), str(tmp_path / 'chunked.csv')
+    df.to_csv(path, index=False)
+
+    expected = Pipeline(spec).run(pd.read_csv(path))
+    assert list(expected.index) == [1, 2, 3, 4, 6, 7, 9]
+    assert expected['id_paciente'].is_unique
+
+    Pipeline(spec).run_chunked(path, {output: False}, chunksize=3) # the entries of 'b' and 'c' fall in different chunks
+    pd.testing.assert_frame_equal(pd.read_csv(output, sep=';', decimal=','), expected.reset_index(drop=True))
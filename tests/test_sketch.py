@@ -0,0 +1,43 @@
+import numpy as np
+
+from lib.sketch import KLLSketch
+
+# Quantile sketches: the rank error stays within the bound of lib/sketch.py, in chunks, merged and after JSON round trips.
+
+percentiles = np.linspace(0.01, 0.99, 99)
+
+def rank_error(sketch, values):
+    """
+    Largest distance between the requested percentiles and the true ranks of their estimates.
+    """
+    ranks = np.searchsorted(np.sort(values), sketch.quantile(percentiles), side='right') / len(values)
+    return np.abs(ranks - percentiles).max()
+
+def test_rank_error_in_chunks():
+    values = np.random.default_rng(0).lognormal(0, 1, 200_000)
+    sketch = KLLSketch(seed=0)
+    for chunk in np.array_split(values, 37):
+        sketch.update(np.append(chunk, np.nan)) # null values are ignored
+    assert len(sketch) == len(values)
+    assert sum(map(len, sketch.compactors)) < 1_000
+    assert rank_error(sketch, values) < 0.0165
+    assert abs(sketch.quantile(0.5) - np.quantile(values, 0.5)) < 0.05
+
+def test_small_samples_are_exact():
+    values = np.random.default_rng(1).normal(size=150)
+    np.testing.assert_array_equal(KLLSketch().update(values).quantile([0.25, 0.75]), np.quantile(values, [0.25, 0.75]))
+    assert np.isnan(KLLSketch().quantile(0.5))
+
+def test_merged_sketches_round_trip_through_json():
+    values = np.random.default_rng(2).lognormal(0, 1, 200_000)
+    shards = [KLLSketch(seed=i).update(part) for i, part in enumerate(np.array_split(values, 8))]
+
+    copy = KLLSketch.from_json(shards[1].to_json())
+    assert copy.to_dict() == shards[1].to_dict()
+    np.testing.assert_array_equal(copy.quantile(percentiles), shards[1].quantile(percentiles))
+
+    merged = KLLSketch.from_json(shards[0].to_json(), seed=0)
+    for shard in shards[1:]:
+        merged.merge(KLLSketch.from_json(shard.to_json()))
+    assert len(merged) == len(values)
+    assert rank_error(merged, values) < 0.0165
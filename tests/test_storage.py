@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lib.loader import load_raw
+from lib.pipeline import Pipeline
+from lib.storage import ParquetChunkWriter, arrow_types, write_table
+
+# Parquet files written chunk by chunk get the declared types of the pipeline, whatever the values of the first chunk.
+
+pipeline_file = str(Path(__file__).resolve().parents[1] / 'pipeline.json')
+
+types = {'ocupacao': 'string', 'doencas_condicoes': 'list', 'n_atendimentos_hospital': 'int', 'obito': 'flag',
+         'tipo': 'category', 'altura': 'float32'}
+
+def chunks():
+    first = pd.DataFrame({
+        'ocupacao': [None, None],
+        'doencas_condicoes': pd.Categorical([np.nan, np.nan]), # no list seen yet
+        'n_atendimentos_hospital': [1, 0], # fits int8
+        'obito': [0, 1],
+        'tipo': [None, None],
+        'altura': [np.nan, np.nan],
+    })
+    second = pd.DataFrame({
+        'ocupacao': ['Pedreiro', None],
+        'doencas_condicoes': pd.Categorical(["['Diabetes', 'Hipertensão']", np.nan]),
+        'n_atendimentos_hospital': [300, 2],
+        'obito': [1, 0],
+        'tipo': pd.Categorical(['rotineiro', 'rotineiro']),
+        'altura': [170.0, 150.5],
+    })
+    return first, second
+
+def test_chunks_get_the_declared_types(tmp_path):
+    path = str(tmp_path / 'chunks.parquet')
+    writer = ParquetChunkWriter(path, types=types)
+    for chunk in chunks():
+        writer.write(chunk)
+    writer.close()
+
+    table = pq.read_table(path)
+    assert {field.name: field.type for field in table.schema} == {col: arrow_types[kind] for col, kind in types.items()}
+    assert table.to_pydict() == {
+        'ocupacao': [None, None, 'Pedreiro', None],
+        'doencas_condicoes': [None, None, ['Diabetes', 'Hipertensão'], None],
+        'n_atendimentos_hospital': [1, 0, 300, 2],
+        'obito': [0, 1, 1, 0],
+        'tipo': [None, None, 'rotineiro', 'rotineiro'],
+        'altura': [None, None, 170.0, 150.5],
+    }
+
+def test_undeclared_columns_keep_the_first_chunk_types(tmp_path):
+    path = str(tmp_path / 'chunks.parquet')
+    writer = ParquetChunkWriter(path, types={})
+    writer.write(pd.DataFrame({'n': [1.5, 2.0]}))
+    writer.write(pd.DataFrame({'n': [3.0, 4.0]}))
+    writer.close()
+    assert pq.read_table(path).schema.field('n').type == pa.float64()
+
+def test_chunked_file_equals_eager_file(raw_extract, tmp_path):
+    for compact in (False, True):
+        pipeline = Pipeline.from_file(pipeline_file, compact)
+        eager, chunked = str(tmp_path / 'eager.parquet'), str(tmp_path / 'chunked.parquet')
+        write_table(pipeline.run(load_raw(raw_extract)[0]), eager, types=pipeline.column_types())
+        pipeline.run_chunked(raw_extract, {chunked: False}, chunksize=700)
+
+        eager, chunked = pq.read_table(eager), pq.read_table(chunked)
+        assert eager.schema == chunked.schema
+
+        # New random IDs for patients sharing an ID, and outlier limits from quantile sketches in chunks
+        dropped = ['id_paciente'] + [col for col in eager.column_names if col.endswith('_outlier_flag')]
+        pd.testing.assert_frame_equal(eager.drop_columns(dropped).to_pandas(), chunked.drop_columns(dropped).to_pandas(),
+                                      check_categorical=False) # each row group has its own dictionary
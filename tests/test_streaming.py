@@ -0,0 +1,14 @@
+import numpy as np
+import pandas as pd
+
+from lib.functions import hash_ids
+from lib.streaming import find_duplicated_rows
+
+# Duplicated IDs found in chunks, with the distinct hashes merged as the file is read.
+
+def test_duplicated_rows_found_in_chunks(raw_extract):
+    ids = pd.read_csv(raw_extract, usecols=['id_paciente'])['id_paciente']
+    for chunksize in (97, 1_000, 10_000):
+        keys, hashes = find_duplicated_rows(raw_extract, 'id_paciente', ['data_nascimento'], chunksize)
+        assert np.array_equal(hashes, np.unique(hash_ids(ids)))
+        assert list(keys.index) == list(ids.index[ids.duplicated(keep=False)])
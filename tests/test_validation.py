@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from lib.validation import QualityReport, validate
+
+# Data quality reports of chunks and workers merged into one.
+
+def ids(rows, seed):
+    rng = np.random.default_rng(seed)
+    values = pd.Series([f'{i:032x}' for i in rng.integers(0, rows // 2, rows)], dtype=object)
+    values[rng.random(rows) < 0.05] = None
+    return values
+
+def test_merged_duplicates_equal_one_pass():
+    series = ids(50_000, 0)
+    whole = QualityReport()
+    whole.add_keys('id_paciente', series)
+
+    chunked, other = QualityReport(), QualityReport()
+    for start in range(0, len(series), 4_000):
+        (chunked if start % 8_000 else other).add_keys('id_paciente', series.iloc[start:start + 4_000])
+    chunked.merge(other)
+
+    counts = series.value_counts()
+    expected = (int(counts[counts > 1].sum()), int((counts > 1).sum()))
+    assert whole.duplicates('id_paciente') == expected
+    assert chunked.duplicates('id_paciente') == expected
+    assert chunked.to_dict() == whole.to_dict()
+
+def test_chunks_added_after_the_results_are_counted():
+    report = QualityReport()
+    report.add_keys('id_paciente', pd.Series(['a', 'b']))
+    assert report.duplicates('id_paciente') == (0, 0)
+    report.add_keys('id_paciente', pd.Series(['b', 'c', None]))
+    assert report.duplicates('id_paciente') == (2, 1)
+
+def test_chunked_validation_equals_whole_table(raw_extract):
+    df = pd.read_csv(raw_extract)
+    whole, chunked = validate(df), QualityReport()
+    for start in range(0, len(df), 700):
+        chunked.merge(validate(df.iloc[start:start + 700]))
+    assert chunked.table()[['column', 'check', 'rows']].equals(whole.table()[['column', 'check', 'rows']])